@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, time, threading, subprocess
+from multiprocessing.pool import ThreadPool
+
+class BSPDecompiler(object):
+	"""
+	Decompiles .bsp files to .vmf files with BSPSource, which writes <map>_d.vmf next to every .bsp.
+
+	Maps of which the _d.vmf is newer than the .bsp are skipped. The remaining maps are split in batches of batch_size files per BSPSource invocation (to spread the JVM startup cost), of which at most workers run at the same time.
+	When BSPSource crashes or times out on a batch, the VMF files it wrote are removed (the one it was writing is likely truncated), and the maps of that batch are decompiled again one at a time, so only the map that breaks BSPSource fails.
+	"""
+
+	STATUS_SKIPPED 	= 'skipped'
+	STATUS_OK 		= 'ok'
+	STATUS_FAILED 	= 'failed'
+
+	def __init__(self, java_exec, bspsrc_jar='bspsrc.jar', workers=2, batch_size=8, timeout=900):
+		"""
+		Contructor
+		"""
+		self.java_exec = java_exec
+		self.bspsrc_jar = bspsrc_jar
+		self.workers = workers
+		self.batch_size = batch_size
+		self.timeout = timeout
+
+	def decompile(self, bsp_files):
+		"""
+		Decompile the given .bsp files, returns a result dict per file: {'bspFile', 'status', 'seconds', 'error'}.
+		The seconds of a decompiled map are its share of the runtime of its batch.
+		"""
+		results = []
+		stale_bsp_files = []
+		for bsp_file in bsp_files:
+			if self.isVMFFresh(bsp_file):
+				results.append({'bspFile' : bsp_file, 'status' : BSPDecompiler.STATUS_SKIPPED, 'seconds' : 0.0, 'error' : None})
+			else:
+				stale_bsp_files.append(bsp_file)
+
+		batches = [stale_bsp_files[i:i+self.batch_size] for i in range(0, len(stale_bsp_files), self.batch_size)]
+		if len(batches) == 0:
+			return results
+
+		pool = ThreadPool(min(self.workers, len(batches)))
+		try:
+			for batch_results in pool.imap_unordered(self.__decompileBatch, batches):
+				for result in batch_results:
+					if result['status'] == BSPDecompiler.STATUS_OK:
+						print("[BSPSource] Decompiled {} ({:.1f}s)".format(os.path.basename(result['bspFile']), result['seconds']))
+					else:
+						print("[BSPSource] Failed to decompile {}: {}".format(os.path.basename(result['bspFile']), result['error']))
+				results.extend(batch_results)
+		finally:
+			pool.close()
+			pool.join()
+		return results
+
+	def getVMFFilename(self, bsp_file):
+		return '{}_d.vmf'.format(bsp_file[:-len('.bsp')])
+
+	def isVMFFresh(self, bsp_file):
+		vmf_file = self.getVMFFilename(bsp_file)
+		return os.path.exists(vmf_file) and os.path.getmtime(vmf_file) >= os.path.getmtime(bsp_file)
+
+	def __decompileBatch(self, bsp_files):
+		cmd = [self.java_exec, '-jar', self.bspsrc_jar]
+		cmd.extend(bsp_files)
+		start = time.time()
+		error = None
+		output = ''
+		timed_out = threading.Event()
+		try:
+			process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+			# Kill BSPSource when it hangs on a broken map
+			timer = threading.Timer(self.timeout, self.__killProcess, (process, timed_out))
+			timer.start()
+			try:
+				output = process.communicate()[0].decode('utf-8', 'replace')
+			finally:
+				timer.cancel()
+			if timed_out.is_set():
+				error = 'BSPSource timed out after {} seconds'.format(self.timeout)
+			elif process.returncode != 0:
+				error = 'BSPSource exited with code {}'.format(process.returncode)
+		except OSError as e:
+			error = 'Could not start BSPSource: {}'.format(e)
+		seconds = (time.time() - start) / len(bsp_files)
+
+		if error is not None:
+			# Every VMF that is fresh now was written by this invocation, but the one it was writing when it stopped is incomplete
+			for bsp_file in bsp_files:
+				if self.isVMFFresh(bsp_file):
+					os.remove(self.getVMFFilename(bsp_file))
+
+		results = []
+		failed_bsp_files = []
+		for bsp_file in bsp_files:
+			if self.isVMFFresh(bsp_file):
+				results.append({'bspFile' : bsp_file, 'status' : BSPDecompiler.STATUS_OK, 'seconds' : seconds, 'error' : None})
+			elif error is not None and len(bsp_files) > 1:
+				# One broken map takes the whole invocation down, retry the others on their own
+				failed_bsp_files.append(bsp_file)
+			else:
+				map_error = error
+				if map_error is None:
+					map_error = 'No VMF file was written. {}'.format(output.strip().split('\n')[-1])
+				results.append({'bspFile' : bsp_file, 'status' : BSPDecompiler.STATUS_FAILED, 'seconds' : seconds, 'error' : map_error})
+		if len(failed_bsp_files) > 0:
+			print("[BSPSource] Batch failed ({}), decompiling its {} map(s) one at a time.".format(error, len(failed_bsp_files)))
+			for bsp_file in failed_bsp_files:
+				results.extend(self.__decompileBatch([bsp_file]))
+		return results
+
+	def __killProcess(self, process, timed_out):
+		timed_out.set()
+		try:
+			process.kill()
+		except OSError:
+			# Exited in the meantime
+			pass
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import re, mmap, struct
+from vmf_parser.entity import Entity
+try:
+	import lzma
+except ImportError:
+	# Python 2, only required for maps with compressed lumps
+	lzma = None
+
+class BSPReader(object):
+	"""
+	Stateless reader for Source Engine .bsp files, which reads the map revision from the header and the entities from the entity lump without decompiling the map.
+
+	Returns the same structure as VMFParser does for the decompiled _d.vmf, limited to the point entity data: {'world': {...worldspawn keyvalues, 'mapversion'}, 'entity': [{...}, ...]}.
+	Entity outputs are moved to a 'connections' dict like in a VMF, brush geometry is not available. With compact_entities the entities are returned as Entity objects.
+	Static props are not part of the entity lump, they are read from the static prop game lump (sprp) and added as prop_static entities with their model, origin and angles, like BSPSource decompiles them.
+	"""
+
+	HEADER_IDENT 		= b'VBSP'
+	HEADER_LUMPS 		= 64
+	LUMP_ENTITIES 		= 0
+	LUMP_GAME_LUMP 		= 35
+	LZMA_IDENT 			= b'LZMA'
+	# Game lump ids are stored as little endian ints, 'sprp' reads as b'prps'
+	GAME_LUMP_STATIC_PROPS 	= b'prps'
+	STATIC_PROP_NAME_LENGTH = 128
+
+	def __init__(self, compact_entities=False):
+		"""
+		Contructor
+		"""
+		self.compact_entities = compact_entities
+		self.token_re = re.compile(r'"([^"]*)"|([{}])')
+		self.connection_re = re.compile(r'^[^,\x1b]*([,\x1b][^,\x1b]*){4}$')
+
+	def load(self, bsp_location):
+		"""
+		Load the map revision and entities of a .bsp file from the filesystem.
+		"""
+		if type(bsp_location) is not str:
+			raise Exception('Must supply the BSP file location in a str.')
+
+		(map_revision, entity_lump, static_props) = self.__readLumps(bsp_location)
+		entities = self.__parseEntities(entity_lump.decode('utf-8', 'replace')) + static_props
+
+		obj = {'world' : {}, 'entity' : []}
+		for entity in entities:
+			if entity.get('classname') == 'worldspawn':
+				obj['world'] = entity
+			elif self.compact_entities == True:
+				obj['entity'].append(Entity(entity))
+			else:
+				obj['entity'].append(entity)
+		if 'mapversion' not in obj['world']:
+			obj['world']['mapversion'] = str(map_revision)
+		return obj
+
+	def __readLumps(self, bsp_location):
+		"""
+		Returns the map revision, the (decompressed) entity lump and the static props.
+		"""
+		with open(bsp_location, 'rb') as bsp_file:
+			data = mmap.mmap(bsp_file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			# dheader_t: ident, version, lump_t lumps[64], mapRevision
+			if data[0:4] != BSPReader.HEADER_IDENT:
+				raise Exception('{} is not a Source Engine BSP file.'.format(bsp_location))
+			(map_revision,) = struct.unpack_from('<i', data, 8 + 16 * BSPReader.HEADER_LUMPS)
+			entity_lump = self.__getLump(data, BSPReader.LUMP_ENTITIES)
+			if entity_lump is None:
+				raise Exception('{} has a corrupt entity lump.'.format(bsp_location))
+			try:
+				static_props = self.__readStaticProps(data)
+			except Exception as e:
+				# The entities are still usable, but the metadata will miss the static props
+				print("Could not read the static props of {}, the metadata will not include them: {}".format(bsp_location, e))
+				static_props = []
+		finally:
+			data.close()
+		return (map_revision, self.__decompressLump(entity_lump), static_props)
+
+	def __getLump(self, data, lump_index):
+		# lump_t: fileofs, filelen, version, fourCC
+		(fileofs, filelen, lump_version, fourcc) = struct.unpack_from('<iii4s', data, 8 + 16 * lump_index)
+		if fileofs < 0 or filelen < 0 or fileofs + filelen > len(data):
+			return None
+		return data[fileofs:fileofs + filelen]
+
+	def __readStaticProps(self, data):
+		"""
+		Returns a prop_static entity for every static prop in the sprp game lump.
+		"""
+		game_lump = self.__getLump(data, BSPReader.LUMP_GAME_LUMP)
+		if game_lump is None:
+			raise Exception('corrupt game lump')
+		if len(game_lump) < 4:
+			return []
+		# dgamelumpheader_t: lumpCount, followed by dgamelump_t: id, flags, version, fileofs (from the start of the file), filelen
+		(lump_count,) = struct.unpack_from('<i', game_lump, 0)
+		for i in range(0, lump_count):
+			(lump_id, flags, version, fileofs, filelen) = struct.unpack_from('<4sHHii', game_lump, 4 + 16 * i)
+			if lump_id != BSPReader.GAME_LUMP_STATIC_PROPS:
+				continue
+			if fileofs < 0 or filelen < 0 or fileofs + filelen > len(data):
+				raise Exception('corrupt static prop game lump')
+			return self.__parseStaticProps(self.__decompressLump(data[fileofs:fileofs + filelen]))
+		return []
+
+	def __parseStaticProps(self, lump):
+		# Model dictionary: count, followed by 128 byte names
+		(dict_entries,) = struct.unpack_from('<i', lump, 0)
+		offset = 4
+		names = []
+		for i in range(0, dict_entries):
+			name = lump[offset:offset + BSPReader.STATIC_PROP_NAME_LENGTH].split(b'\0', 1)[0]
+			names.append(name.decode('utf-8', 'replace'))
+			offset += BSPReader.STATIC_PROP_NAME_LENGTH
+		# Leaf list: count, followed by unsigned shorts
+		(leaf_entries,) = struct.unpack_from('<i', lump, offset)
+		offset += 4 + 2 * leaf_entries
+		(prop_entries,) = struct.unpack_from('<i', lump, offset)
+		offset += 4
+		if prop_entries == 0:
+			return []
+		# The size of StaticPropLump_t depends on the lump version (and differs between games with the same version), derive it from the lump size instead
+		if (len(lump) - offset) % prop_entries != 0:
+			raise Exception('unexpected static prop lump size')
+		prop_size = (len(lump) - offset) // prop_entries
+		props = []
+		for i in range(0, prop_entries):
+			# StaticPropLump_t starts with: Vector origin, QAngle angles, unsigned short propType (index in the model dictionary)
+			(x, y, z, pitch, yaw, roll, prop_type) = struct.unpack_from('<ffffffH', lump, offset + i * prop_size)
+			if prop_type >= len(names):
+				raise Exception('static prop refers to an unknown model')
+			props.append({
+				'classname' : 'prop_static',
+				'model' : names[prop_type],
+				'origin' : self.__formatVector((x, y, z)),
+				'angles' : self.__formatVector((pitch, yaw, roll)),
+			})
+		return props
+
+	def __formatVector(self, vector):
+		# Floats are stored with single precision, 7 significant digits are enough
+		return ' '.join(['{:.7g}'.format(f) for f in vector])
+
+	def __decompressLump(self, lump):
+		if lump[0:4] != BSPReader.LZMA_IDENT:
+			return lump
+		if lzma is None:
+			raise Exception('Reading LZMA compressed lumps requires the lzma module.')
+		# lzma_header_t: id, actualSize, lzmaSize, properties[5], followed by the raw LZMA stream
+		(actual_size, lzma_size) = struct.unpack_from('<II', lump, 4)
+		properties = lump[12:17]
+		# Rebuild the header of the .lzma (alone) format, which includes the uncompressed size
+		alone = properties + struct.pack('<Q', actual_size) + lump[17:17 + lzma_size]
+		return lzma.LZMADecompressor(format=lzma.FORMAT_ALONE).decompress(alone)[:actual_size]
+
+	def __parseEntities(self, entity_lump):
+		entities = []
+		entity = None
+		key = None
+		for token in self.token_re.finditer(entity_lump):
+			(string, bracket) = token.groups()
+			if bracket == '{':
+				entity = {}
+				key = None
+			elif bracket == '}':
+				if entity is not None:
+					entities.append(entity)
+				entity = None
+			elif entity is not None:
+				if key is None:
+					key = string
+				else:
+					if self.connection_re.match(string):
+						# An output, e.g. "OnTrigger" "target,input,parameter,delay,times"
+						entity.setdefault('connections', {})[key] = string
+					else:
+						entity[key] = string
+					key = None
+		return entities
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, time, threading, traceback
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+
+class ScreenCaptureBackend(object):
+	"""
+	Grabs the screen into an in-memory image, without encoding it.
+
+	Uses PIL's ImageGrab (X11) when available, which reads the framebuffer directly. Otherwise it falls back to pyautogui.
+	"""
+
+	def __init__(self, region=None):
+		"""
+		Contructor
+		"""
+		# (left, top, width, height), or None for the full screen
+		self.region = region
+		self.image_grab = None
+		try:
+			from PIL import ImageGrab
+			ImageGrab.grab(bbox=(0, 0, 1, 1))
+			self.image_grab = ImageGrab
+		except Exception:
+			print("PIL ImageGrab is not available, capturing with pyautogui.")
+
+	def grab(self):
+		if self.image_grab is not None:
+			bbox = None
+			if self.region is not None:
+				(left, top, width, height) = self.region
+				bbox = (left, top, left + width, top + height)
+			return self.image_grab.grab(bbox=bbox)
+		import pyautogui
+		return pyautogui.screenshot(region=self.region)
+
+class FileCaptureBackend(object):
+	"""
+	Returns frames from image files instead of the screen (in order, starting over at the end), to test capturing without the game.
+	"""
+
+	def __init__(self, filenames):
+		"""
+		Contructor
+		"""
+		self.frames = []
+		for filename in filenames:
+			frame = Image.open(filename)
+			frame.load()
+			self.frames.append(frame.convert('RGB'))
+		if len(self.frames) == 0:
+			raise Exception('FileCaptureBackend requires at least one image.')
+		self.index = 0
+
+	def grab(self):
+		frame = self.frames[self.index % len(self.frames)]
+		self.index += 1
+		return frame.copy()
+
+class TestPatternCaptureBackend(object):
+	"""
+	Returns generated frames instead of the screen, every frame has a different pattern, to test capturing without the game.
+	"""
+
+	def __init__(self, width=1920, height=1080):
+		"""
+		Contructor
+		"""
+		self.width = width
+		self.height = height
+		self.index = 0
+
+	def grab(self):
+		rows = np.arange(self.height, dtype=np.uint16).reshape(-1, 1)
+		columns = np.arange(self.width, dtype=np.uint16).reshape(1, -1)
+		data = np.empty((self.height, self.width, 3), dtype=np.uint8)
+		data[:, :, 0] = (columns + self.index * 8) % 256
+		data[:, :, 1] = (rows + self.index * 8) % 256
+		data[:, :, 2] = ((rows // 64 + columns // 64 + self.index) % 2) * 255
+		self.index += 1
+		return Image.fromarray(data, 'RGB')
+
+class EncodingPool(object):
+	"""
+	Encodes and writes captured frames in a pool of threads (the image codecs release the GIL), so capturing does not wait for it.
+
+	save() blocks while max_pending frames are still being encoded, which keeps the frames waiting in memory bounded.
+	Call flush() before using the written files.
+	"""
+
+	FORMAT_PNG 		= 'png'
+	FORMAT_WEBP 	= 'webp'
+
+	def __init__(self, workers=2, image_format=FORMAT_PNG, max_pending=16, png_compress_level=6, webp_quality=90):
+		"""
+		Contructor
+		"""
+		if image_format not in [EncodingPool.FORMAT_PNG, EncodingPool.FORMAT_WEBP]:
+			raise Exception('Unknown image format {}.'.format(image_format))
+		self.image_format = image_format
+		self.png_compress_level = png_compress_level
+		self.webp_quality = webp_quality
+		self.pool = ThreadPool(workers)
+		self.pending = threading.BoundedSemaphore(max_pending)
+		self.lock = threading.Lock()
+		self.results = []
+		self.failed = []
+		# Total time spent encoding and writing, over all workers
+		self.busy_seconds = 0.0
+		self.encoded = 0
+
+	def getExtension(self):
+		return self.image_format
+
+	def save(self, image, filename):
+		"""
+		Queue the image to be written to filename, returns immediately unless max_pending frames are waiting.
+		The returned result gives the filename once written, or None when writing failed.
+		"""
+		self.pending.acquire()
+		result = self.pool.apply_async(self.__encode, (image, filename))
+		with self.lock:
+			self.results.append(result)
+		return result
+
+	def flush(self):
+		"""
+		Wait until every queued frame is written, returns the filenames that failed so far.
+		"""
+		with self.lock:
+			results = self.results
+			self.results = []
+		for result in results:
+			result.wait()
+		return list(self.failed)
+
+	def close(self):
+		self.flush()
+		self.pool.close()
+		self.pool.join()
+		if len(self.failed) > 0:
+			print("Failed to write {} screenshot(s).".format(len(self.failed)))
+
+	def __encode(self, image, filename):
+		start = time.time()
+		written = None
+		try:
+			directory = os.path.dirname(filename)
+			if directory != '' and not os.path.exists(directory):
+				try:
+					os.makedirs(directory)
+				except OSError:
+					# Created by another worker in the meantime
+					pass
+			if self.image_format == EncodingPool.FORMAT_WEBP:
+				image.save(filename, 'WEBP', quality=self.webp_quality)
+			else:
+				image.save(filename, 'PNG', compress_level=self.png_compress_level)
+			written = filename
+		except Exception:
+			print("Failed to write '{}':\n{}".format(filename, traceback.format_exc()))
+			self.failed.append(filename)
+		finally:
+			with self.lock:
+				self.busy_seconds += time.time() - start
+				self.encoded += 1
+			self.pending.release()
+		return written
+
+class SettleDetector(object):
+	"""
+	Waits until the game finished rendering after the camera changed, by grabbing frames in quick succession until they stop changing.
+
+	Frames are compared downscaled and in grayscale, a frame counts as unchanged when the mean absolute difference (0-255) to the previous frame is at most threshold.
+	Unchanged frames only count once the view changed from the first grabbed frame, since the game may not have started rendering the new view yet.
+	When the view does not change within change_timeout (e.g. a command that keeps the same view), the unchanged frames count from then on.
+	The last grabbed frame is returned, so it can be used as the screenshot without grabbing again.
+	"""
+
+	def __init__(self, threshold=1.0, stable_frames=2, min_wait=0.05, poll_interval=0.03, timeout=3.0, size=(160, 90), change_timeout=0.5):
+		"""
+		Contructor
+		"""
+		self.threshold = threshold
+		# Number of consecutive unchanged frames required
+		self.stable_frames = stable_frames
+		# Always wait this long, the game does not start rendering the new view immediately
+		self.min_wait = min_wait
+		self.poll_interval = poll_interval
+		self.timeout = timeout
+		self.size = size
+		# Without a change of the view, frames only count as stable after this many seconds
+		self.change_timeout = change_timeout
+
+	def waitForSettle(self, backend):
+		"""
+		Returns (frame, seconds, settled), settled is False when the frames were still changing at the timeout.
+		"""
+		start = time.time()
+		time.sleep(self.min_wait)
+		frame = backend.grab()
+		first = self.__getThumbnail(frame)
+		previous = first
+		changed = False
+		stable = 0
+		while stable < self.stable_frames:
+			if time.time() - start >= self.timeout:
+				return (frame, time.time() - start, False)
+			time.sleep(self.poll_interval)
+			frame = backend.grab()
+			thumbnail = self.__getThumbnail(frame)
+			if not changed:
+				changed = np.mean(np.abs(thumbnail - first)) > self.threshold or time.time() - start >= self.change_timeout
+			if changed and np.mean(np.abs(thumbnail - previous)) <= self.threshold:
+				stable += 1
+			else:
+				stable = 0
+			previous = thumbnail
+		return (frame, time.time() - start, True)
+
+	def __getThumbnail(self, frame):
+		return np.asarray(frame.convert('L').resize(self.size, Image.BILINEAR), dtype=np.int16)
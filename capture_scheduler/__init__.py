@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, glob, time, traceback, multiprocessing
+from job_ledger import JobLedger
+
+class CaptureScheduler(object):
+	"""
+	Runs multiple game instances at once, each in its own process with its own display (e.g. a separate X server) and game directory.
+
+	The maps are divided over the instances in the shared job ledger. Every instance works through its own shard first,
+	and takes over maps from the largest remaining shard once its own is empty.
+	The scheduler checks the health of every instance: an instance that exits with an error, or stops sending heartbeats for heartbeat_timeout seconds,
+	is stopped, the maps it was working on are made pending again, and it is restarted (at most max_restarts times).
+
+	instances is a list of dicts with a 'name', 'display' and 'game_base_dir'.
+	coordinator_factory is an optional module-level function (instance => coordinator), to run the instances with e.g. a FakeGameCoordinator.
+	"""
+
+	def __init__(self, instances, metadata_filename, screenshots_storage_dir, tasks, ledger_filename=None, map_priorities=None,
+				 heartbeat_timeout=600, health_check_interval=5, max_restarts=3, coordinator_factory=None, runner_kwargs=None):
+		"""
+		Contructor
+		"""
+		if len(set([instance['name'] for instance in instances])) != len(instances):
+			raise Exception('Every instance requires a unique name.')
+		self.instances = instances
+		self.metadata_filename = metadata_filename
+		self.screenshots_storage_dir = screenshots_storage_dir
+		self.tasks = tasks
+		if ledger_filename is None:
+			ledger_filename = '{}/ledger.sqlite'.format(screenshots_storage_dir)
+		self.ledger_filename = ledger_filename
+		self.map_priorities = map_priorities
+		self.heartbeat_timeout = heartbeat_timeout
+		self.health_check_interval = health_check_interval
+		self.max_restarts = max_restarts
+		self.coordinator_factory = coordinator_factory
+		self.runner_kwargs = runner_kwargs if runner_kwargs is not None else {}
+
+	def run(self):
+		if not os.path.exists(self.screenshots_storage_dir):
+			os.makedirs(self.screenshots_storage_dir)
+		ledger = JobLedger(self.ledger_filename, max_attempts=self.runner_kwargs.get('max_map_attempts', 3))
+		# Only maps every instance has can be processed by any instance
+		maps = None
+		for instance in self.instances:
+			instance_maps = set(self.__getAllMapsInFolder('{}tf/maps/'.format(instance['game_base_dir'])))
+			maps = instance_maps if maps is None else maps & instance_maps
+		ledger.addMaps(sorted(maps), self.map_priorities)
+		ledger.assignShards([instance['name'] for instance in self.instances])
+		print("Maps per state in the ledger: {}".format(ledger.getSummary()))
+
+		workers = {}
+		restarts = dict((instance['name'], 0) for instance in self.instances)
+		for instance in self.instances:
+			workers[instance['name']] = self.__startInstance(instance, ledger)
+		while len(workers) > 0:
+			time.sleep(self.health_check_interval)
+			for instance in self.instances:
+				name = instance['name']
+				if name not in workers:
+					continue
+				process = workers[name]
+				heartbeat = ledger.getHeartbeat(name)
+				if not process.is_alive() and process.exitcode == 0:
+					print("Instance '{}' finished.".format(name))
+					del workers[name]
+					continue
+				if process.is_alive() and (heartbeat is None or time.time() - heartbeat < self.heartbeat_timeout):
+					continue
+				# Crashed, or stopped responding
+				if process.is_alive():
+					print("Instance '{}' did not send a heartbeat for {} seconds, stopping it.".format(name, self.heartbeat_timeout))
+					process.terminate()
+					process.join()
+				else:
+					print("Instance '{}' exited with code {}.".format(name, process.exitcode))
+				released = ledger.releaseMaps(name)
+				if len(released) > 0:
+					print("Released the maps of instance '{}': {}".format(name, ', '.join(released)))
+				del workers[name]
+				if restarts[name] < self.max_restarts:
+					restarts[name] += 1
+					print("Restarting instance '{}' ({}/{}).".format(name, restarts[name], self.max_restarts))
+					workers[name] = self.__startInstance(instance, ledger)
+				else:
+					print("Instance '{}' failed too often, not restarting it.".format(name))
+		print("Maps per state in the ledger: {}".format(ledger.getSummary()))
+		ledger.close()
+
+	def __startInstance(self, instance, ledger):
+		# The heartbeat timeout starts now, a new instance also needs time to start the game
+		ledger.heartbeat(instance['name'])
+		process = multiprocessing.Process(target=_runInstance, name=instance['name'],
+										  args=(instance, self.metadata_filename, self.screenshots_storage_dir, self.tasks, self.ledger_filename, self.coordinator_factory, self.runner_kwargs))
+		process.start()
+		print("Started instance '{}' on display {} (pid {}).".format(instance['name'], instance.get('display'), process.pid))
+		return process
+
+	def __getAllMapsInFolder(self, maps_dir):
+		return [os.path.basename(filename)[:-len('.bsp')] for filename in glob.glob('{}*.bsp'.format(maps_dir))]
+
+def _runInstance(instance, metadata_filename, screenshots_storage_dir, tasks, ledger_filename, coordinator_factory, runner_kwargs):
+	"""
+	Runs a GameMapRunner for one instance, in its own process.
+	"""
+	try:
+		# Before anything connects to the display
+		if instance.get('display') is not None:
+			os.environ['DISPLAY'] = instance['display']
+		from run_game_map import GameMapRunner
+		coordinator = None
+		if coordinator_factory is not None:
+			coordinator = coordinator_factory(instance)
+		runner = GameMapRunner(instance['game_base_dir'], screenshots_storage_dir, metadata_filename, ledger_filename=ledger_filename,
+							   game_coordinator=coordinator, instance_name=instance['name'], interactive=False, **runner_kwargs)
+		runner.gatherScreenshotsBasedOnMetadata(metadata_filename, tasks)
+	except Exception:
+		traceback.print_exc()
+		os._exit(1)
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+"""
+Checks the CaptureScheduler with two FakeGame instances: the slow instance gets maps taken over by the fast one, the game of the fast one crashes while loading a map,
+which is retried after the backoff, and every map ends up done.
+
+Usage: python -m capture_scheduler.check
+"""
+import os, json, shutil, sqlite3, tempfile
+from capture_scheduler import CaptureScheduler
+from fake_game import FakeGame, FakeGameCoordinator
+from job_ledger import JobLedger
+
+MAP_NAMES = ['check_{:02d}'.format(i) for i in range(6)]
+
+def getCoordinator(instance):
+	# Module level, so the instance processes can use it
+	return FakeGameCoordinator(FakeGame(instance['game_base_dir'], **instance['fake_game']), map_load_timeout=2)
+
+def getMetadata():
+	return {'cameras' : [{'origin' : '0 0 0', 'angles' : '0 0 0'}], 'dimensions' : [0, 0, {'scale' : 4}, {'x' : 0, 'y' : 0, 'z' : 100}]}
+
+def checkLedger(ledger_filename):
+	connection = sqlite3.connect(ledger_filename)
+	try:
+		maps = connection.execute("SELECT map_name, shard, owner, state, attempts FROM maps ORDER BY map_name").fetchall()
+	finally:
+		connection.close()
+	for (map_name, shard, owner, state, attempts) in maps:
+		print("{}: shard {}, captured by {}, {} after {} attempt(s)".format(map_name, shard, owner, state, attempts))
+	checks = [
+		('all maps are done', len(maps) == len(MAP_NAMES) and all([state == JobLedger.STATE_DONE for (map_name, shard, owner, state, attempts) in maps])),
+		('a map was taken over from the slow instance', any([owner != shard for (map_name, shard, owner, state, attempts) in maps])),
+		('the map of the crashed game was retried', any([attempts >= 2 for (map_name, shard, owner, state, attempts) in maps])),
+	]
+	for (name, passed) in checks:
+		if not passed:
+			print("WARNING: expected that {}.".format(name))
+	return all([passed for (name, passed) in checks])
+
+if __name__ == '__main__':
+	work_dir = tempfile.mkdtemp()
+	try:
+		metadata_filename = os.path.join(work_dir, 'metadata.json')
+		with open(metadata_filename, 'w') as outfile:
+			json.dump(dict((map_name, getMetadata()) for map_name in MAP_NAMES), outfile)
+		instances = [
+			{'name' : 'slow', 'display' : None, 'game_base_dir' : os.path.join(work_dir, 'slow', ''), 'fake_game' : {'load_time' : 2.0, 'render_time' : 0.3}},
+			{'name' : 'fast', 'display' : None, 'game_base_dir' : os.path.join(work_dir, 'fast', ''), 'fake_game' : {'load_time' : 0.2, 'render_time' : 0.05, 'crash_after_maps' : 1}},
+		]
+		for instance in instances:
+			FakeGame(instance['game_base_dir']).installMaps(MAP_NAMES)
+		screenshots_dir = os.path.join(work_dir, 'screenshots')
+		scheduler = CaptureScheduler(instances, metadata_filename, screenshots_dir, [1], health_check_interval=0.5, coordinator_factory=getCoordinator,
+									 runner_kwargs={'pp_workers' : 1, 'settle_timeout' : 1.0, 'retry_backoff' : 1})
+		scheduler.run()
+		if checkLedger(os.path.join(screenshots_dir, 'ledger.sqlite')):
+			print("All scheduler checks passed.")
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, re, time, threading
+
+class ConsoleLogWatcher(object):
+	"""
+	Follows the console log the game writes when started with -condebug, so we can wait for events (map loaded, echoed commands) instead of sleeping a fixed amount of time.
+
+	The log is polled, which works on every filesystem. Only lines written after mark() are considered by waitFor(), earlier output is ignored.
+	"""
+
+	# Printed by the client once the map is loaded and rendered
+	MAP_LOADED_PATTERNS 	= (r'Redownloading all lightmaps',)
+	MAP_FAILED_PATTERNS 	= (r'map load failed', r'^Map .* not found', r"^Couldn't (find|load) map")
+
+	def __init__(self, filename, poll_interval=0.1):
+		"""
+		Contructor
+		"""
+		self.filename = filename
+		self.poll_interval = poll_interval
+		self.offset = 0
+		self.buffer = ''
+		self.mark()
+
+	def mark(self):
+		"""
+		Skips everything that is currently in the log, only newer lines are matched from now on.
+		"""
+		self.offset = self.__getSize()
+		self.buffer = ''
+		return self.offset
+
+	def readLines(self):
+		"""
+		Returns the complete lines that were appended to the log since the last read.
+		"""
+		size = self.__getSize()
+		if size < self.offset:
+			# The log was truncated or replaced (game restarted), start from the beginning
+			self.offset = 0
+			self.buffer = ''
+		if size == self.offset:
+			return []
+		with open(self.filename, 'rb') as log_file:
+			log_file.seek(self.offset)
+			data = log_file.read(size - self.offset)
+		self.offset += len(data)
+		self.buffer += data.decode('utf-8', 'replace')
+		lines = self.buffer.split('\n')
+		# The last part is not terminated yet, keep it for the next read
+		self.buffer = lines.pop()
+		return [line.rstrip('\r') for line in lines]
+
+	def waitFor(self, patterns, timeout, failure_patterns=()):
+		"""
+		Blocks until a line matches one of the patterns (regular expressions), and returns that line.
+		Returns None when the timeout passed, or when a line matches one of the failure_patterns first.
+		"""
+		compiled = [re.compile(pattern) for pattern in patterns]
+		compiled_failures = [re.compile(pattern) for pattern in failure_patterns]
+		deadline = time.time() + timeout
+		while True:
+			for line in self.readLines():
+				for pattern in compiled_failures:
+					if pattern.search(line):
+						print("Console reported '{}'.".format(line))
+						return None
+				for pattern in compiled:
+					if pattern.search(line):
+						return line
+			if time.time() >= deadline:
+				return None
+			time.sleep(self.poll_interval)
+
+	def __getSize(self):
+		try:
+			return os.path.getsize(self.filename)
+		except OSError:
+			return 0
+
+class FakeConsoleLog(object):
+	"""
+	Writes a console log like the game would, to test the ConsoleLogWatcher and GameCoordinator without starting the game.
+	"""
+
+	def __init__(self, filename):
+		"""
+		Contructor
+		"""
+		self.filename = filename
+		self.timers = []
+		self.lock = threading.Lock()
+
+	def write(self, line):
+		with self.lock:
+			with open(self.filename, 'a') as log_file:
+				log_file.write('{}\n'.format(line))
+
+	def writeLater(self, line, delay):
+		"""
+		Writes the line after delay seconds, without blocking.
+		"""
+		timer = threading.Timer(delay, self.write, (line,))
+		timer.daemon = True
+		timer.start()
+		self.timers.append(timer)
+		return timer
+
+	def truncate(self):
+		with self.lock:
+			open(self.filename, 'w').close()
+
+	def cancel(self):
+		for timer in self.timers:
+			timer.cancel()
+		self.timers = []
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, re, glob, time, zlib, threading
+import numpy as np
+from PIL import Image
+from console_log import ConsoleLogWatcher, FakeConsoleLog
+from screen_state import ScreenStateClassifier
+
+class FakeGame(object):
+	"""
+	Stands in for the game, to test the runner and the capture scheduler on a machine without the game or a desktop.
+
+	It executes console commands (also from cfg files with exec), writes the console log like the game does with -condebug,
+	and renders synthetic frames for its state: the main menu and welcome screen show the reference images the ScreenStateClassifier looks for,
+	and in-game frames depend on the map and the camera. After the camera changed, frames keep changing for render_time seconds.
+	"""
+
+	MENU_POSITION 		= (96, 460)
+	WELCOME_POSITION 	= (1517, 1006)
+	# Progress bar of the loading screen (left, top, right, bottom), relative to the bottom of the screen
+	LOADING_BAR 		= (0.25, -80, 0.5, -60)
+	LOADING_REFERENCE_MARGIN = 20
+
+	def __init__(self, game_base_dir, width=1920, height=1080, start_time=0.5, load_time=0.5, render_time=0.1, crash_after_maps=None):
+		"""
+		Contructor
+		"""
+		self.game_base_dir = game_base_dir
+		self.maps_dir = '{}tf/maps/'.format(game_base_dir)
+		self.cfg_dir = '{}tf/cfg/'.format(game_base_dir)
+		for directory in [self.maps_dir, self.cfg_dir]:
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+		self.console_log_filename = '{}tf/console.log'.format(game_base_dir)
+		self.console_log = FakeConsoleLog(self.console_log_filename)
+		self.width = width
+		self.height = height
+		self.start_time = start_time
+		self.load_time = load_time
+		self.render_time = render_time
+		# Simulate a crash of the game after loading this many maps
+		self.crash_after_maps = crash_after_maps
+		self.maps_loaded = 0
+		self.lock = threading.Lock()
+		self.running = False
+		self.state = ScreenStateClassifier.STATE_BLACK
+		self.map_name = None
+		self.camera = 0
+		self.view = {}
+		self.view_changed = 0.0
+		self.commands = []
+		self.references = {
+			ScreenStateClassifier.STATE_MENU : Image.open(os.path.join(ScreenStateClassifier.REFERENCE_DIR, 'menu_find_game.png')).convert('RGB'),
+			ScreenStateClassifier.STATE_WELCOME : Image.open(os.path.join(ScreenStateClassifier.REFERENCE_DIR, 'map_loaded_welcome_screen.png')).convert('RGB'),
+		}
+
+	def installMaps(self, map_names):
+		"""
+		Place (empty) map files in the maps directory.
+		"""
+		for map_name in map_names:
+			open('{}{}.bsp'.format(self.maps_dir, map_name), 'a').close()
+
+	def start(self, args=()):
+		"""
+		Start the game with launch options, '+command argument' options are executed once the game started.
+		"""
+		with self.lock:
+			self.running = True
+			self.state = ScreenStateClassifier.STATE_BLACK
+			self.map_name = None
+		launch_commands = ' '.join(args).split('+')[1:]
+		self.__later(self.start_time, self.__onStarted, (launch_commands,))
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+			self.state = ScreenStateClassifier.STATE_BLACK
+
+	def isRunning(self):
+		return self.running
+
+	def execute(self, line):
+		"""
+		Execute a console line, as if it was typed in the console.
+		"""
+		if not self.running:
+			return
+		self.console_log.write('] {}'.format(line))
+		self.__execute(line)
+
+	def click(self):
+		"""
+		Click the screen: continues from the welcome screen, and switches to the next spectator camera in-game.
+		"""
+		with self.lock:
+			if self.state == ScreenStateClassifier.STATE_WELCOME:
+				self.state = ScreenStateClassifier.STATE_IN_GAME
+			elif self.state == ScreenStateClassifier.STATE_IN_GAME:
+				self.camera += 1
+			self.view_changed = time.time()
+
+	def grab(self):
+		with self.lock:
+			state = self.state
+			view = (self.map_name, self.camera, tuple(sorted(self.view.items())))
+			rendering = time.time() - self.view_changed < self.render_time
+		if state == ScreenStateClassifier.STATE_BLACK:
+			return Image.new('RGB', (self.width, self.height), (0, 0, 0))
+		if state == ScreenStateClassifier.STATE_LOADING:
+			return self.__renderLoadingScreen()
+		frame = self.__render(zlib.crc32(repr(view).encode('utf-8')) & 0xffffffff, rendering)
+		if state in self.references:
+			position = FakeGame.MENU_POSITION if state == ScreenStateClassifier.STATE_MENU else FakeGame.WELCOME_POSITION
+			frame.paste(self.references[state], position)
+		return frame
+
+	def getLoadingReference(self):
+		"""
+		Returns (image, position) of the loading screen reference, the region around the progress bar.
+		"""
+		(left, top, right, bottom) = self.__getLoadingBar()
+		margin = FakeGame.LOADING_REFERENCE_MARGIN
+		region = (left - margin, top - margin, right + margin, bottom + margin)
+		return (self.__renderLoadingScreen().crop(region), (region[0], region[1]))
+
+	def __getLoadingBar(self):
+		(left, top, right, bottom) = FakeGame.LOADING_BAR
+		return (int(self.width * left), self.height + top, int(self.width * right), self.height + bottom)
+
+	def __renderLoadingScreen(self):
+		frame = Image.new('RGB', (self.width, self.height), (40, 40, 40))
+		frame.paste((200, 160, 60), self.__getLoadingBar())
+		return frame
+
+	def __render(self, seed, rendering):
+		rows = np.arange(self.height, dtype=np.int32).reshape(-1, 1)
+		columns = np.arange(self.width, dtype=np.int32).reshape(1, -1)
+		shift = int(time.time() * 1000) % 97 if rendering else 0
+		data = np.empty((self.height, self.width, 3), dtype=np.uint8)
+		(red, green, blue, scale) = (seed & 0xff, (seed >> 8) & 0xff, (seed >> 16) & 0xff, 1 + (seed >> 24) % 3)
+		data[:, :, 0] = (columns * scale + red + shift) % 256
+		data[:, :, 1] = (rows * scale + green) % 256
+		data[:, :, 2] = (((rows + shift) // 48 + columns // 48 + blue) % 2) * 200 + 40
+		return Image.fromarray(data, 'RGB')
+
+	def __onStarted(self, launch_commands):
+		if not self.running:
+			return
+		self.console_log.write('execing valve.rc')
+		with self.lock:
+			self.state = ScreenStateClassifier.STATE_MENU
+		for command in launch_commands:
+			self.__execute(command.strip())
+
+	def __execute(self, line):
+		for command in [command.strip() for command in line.split(';') if command.strip() != '']:
+			parts = command.split(None, 1)
+			(name, argument) = (parts[0], parts[1] if len(parts) > 1 else '')
+			self.commands.append(command)
+			if name == 'echo':
+				self.console_log.write(argument)
+			elif name == 'exec':
+				cfg_filename = '{}{}.cfg'.format(self.cfg_dir, argument)
+				if not os.path.exists(cfg_filename):
+					self.console_log.write("Couldn't exec {}".format(argument))
+					continue
+				with open(cfg_filename) as cfg_file:
+					for cfg_line in cfg_file.read().splitlines():
+						self.__execute(cfg_line)
+			elif name == 'map':
+				self.__loadMap(argument)
+			elif name in ['setang_exact', 'setpos_exact', 'cl_leveloverview', 'spectate', 'noclip']:
+				with self.lock:
+					self.view[name] = argument
+					self.view_changed = time.time()
+
+	def __loadMap(self, map_name):
+		if not os.path.exists('{}{}.bsp'.format(self.maps_dir, map_name)):
+			self.console_log.write('map load failed: {} not found or invalid'.format(map_name))
+			return
+		with self.lock:
+			self.state = ScreenStateClassifier.STATE_LOADING
+			self.map_name = map_name
+			self.camera = 0
+			self.view = {}
+		self.__later(self.load_time, self.__onMapLoaded, (map_name,))
+
+	def __onMapLoaded(self, map_name):
+		if not self.running or self.map_name != map_name:
+			return
+		self.maps_loaded += 1
+		if self.crash_after_maps is not None and self.maps_loaded > self.crash_after_maps:
+			print("[FakeGame] Crashing while loading {}.".format(map_name))
+			self.crash_after_maps = None
+			self.stop()
+			return
+		self.console_log.write('Redownloading all lightmaps')
+		with self.lock:
+			self.state = ScreenStateClassifier.STATE_WELCOME
+			self.view_changed = time.time()
+
+	def __later(self, delay, function, args):
+		timer = threading.Timer(delay, function, args)
+		timer.daemon = True
+		timer.start()
+
+class FakeGameCoordinator(object):
+	"""
+	Drives a FakeGame with the same interface as the GameCoordinator, so the runner can be used without the game.
+	Commands are sent through a generated cfg and confirmed through the console log, like the GameCoordinator does.
+	"""
+
+	def __init__(self, game, start_timeout=10, map_load_timeout=10, command_timeout=5, batch_config_name='gc_batch'):
+		"""
+		Contructor
+		"""
+		self.game = game
+		self.maps_dir = game.maps_dir
+		self.start_timeout = start_timeout
+		self.map_load_timeout = map_load_timeout
+		self.command_timeout = command_timeout
+		self.batch_config_name = batch_config_name
+		self.console_log = ConsoleLogWatcher(game.console_log_filename, poll_interval=0.01)
+		self.screen_classifier = ScreenStateClassifier()
+		for reference in self.screen_classifier.references:
+			if reference['state'] == ScreenStateClassifier.STATE_MENU:
+				reference['position'] = FakeGame.MENU_POSITION
+		(loading_reference, loading_position) = game.getLoadingReference()
+		self.screen_classifier.addReference(ScreenStateClassifier.STATE_LOADING, loading_reference, loading_position)
+		self.echo_counter = 0
+
+	def isTF2Running(self):
+		return self.game.isRunning()
+
+	def startupGame(self):
+		token = self.__getEchoToken()
+		self.console_log.mark()
+		self.game.start(['-condebug', '+echo', token])
+		if self.console_log.waitFor(['^{}$'.format(re.escape(token))], self.start_timeout) is None:
+			print("Game did not report it started within {} seconds.".format(self.start_timeout))
+
+	def killGame(self):
+		self.game.stop()
+
+	def getAllMapsInTFFolder(self):
+		return sorted([os.path.basename(filename)[:-len('.bsp')] for filename in glob.glob('{}*.bsp'.format(self.maps_dir))])
+
+	def getCaptureBackend(self):
+		return self.game
+
+	def getScreenState(self):
+		return self.screen_classifier.classify(self.game.grab())
+
+	def changeMap(self, map_name):
+		self.console_log.mark()
+		self.__sendCommands(['map {}'.format(map_name)], wait_for_echo=False)
+		if self.console_log.waitFor(ConsoleLogWatcher.MAP_LOADED_PATTERNS, self.map_load_timeout, ConsoleLogWatcher.MAP_FAILED_PATTERNS) is None:
+			print("Map {} did not load.".format(map_name))
+			return False
+		return True
+
+	def isMapLoaded(self):
+		if not self.game.isRunning():
+			return False
+		return self.getScreenState() in ScreenStateClassifier.LOADED_STATES
+
+	def clickScreen(self):
+		self.game.click()
+
+	def prepareMapForScreenshots(self, map_name):
+		# Go through the welcome screen
+		self.game.click()
+		self.__sendCommands(['sv_cheats 1', 'r_drawviewmodel 0', 'cl_drawhud 0', 'noclip', 'mat_picmip -1', 'r_lod 0', 'mat_fullbright 0'])
+
+	def prepareForSpectatorScreenshots(self):
+		self.__sendCommands(['spectate'])
+
+	def prepareForBoxScreenshots(self):
+		pass
+
+	def prepareForOverviewScreenshots(self):
+		self.__sendCommands(['fog_enable 0', 'fog_override 1', 'r_portalsopenall 1'])
+
+	def setCorrectOverview(self, pos, ypos, scale):
+		self.__sendCommands(['setpos_exact {} {} {}'.format(pos["x"], pos["y"], ypos), 'cl_leveloverview {}'.format(scale)])
+
+	def setAngles(self, setang_args):
+		self.__sendCommands(['setang_exact {}'.format(setang_args)])
+
+	def prepareMapForUnload(self, map_name):
+		self.__sendCommands(['cl_leveloverview 0', 'cl_drawhud 1', 'noclip'])
+
+	def __getEchoToken(self):
+		self.echo_counter += 1
+		return 'gc_sync_{}_{}'.format(os.getpid(), self.echo_counter)
+
+	def __sendCommands(self, cmds, wait_for_echo=True):
+		lines = list(cmds)
+		token = None
+		if wait_for_echo:
+			token = self.__getEchoToken()
+			lines.append('echo {}'.format(token))
+			self.console_log.mark()
+		with open('{}{}.cfg'.format(self.game.cfg_dir, self.batch_config_name), 'w') as cfg_file:
+			cfg_file.write('\n'.join(lines) + '\n')
+		self.game.execute('exec {}'.format(self.batch_config_name))
+		if token is not None and self.console_log.waitFor(['^{}$'.format(re.escape(token))], self.command_timeout) is None:
+			print("Game did not execute {} within {} seconds.".format(cmds, self.command_timeout))
+			return False
+		return True
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, json, mmap, zlib, hashlib
+from multiprocessing.pool import ThreadPool
+
+class FileFingerprinter(object):
+	"""
+	Computes file digests with large memory-mapped reads, hashing multiple files at once in a thread pool (hashlib and zlib release the GIL while hashing).
+
+	Digests are remembered per (path, size, mtime), and persisted to cache_filename when given, so unchanged files are not read again on the next run.
+	Supported digests:
+	- md5: the content hash used for the fileHash in the metadata.
+	- crc32: a much faster checksum, only meant for detecting changes.
+	"""
+
+	DIGEST_MD5 		= 'md5'
+	DIGEST_CRC32 	= 'crc32'
+
+	def __init__(self, cache_filename=None, workers=4, chunk_size=8*1024*1024):
+		"""
+		Contructor
+		"""
+		self.cache_filename = cache_filename
+		self.workers = workers
+		self.chunk_size = chunk_size
+		self.cache = {}
+		if cache_filename is not None and os.path.exists(cache_filename):
+			try:
+				with open(cache_filename) as data_file:
+					self.cache = json.load(data_file)
+			except ValueError:
+				print("Ignoring the corrupt fingerprint cache {}.".format(cache_filename))
+
+	def getDigest(self, filename, digest=DIGEST_MD5):
+		return self.getDigests([filename], digest)[filename]
+
+	def getDigests(self, filenames, digest=DIGEST_MD5):
+		"""
+		Returns a dict with the hex digest of every file, reading only the files that changed since they were last fingerprinted.
+		"""
+		digests = {}
+		stats = {}
+		to_hash = []
+		for filename in filenames:
+			stat = os.stat(filename)
+			stats[filename] = stat
+			entry = self.cache.get(os.path.abspath(filename))
+			if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and digest in entry:
+				digests[filename] = entry[digest]
+			else:
+				to_hash.append(filename)
+
+		if len(to_hash) > 0:
+			if self.workers > 1 and len(to_hash) > 1:
+				pool = ThreadPool(min(self.workers, len(to_hash)))
+				try:
+					results = pool.map(lambda filename: self.__hashFile(filename, digest), to_hash)
+				finally:
+					pool.close()
+					pool.join()
+			else:
+				results = [self.__hashFile(filename, digest) for filename in to_hash]
+
+			for (filename, file_digest) in zip(to_hash, results):
+				digests[filename] = file_digest
+				stat = stats[filename]
+				key = os.path.abspath(filename)
+				entry = self.cache.get(key)
+				if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+					entry = {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+					self.cache[key] = entry
+				entry[digest] = file_digest
+		return digests
+
+	def save(self):
+		"""
+		Persist the fingerprint cache, dropping entries of files that no longer exist.
+		"""
+		if self.cache_filename is None:
+			return
+		for key in list(self.cache):
+			if not os.path.exists(key):
+				del self.cache[key]
+		tmp_filename = '{}.tmp'.format(self.cache_filename)
+		with open(tmp_filename, 'w') as outfile:
+			json.dump(self.cache, outfile)
+		if os.path.exists(self.cache_filename):
+			os.remove(self.cache_filename)
+		os.rename(tmp_filename, self.cache_filename)
+
+	def __hashFile(self, filename, digest):
+		if digest == FileFingerprinter.DIGEST_MD5:
+			hash_md5 = hashlib.md5()
+			for chunk in self.__readChunks(filename):
+				hash_md5.update(chunk)
+			return hash_md5.hexdigest()
+		elif digest == FileFingerprinter.DIGEST_CRC32:
+			crc = 0
+			for chunk in self.__readChunks(filename):
+				crc = zlib.crc32(chunk, crc)
+			return '{:08x}'.format(crc & 0xffffffff)
+		raise Exception('Unknown digest {}.'.format(digest))
+
+	def __readChunks(self, filename):
+		with open(filename, 'rb') as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				# Empty files can not be memory-mapped
+				return
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				for offset in range(0, len(data), self.chunk_size):
+					yield data[offset:offset + self.chunk_size]
+			finally:
+				data.close()
@@ -6,6 +6,9 @@ import glob, gtk, re, wnck, gtk, os, pyautogui, psutil, subprocess
 from pyautogui import press, typewrite, hotkey, keyDown, keyUp
 import pyautogui
 import numpy as np
+from console_log import ConsoleLogWatcher
+from screen_state import ScreenStateClassifier
+import capture
 
 class FatalGameCoordinatorException(Exception):
 	pass
@@ -13,17 +16,51 @@ class FatalGameCoordinatorException(Exception):
 class GameCoordinator(object):
 	"""
 	GameCoordinator is a stateless utility object, which helps with communicting to the game.
+
+	The game is started with -condebug, which makes it write its console output to tf/console.log. Instead of sleeping a fixed amount of time,
+	we follow that log and continue as soon as the game reports the event we are waiting for (started, map loaded, commands executed), or give up after a timeout.
+	Set use_console_log to False to fall back to the fixed waits.
 	"""
 
-	def __init__(self, game_base_dir, default_game_start_wait=40, default_map_switch_wait=25):
+	MAP_LOADED_PATTERNS 	= ConsoleLogWatcher.MAP_LOADED_PATTERNS
+	MAP_FAILED_PATTERNS 	= ConsoleLogWatcher.MAP_FAILED_PATTERNS
+
+	def __init__(self, game_base_dir, default_game_start_wait=40, default_map_switch_wait=25, usr_steam_exec='/usr/bin/steam', screenshots_storage_dir=None,
+				 use_console_log=True, console_log_filename=None, game_start_timeout=180, map_load_timeout=120, command_timeout=10, console_key_delay=0.2,
+				 map_loaded_patterns=MAP_LOADED_PATTERNS, map_failed_patterns=MAP_FAILED_PATTERNS, batch_commands=True, batch_config_name='gc_batch', capture_backend=None, screen_classifier=None):
 		"""
 		Contructor
 		"""
 		self.game_p = None
 		self.game_base_dir = game_base_dir
 		self.maps_dir = '{}tf/maps/'.format(game_base_dir)
+		self.cfg_dir = '{}tf/cfg/'.format(game_base_dir)
+		self.usr_steam_exec = usr_steam_exec
+		self.screenshots_storage_dir = screenshots_storage_dir
 		self.default_game_start_wait = default_game_start_wait
 		self.default_map_switch_wait = default_map_switch_wait
+		self.use_console_log = use_console_log
+		if console_log_filename is None:
+			console_log_filename = '{}tf/console.log'.format(game_base_dir)
+		self.console_log = ConsoleLogWatcher(console_log_filename) if use_console_log else None
+		self.game_start_timeout = game_start_timeout
+		self.map_load_timeout = map_load_timeout
+		self.command_timeout = command_timeout
+		# Time for the console to open or close, before we can type in it
+		self.console_key_delay = console_key_delay
+		self.map_loaded_patterns = map_loaded_patterns
+		self.map_failed_patterns = map_failed_patterns
+		self.echo_counter = 0
+		# Write command groups to a generated cfg and type a single exec, instead of typing every command
+		self.batch_commands = batch_commands
+		self.batch_config_name = batch_config_name
+		# Recognises the main menu and welcome screen in a small region of a captured frame
+		self.capture_backend = capture_backend
+		self.screen_classifier = screen_classifier if screen_classifier is not None else ScreenStateClassifier()
+
+	def __getEchoToken(self):
+		self.echo_counter += 1
+		return 'gc_sync_{}_{}'.format(os.getpid(), self.echo_counter)
 
 	def isTF2Running(self):
 		return "hl2_linux" in (p.name() for p in psutil.process_iter())
@@ -36,19 +73,31 @@ class GameCoordinator(object):
 	def startupGame(self):
 		# Open up TF2
 		if self.isTF2Running() == True:
-			raise FatalGameMapRunnerException("Team Fortress 2 is currently running.")
+			raise FatalGameCoordinatorException("Team Fortress 2 is currently running.")
 		print("Attempting to start game ...")
-		self.game_p = subprocess.Popen([self.usr_steam_exec,'-applaunch', '440', 
-										   '-nosound',
-										   '-novid'
-										   ],
+		args = [self.usr_steam_exec,'-applaunch', '440', 
+				'-nosound',
+				'-novid'
+				]
+		if self.use_console_log:
+			# Log the console to a file, and echo a token once the game executed its startup configs
+			token = self.__getEchoToken()
+			args += ['-condebug', '+echo', token]
+			self.console_log.mark()
+		self.game_p = subprocess.Popen(args,
 									stdin=subprocess.PIPE,
 									stdout=subprocess.PIPE,
 									stderr=subprocess.PIPE)
-		time.sleep(self.default_game_start_wait)
-		# Click the wait button for GNOME process freeze
-		self.clickGNOMEWaitProcess()
-		time.sleep(15)
+		if self.use_console_log:
+			if self.console_log.waitFor([re.escape(token)], self.game_start_timeout) is None:
+				print("Game did not report it started within {} seconds.".format(self.game_start_timeout))
+			# Click the wait button for GNOME process freeze
+			self.clickGNOMEWaitProcess()
+		else:
+			time.sleep(self.default_game_start_wait)
+			# Click the wait button for GNOME process freeze
+			self.clickGNOMEWaitProcess()
+			time.sleep(15)
 		if self.isTF2Running():
 			print("Game is now started.")
 		else:
@@ -62,14 +111,32 @@ class GameCoordinator(object):
 			if titlePattern.match(w.get_name()):
 				print("Activated window, waiting for input ...")
 				w.activate(gtk.gdk.x11_get_server_time(gtk.gdk.get_default_root_window()))
+		# The game shows the main menu now, locate its reference once when its position is not known yet
+		self.__calibrateScreenState(ScreenStateClassifier.STATE_MENU)
 		return
 
+	def getCaptureBackend(self):
+		if self.capture_backend is None:
+			self.capture_backend = capture.ScreenCaptureBackend()
+		return self.capture_backend
+
+	def getScreenState(self):
+		return self.screen_classifier.classify(self.getCaptureBackend().grab())
+
+	def __calibrateScreenState(self, state):
+		for reference in self.screen_classifier.references:
+			if reference['state'] == state and reference['position'] is None:
+				self.screen_classifier.calibrate(self.getCaptureBackend().grab(), state)
+
 	def killGame(self):
 		print("Attempting to kill the game ...")
 		for proc in psutil.process_iter():
 			if 'hl2_linux' in proc.name() :
 				proc.kill()
-				time.sleep(5)
+				try:
+					proc.wait(timeout=5)
+				except psutil.TimeoutExpired:
+					print("Game did not exit within 5 seconds.")
 				return
 
 	def getAllMapsInTFFolder(self):
@@ -83,44 +150,96 @@ class GameCoordinator(object):
 
 	def getNotProcessedMapsInTFFolder(self):
 		filtered_maps = []
-		maps = getAllMapsInFolder()
+		maps = self.getAllMapsInTFFolder()
 		folders = [name for name in os.listdir(self.screenshots_storage_dir) if os.path.isdir("{}/{}".format(self.screenshots_storage_dir, name))]
 		for map_name in maps:
 			if map_name not in folders:
 				filtered_maps.append(map_name)
 		return filtered_maps
 
-	def __sendCommand(cmd):
+	def __sendCommand(self, cmd):
 		typewrite("{}\n".format(cmd))
-		time.sleep(0.5)
+		if not self.use_console_log:
+			time.sleep(0.5)
 
-	def __openConsoleAndCmd(self, cmds):
-		time.sleep(0.5)
+	def __writeBatchConfig(self, cmds):
+		"""
+		Writes the commands to a cfg in the games cfg directory, returns the command that executes it.
+		"""
+		with open('{}{}.cfg'.format(self.cfg_dir, self.batch_config_name), 'w') as cfg_file:
+			cfg_file.write('\n'.join(cmds) + '\n')
+		return 'exec {}'.format(self.batch_config_name)
+
+	def __openConsoleAndCmd(self, cmds, wait_for_echo=True):
+		"""
+		Sends the commands through the console. With the console log, the commands are followed by an echo of a token,
+		which the game prints after it executed all commands before it.
+		With batch_commands, the commands are written to a cfg and only a single exec line is typed.
+		"""
+		lines = list(cmds)
+		token = None
+		if self.use_console_log and wait_for_echo:
+			token = self.__getEchoToken()
+			lines.append('echo {}'.format(token))
+		if self.batch_commands:
+			lines = [self.__writeBatchConfig(lines)]
+		if not self.use_console_log:
+			time.sleep(0.5)
+			press('`')
+			time.sleep(1)
+			for line in lines:
+				self.__sendCommand(line)
+			press('`')
+			time.sleep(0.5)
+			return True
+		executed = True
 		press('`')
-		time.sleep(1)
-		for cmd in cmds:
-			self.__sendCommand(cmd)
+		time.sleep(self.console_key_delay)
+		if token is not None:
+			self.console_log.mark()
+		for line in lines:
+			self.__sendCommand(line)
+		if token is not None:
+			if self.console_log.waitFor(['^{}$'.format(re.escape(token))], self.command_timeout) is None:
+				print("Game did not execute {} within {} seconds.".format(cmds, self.command_timeout))
+				executed = False
 		press('`')
-		time.sleep(0.5)
+		time.sleep(self.console_key_delay)
+		return executed
 
 	def changeMap(self, map_name):
-		self.__openConsoleAndCmd(['map {}'.format(map_name)])
-		time.sleep(self.default_map_switch_wait)
-		print("Loaded map {}".format(map_name))
-		return
+		"""
+		Loads the map, returns False when the game reported the map could not be loaded, or it did not finish loading in time.
+		"""
+		if not self.use_console_log:
+			self.__openConsoleAndCmd(['map {}'.format(map_name)])
+			self.__calibrateScreenState(ScreenStateClassifier.STATE_LOADING)
+			time.sleep(self.default_map_switch_wait)
+			print("Loaded map {}".format(map_name))
+			return True
+		self.console_log.mark()
+		self.__openConsoleAndCmd(['map {}'.format(map_name)], wait_for_echo=False)
+		start = time.time()
+		# The game shows the loading screen now, locate its reference once when its position is not known yet
+		self.__calibrateScreenState(ScreenStateClassifier.STATE_LOADING)
+		if self.console_log.waitFor(self.map_loaded_patterns, self.map_load_timeout, self.map_failed_patterns) is None:
+			print("Map {} did not load.".format(map_name))
+			return False
+		print("Loaded map {} ({:.1f}s)".format(map_name, time.time() - start))
+		return True
 
-	def clickScreen():
+	def clickScreen(self):
 		pyautogui.click(x=1233, y=669)
 
 	def isMapLoaded(self):
 		if self.isTF2Running() == False:
 			return False
-		# check with an image if we're not in the game menu yet
-		menu_check = pyautogui.locateOnScreen('menu_find_game.png')
-		if menu_check == None:
+		# check a small region of the screen, to see if we're not in the game menu (or loading) anymore
+		state = self.getScreenState()
+		if state in ScreenStateClassifier.LOADED_STATES:
 			return True
-		else:
-			return False
+		print("Map is not loaded, the game shows the {} screen.".format(state))
+		return False
 	
 	def prepareMapForScreenshots(self,  map_name):
 		# Go through welcome screen
@@ -130,7 +249,7 @@ class GameCoordinator(object):
 				pyautogui.click(x=1651, y=1025)
 				time.sleep(0.5)
 			press('1')
-			openConsoleAndCmd(['spectate'])
+			self.__openConsoleAndCmd(['spectate'])
 			self.clickScreen()
 		else:
 			for x in range(0,4):
@@ -159,6 +278,9 @@ class GameCoordinator(object):
 	def setCorrectOverview(self, pos, ypos, scale):
 		self.__openConsoleAndCmd(['setpos_exact {} {} {}'.format(pos["x"], pos["y"], ypos), 'cl_leveloverview {}'.format(scale)])
 
+	def setAngles(self, setang_args):
+		self.__openConsoleAndCmd(['setang_exact {}'.format(setang_args)])
+
 	def prepareMapForUnload(self, map_name):
 		self.__openConsoleAndCmd(['cl_leveloverview 0', 'cl_drawhud 1', 'noclip'])
 
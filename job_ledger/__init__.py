@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import time, sqlite3, threading
+
+class JobLedger(object):
+	"""
+	Persistent record (SQLite) of the state of every map and every task per map, so a capture run can be resumed where it stopped.
+
+	Maps are handed out by priority (highest first). A failed map is retried after a backoff that doubles with every attempt, until max_attempts.
+	Maps and tasks that were still running when the previous run stopped are pending again once the ledger is opened (with recover).
+	The ledger can be used from multiple threads (e.g. post-processing callbacks), and from multiple processes:
+	with multiple game instances every instance claims maps from its own shard, and steals from the largest other shard when its own is empty.
+	"""
+
+	STATE_PENDING 	= 'pending'
+	STATE_RUNNING 	= 'running'
+	STATE_DONE 		= 'done'
+	STATE_FAILED 	= 'failed'
+	STATE_SKIPPED 	= 'skipped'
+
+	TASK_SPECTATOR 		= 'spectator'
+	TASK_OVERVIEW 		= 'overview'
+	TASK_360 			= '360'
+	TASK_POST_PROCESS 	= 'post-process'
+
+	def __init__(self, filename, max_attempts=3, backoff=60, max_backoff=3600, recover=True):
+		"""
+		Contructor
+		"""
+		self.filename = filename
+		self.max_attempts = max_attempts
+		# Seconds to wait before the first retry of a failed map
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.lock = threading.Lock()
+		# Wait for the other processes, instead of failing when the database is locked
+		self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+		with self.lock:
+			self.connection.executescript("""
+				CREATE TABLE IF NOT EXISTS maps (
+					map_name TEXT PRIMARY KEY,
+					priority INTEGER NOT NULL DEFAULT 0,
+					state TEXT NOT NULL,
+					attempts INTEGER NOT NULL DEFAULT 0,
+					error TEXT,
+					next_attempt REAL NOT NULL DEFAULT 0,
+					started REAL,
+					finished REAL,
+					shard TEXT,
+					owner TEXT
+				);
+				CREATE TABLE IF NOT EXISTS tasks (
+					map_name TEXT NOT NULL,
+					task TEXT NOT NULL,
+					state TEXT NOT NULL,
+					attempts INTEGER NOT NULL DEFAULT 0,
+					seconds REAL,
+					error TEXT,
+					updated REAL,
+					PRIMARY KEY (map_name, task)
+				);
+				CREATE TABLE IF NOT EXISTS instances (
+					name TEXT PRIMARY KEY,
+					pid INTEGER,
+					heartbeat REAL
+				);
+			""")
+			# Ledgers of earlier versions have no shards
+			columns = [row[1] for row in self.connection.execute("PRAGMA table_info(maps)")]
+			for column in ['shard', 'owner']:
+				if column not in columns:
+					self.connection.execute("ALTER TABLE maps ADD COLUMN {} TEXT".format(column))
+			self.connection.execute("CREATE INDEX IF NOT EXISTS maps_queue ON maps (state, priority)")
+			if recover == True:
+				# Anything still running was interrupted
+				self.connection.execute("UPDATE maps SET state = ?, next_attempt = 0, owner = NULL WHERE state = ?", (JobLedger.STATE_PENDING, JobLedger.STATE_RUNNING))
+				self.connection.execute("UPDATE tasks SET state = ? WHERE state = ?", (JobLedger.STATE_PENDING, JobLedger.STATE_RUNNING))
+			self.connection.commit()
+
+	def addMaps(self, map_names, priorities=None):
+		"""
+		Add maps that are not in the ledger yet, and update the priority of the given maps (map name => priority, higher goes first).
+		"""
+		if priorities is None:
+			priorities = {}
+		with self.lock:
+			for map_name in map_names:
+				self.connection.execute("INSERT OR IGNORE INTO maps (map_name, priority, state) VALUES (?, ?, ?)", (map_name, priorities.get(map_name, 0), JobLedger.STATE_PENDING))
+				if map_name in priorities:
+					self.connection.execute("UPDATE maps SET priority = ? WHERE map_name = ?", (priorities[map_name], map_name))
+			self.connection.commit()
+
+	def getNextMap(self):
+		"""
+		Returns the pending or failed map with the highest priority that may be (re)tried now, or None.
+		"""
+		with self.lock:
+			row = self.connection.execute("""
+				SELECT map_name FROM maps
+				WHERE (state = ? OR (state = ? AND attempts < ?)) AND next_attempt <= ?
+				ORDER BY priority DESC, map_name LIMIT 1
+			""", (JobLedger.STATE_PENDING, JobLedger.STATE_FAILED, self.max_attempts, time.time())).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def assignShards(self, instance_names):
+		"""
+		Divide the maps that still have to be processed over the instances, alternating in order of priority.
+		"""
+		with self.lock:
+			rows = self.connection.execute("SELECT map_name FROM maps WHERE state IN (?, ?) ORDER BY priority DESC, map_name", (JobLedger.STATE_PENDING, JobLedger.STATE_FAILED)).fetchall()
+			for (i, row) in enumerate(rows):
+				self.connection.execute("UPDATE maps SET shard = ? WHERE map_name = ?", (instance_names[i % len(instance_names)], row[0]))
+			self.connection.commit()
+
+	def claimNextMap(self, instance_name):
+		"""
+		Start the next map of the instances shard, or steal one from the shard with the most maps left. Returns None when no map may be (re)tried now.
+		"""
+		claimable = "(state = ? OR (state = ? AND attempts < ?)) AND next_attempt <= ?"
+		with self.lock:
+			# Claim atomically, other instances use the same database
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				parameters = (JobLedger.STATE_PENDING, JobLedger.STATE_FAILED, self.max_attempts, time.time())
+				row = self.connection.execute("SELECT map_name FROM maps WHERE shard = ? AND " + claimable + " ORDER BY priority DESC, map_name LIMIT 1", (instance_name,) + parameters).fetchone()
+				if row is None:
+					row = self.connection.execute("""
+						SELECT map_name FROM maps WHERE """ + claimable + """
+						ORDER BY (SELECT COUNT(*) FROM maps AS shard_maps WHERE shard_maps.shard IS maps.shard AND shard_maps.state = ?) DESC, priority DESC, map_name LIMIT 1
+					""", parameters + (JobLedger.STATE_PENDING,)).fetchone()
+					if row is not None:
+						print("Instance '{}' takes over map '{}'.".format(instance_name, row[0]))
+				if row is not None:
+					self.connection.execute("UPDATE maps SET state = ?, owner = ?, attempts = attempts + 1, error = NULL, started = ?, finished = NULL WHERE map_name = ?", (JobLedger.STATE_RUNNING, instance_name, time.time(), row[0]))
+				self.connection.commit()
+			except Exception:
+				self.connection.rollback()
+				raise
+		if row is None:
+			return None
+		return row[0]
+
+	def releaseMaps(self, instance_name):
+		"""
+		Make the maps an instance was working on pending again, e.g. when the instance crashed.
+		"""
+		with self.lock:
+			rows = self.connection.execute("SELECT map_name FROM maps WHERE owner = ? AND state = ?", (instance_name, JobLedger.STATE_RUNNING)).fetchall()
+			for row in rows:
+				self.connection.execute("UPDATE tasks SET state = ? WHERE map_name = ? AND state = ?", (JobLedger.STATE_PENDING, row[0], JobLedger.STATE_RUNNING))
+			self.connection.execute("UPDATE maps SET state = ?, owner = NULL, next_attempt = 0 WHERE owner = ? AND state = ?", (JobLedger.STATE_PENDING, instance_name, JobLedger.STATE_RUNNING))
+			self.connection.commit()
+		return [row[0] for row in rows]
+
+	def heartbeat(self, instance_name, pid=None):
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO instances (name, pid, heartbeat) VALUES (?, ?, ?)", (instance_name, pid, time.time()))
+			self.connection.commit()
+
+	def getHeartbeat(self, instance_name):
+		"""
+		Returns the time of the last heartbeat of the instance, or None.
+		"""
+		with self.lock:
+			row = self.connection.execute("SELECT heartbeat FROM instances WHERE name = ?", (instance_name,)).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def getSecondsUntilRetry(self):
+		"""
+		Returns how long until the next map may be (re)tried, or None when no map is waiting for that.
+		"""
+		with self.lock:
+			row = self.connection.execute("SELECT MIN(next_attempt) FROM maps WHERE state = ? OR (state = ? AND attempts < ?)", (JobLedger.STATE_PENDING, JobLedger.STATE_FAILED, self.max_attempts)).fetchone()
+		if row is None or row[0] is None:
+			return None
+		return max(0.0, row[0] - time.time())
+
+	def startMap(self, map_name):
+		with self.lock:
+			self.connection.execute("UPDATE maps SET state = ?, attempts = attempts + 1, error = NULL, started = ?, finished = NULL WHERE map_name = ?", (JobLedger.STATE_RUNNING, time.time(), map_name))
+			self.connection.commit()
+
+	def finishMap(self, map_name):
+		self.__setMapState(map_name, JobLedger.STATE_DONE)
+
+	def failMap(self, map_name, error):
+		"""
+		Mark the map as failed, it is retried after the backoff (unless it failed max_attempts times).
+		"""
+		with self.lock:
+			row = self.connection.execute("SELECT attempts FROM maps WHERE map_name = ?", (map_name,)).fetchone()
+			attempts = row[0] if row is not None else 1
+			backoff = min(self.max_backoff, self.backoff * 2 ** max(0, attempts - 1))
+			self.connection.execute("UPDATE maps SET state = ?, error = ?, next_attempt = ?, finished = ? WHERE map_name = ?", (JobLedger.STATE_FAILED, error, time.time() + backoff, time.time(), map_name))
+			self.connection.commit()
+		if attempts < self.max_attempts:
+			print("Map '{}' failed ({}), retrying in {} seconds.".format(map_name, error, backoff))
+		else:
+			print("Map '{}' failed ({}), giving up after {} attempt(s).".format(map_name, error, attempts))
+
+	def skipMap(self, map_name, reason):
+		"""
+		Mark the map as not processable, it is not retried.
+		"""
+		self.__setMapState(map_name, JobLedger.STATE_SKIPPED, reason)
+
+	def getMapState(self, map_name):
+		with self.lock:
+			row = self.connection.execute("SELECT state FROM maps WHERE map_name = ?", (map_name,)).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def isTaskDone(self, map_name, task):
+		return self.getTaskState(map_name, task) == JobLedger.STATE_DONE
+
+	def getTaskState(self, map_name, task):
+		with self.lock:
+			row = self.connection.execute("SELECT state FROM tasks WHERE map_name = ? AND task = ?", (map_name, task)).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def startTask(self, map_name, task):
+		with self.lock:
+			self.connection.execute("INSERT OR IGNORE INTO tasks (map_name, task, state) VALUES (?, ?, ?)", (map_name, task, JobLedger.STATE_PENDING))
+			self.connection.execute("UPDATE tasks SET state = ?, attempts = attempts + 1, error = NULL, seconds = NULL, updated = ? WHERE map_name = ? AND task = ?", (JobLedger.STATE_RUNNING, time.time(), map_name, task))
+			self.connection.commit()
+
+	def finishTask(self, map_name, task, seconds=None):
+		self.__setTaskState(map_name, task, JobLedger.STATE_DONE, seconds=seconds)
+
+	def failTask(self, map_name, task, error, seconds=None):
+		self.__setTaskState(map_name, task, JobLedger.STATE_FAILED, error, seconds)
+
+	def resetTasks(self, map_name, tasks):
+		"""
+		Mark finished tasks as pending again, e.g. captures whose post-processing did not finish.
+		"""
+		with self.lock:
+			for task in tasks:
+				self.connection.execute("UPDATE tasks SET state = ? WHERE map_name = ? AND task = ?", (JobLedger.STATE_PENDING, map_name, task))
+			self.connection.commit()
+
+	def getSummary(self):
+		"""
+		Returns the number of maps per state.
+		"""
+		with self.lock:
+			rows = self.connection.execute("SELECT state, COUNT(*) FROM maps GROUP BY state").fetchall()
+		return dict(rows)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	def __setMapState(self, map_name, state, error=None):
+		with self.lock:
+			self.connection.execute("UPDATE maps SET state = ?, error = ?, finished = ? WHERE map_name = ?", (state, error, time.time(), map_name))
+			self.connection.commit()
+
+	def __setTaskState(self, map_name, task, state, error=None, seconds=None):
+		with self.lock:
+			self.connection.execute("INSERT OR IGNORE INTO tasks (map_name, task, state) VALUES (?, ?, ?)", (map_name, task, JobLedger.STATE_PENDING))
+			self.connection.execute("UPDATE tasks SET state = ?, error = ?, seconds = ?, updated = ? WHERE map_name = ? AND task = ?", (state, error, seconds, time.time(), map_name, task))
+			self.connection.commit()
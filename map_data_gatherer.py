@@ -3,158 +3,285 @@
 import time
 import json
 import glob, re, os, subprocess
-import hashlib
+import multiprocessing, traceback
+import numpy as np
 from vmf_parser import VMFParser
+from vmf_parser.entity import Entity
+from metadata_cache import MetadataCache
+from metadata_store import MetadataWriter
+from bsp_decompiler import BSPDecompiler
+from bsp_reader import BSPReader
+from fingerprint import FileFingerprinter
 from process.functions import MapStatsCoordinator
+from shot_planner import ShotPlanner
 
 class MapDataGatherer(object):
 	"""
 	MapDataGatherer is a stateless utility object, which provides metadata from .bsp files. This metadata can be used for the automation of camera angles in-game for TF2 or other Source Engine games.
 	
-	Currently only Windows compatible, but should work on Linux with a few minor adjustments. Not multithreading compatible.
+	Currently only Windows compatible, but should work on Linux with a few minor adjustments. Not multithreading compatible, use the workers argument of gatherMetadataFromBSPDir to process maps in parallel processes instead.
 
-	Required installs:
+	Required installs (not needed for the BSP backend, which reads the entities straight from the .bsp):
 	- Java
 	- BSPSource (the jar must be placed in the same dir)
 	"""
 
-	def __init__(self, java_exec=''):
+	# Bump whenever the extracted metadata changes, this invalidates the metadata cache.
+	METADATA_VERSION = 4
+
+	# Partial class and model names that are looked up in the entity index, see __buildEntityIndex.
+	INDEXED_PARTIAL_CLASS_NAMES = ('item_healthkit', 'item_ammopack', 'team_control_point', 'item_teamflag', 'info_player_teamspawn')
+	INDEXED_PARTIAL_MODEL_NAMES = ('competitive_stage', 'halloween', 'resupply_locker')
+
+	# Input backends: decompile to VMF with BSPSource, or read the entity lump of the .bsp directly.
+	BACKEND_VMF 	= 'vmf'
+	BACKEND_BSP 	= 'bsp'
+
+	def __init__(self, java_exec='', decompile_workers=2, decompile_batch_size=8, backend=BACKEND_VMF, compact_entities=False, fingerprint_cache_filename=None, hash_workers=4, shot_planner=None):
 		"""
 		Contructor
 		"""
+		if backend not in (MapDataGatherer.BACKEND_VMF, MapDataGatherer.BACKEND_BSP):
+			raise Exception('Unknown backend {}.'.format(backend))
 		self.java_exec = java_exec
-		self.vmf_parser = VMFParser()
+		self.backend = backend
+		self.bsp_decompiler = BSPDecompiler(java_exec, workers=decompile_workers, batch_size=decompile_batch_size)
+		# Compact entities take less memory and have their origins parsed already, see vmf_parser.entity.Entity
+		self.vmf_parser = VMFParser(compact_entities=compact_entities)
+		self.bsp_reader = BSPReader(compact_entities=compact_entities)
 		self.map_stats_coordinator = MapStatsCoordinator()
+		# Remembers the hashes of unchanged .bsp files between runs when given a cache filename
+		self.fingerprinter = FileFingerprinter(fingerprint_cache_filename, workers=hash_workers)
+		# Decides which spectator cameras are captured, see ShotPlanner
+		self.shot_planner = shot_planner if shot_planner is not None else ShotPlanner()
 		
 
-	def gatherMetadataFromBSPDir(self, maps_dir='.', metadata_output_filename='output.json', scale_optimizer=(1920, 1080)):
+	def gatherMetadataFromBSPDir(self, maps_dir='.', metadata_output_filename='output.json', scale_optimizer=(1920, 1080), dimensions_method='solids', workers=1, cache_dir=None, output_format=MetadataWriter.FORMAT_JSON):
 		"""
 		Analyze all .bsp files in the given directory, by decompiling them and storing the valueable metadata in our ./metadata/ folder.
+		With workers > 1 the maps are parsed in a pool of worker processes. Results are written in map name order, maps that fail are reported and skipped.
+		The BSP backend has no brush geometry, the 'solids' dimensions method falls back on the entities there.
+		With a cache_dir, metadata of .bsp files that were processed before (same file hash, same METADATA_VERSION and options) is reused instead of decompiling and parsing the map again.
+		With the jsonl or shards output_format every map is written to disk as soon as it is processed, see MetadataWriter.
 		"""
-		self.__generateVMFFilesFromBSPs(maps_dir)
-		maps = self.__getAllMapsInFolder(maps_dir)
-		maps_metadata = {}
+		maps = sorted(self.__getAllMapsInFolder(maps_dir))
+		failed_maps = []
 
-		i = 0
+		cache = None
+		cache_options = {'scaleOptimizer' : list(scale_optimizer), 'dimensionsMethod' : dimensions_method, 'backend' : self.backend, 'shotPlanner' : self.shot_planner.getOptions()}
+		if cache_dir is not None:
+			cache = MetadataCache(cache_dir, MapDataGatherer.METADATA_VERSION)
+
+		file_hashes = self.__getHashesForMaps(maps_dir, maps)
+		cached_maps = set()
 		for map_name in maps:
-			print("Processing map {} ({}/{})".format(map_name, i, len(maps)))
-			i += 1
-			vmf_obj = self.__getVMFObj(maps_dir, map_name)
-			# Construct the metadata object.
-			maps_metadata[map_name] = {}
-			maps_metadata[map_name]["normalizedMapName"] 		= self.map_stats_coordinator.helperNormalizeMapName(map_name)
-			maps_metadata[map_name]["dimensions"] 				= self.__getDimensionsOfMap(vmf_obj, scale_optimizer, method='entities')
-			maps_metadata[map_name]["cameras"] 					= self.__getCameras(vmf_obj)
-			maps_metadata[map_name]["skyboxCamera"] 			= self.__getEntityCoordsByClassName(vmf_obj, 'sky_camera')
-			maps_metadata[map_name]["tournamentStage"] 			= self.__getEntityCoordsByModelname(vmf_obj, 'competitive_stage')
-			maps_metadata[map_name]["version"] 					= self.__getMapVersion(vmf_obj)
-			maps_metadata[map_name]["entityCount"] 				= self.__getEntityCount(vmf_obj)
-			maps_metadata[map_name]["healthKits"] 				= self.__getHealthKits(vmf_obj)
-			maps_metadata[map_name]["ammoPacks"] 				= self.__getAmmoPacks(vmf_obj)
-			maps_metadata[map_name]["controlPoints"] 			= self.__getControlPoints(vmf_obj)
-			maps_metadata[map_name]["briefCases"] 				= self.__getBriefCases(vmf_obj)
-			maps_metadata[map_name]["spawnPoints"] 				= self.__getSpawnPoints(vmf_obj)
-			maps_metadata[map_name]["resupplyLockers"] 			= self.__getResupplyLockers(vmf_obj)
-			maps_metadata[map_name]["containsHalloweenProps"] 	= self.__containsHalloweenProps(vmf_obj)
-			maps_metadata[map_name]["fileHash"] 				= self.__getHashForMap(maps_dir, map_name)
-
-
-		self.__saveMetadataToDisk(maps_metadata, metadata_output_filename)
+			if cache is not None and cache.contains(file_hashes[map_name], cache_options):
+				cached_maps.add(map_name)
+		maps_to_process = [map_name for map_name in maps if map_name not in cached_maps]
+		print("Reusing cached metadata for {} map(s), {} map(s) to process.".format(len(cached_maps), len(maps_to_process)))
+
+		decompile_errors = {}
+		if len(maps_to_process) > 0 and self.backend == MapDataGatherer.BACKEND_VMF:
+			decompile_errors = self.__generateVMFFilesFromBSPs(maps_dir, maps_to_process)
+
+		jobs = [(maps_dir, map_name, scale_optimizer, dimensions_method, file_hashes[map_name]) for map_name in maps_to_process if map_name not in decompile_errors]
+		pool = None
+		if workers > 1 and len(jobs) > 1:
+			pool = multiprocessing.Pool(workers, _initMetadataWorker, (self,))
+			results = pool.imap(_gatherMetadataForMapWorker, jobs)
+		else:
+			results = (_gatherMetadataForMapJob(self, job) for job in jobs)
+
+		writer = MetadataWriter('.{}metadata{}{}'.format(os.sep, os.sep, metadata_output_filename), output_format)
+		i = 0
+		try:
+			# Both the cached maps and the results are in map name order
+			for map_name in maps:
+				if map_name in decompile_errors:
+					failed_maps.append(map_name)
+					continue
+				if map_name in cached_maps:
+					metadata = cache.get(file_hashes[map_name], cache_options)
+					if metadata is None:
+						print("Cached metadata for map {} disappeared, skipping it.".format(map_name))
+						failed_maps.append(map_name)
+						continue
+					# The same .bsp might be stored under a different name
+					metadata["normalizedMapName"] = self.map_stats_coordinator.helperNormalizeMapName(map_name)
+				else:
+					(map_name, metadata, error) = next(results)
+					i += 1
+					if error is not None:
+						print("Failed processing map {} ({}/{}):\n{}".format(map_name, i, len(jobs), error))
+						failed_maps.append(map_name)
+						continue
+					print("Processed map {} ({}/{})".format(map_name, i, len(jobs)))
+					if cache is not None:
+						cache.put(file_hashes[map_name], metadata, cache_options)
+				writer.write(map_name, metadata)
+		finally:
+			writer.close()
+			if pool is not None:
+				pool.close()
+				pool.join()
+
+		if cache is not None:
+			cache.evict()
+		if len(failed_maps) > 0:
+			print("Failed to extract metadata for {} map(s): {}".format(len(failed_maps), ', '.join(failed_maps)))
 		print("Completed the metadata extraction for folder {}".format(maps_dir))
 
-	def __generateVMFFilesFromBSPs(self, maps_dir):
+	def gatherMetadataForMap(self, maps_dir, map_name, scale_optimizer=(1920, 1080), dimensions_method='solids', file_hash=None):
+		"""
+		Construct the metadata object of a single map, of which the VMF file has already been generated.
+		"""
+		vmf_obj = self.__getMapObj(maps_dir, map_name, dimensions_method)
+		entity_index = self.__buildEntityIndex(vmf_obj)
+		metadata = {}
+		metadata["normalizedMapName"] 		= self.map_stats_coordinator.helperNormalizeMapName(map_name)
+		metadata["dimensions"] 				= self.__getDimensionsOfMap(vmf_obj, entity_index, scale_optimizer, method=dimensions_method)
+		metadata["cameras"] 				= self.__getCameras(entity_index)
+		metadata["skyboxCamera"] 			= self.__getEntityCoordsByClassName(entity_index, 'sky_camera')
+		metadata["tournamentStage"] 		= self.__getEntityCoordsByModelname(entity_index, 'competitive_stage')
+		metadata["version"] 				= self.__getMapVersion(vmf_obj)
+		metadata["entityCount"] 			= self.__getEntityCount(vmf_obj)
+		metadata["healthKits"] 				= self.__getHealthKits(entity_index)
+		metadata["ammoPacks"] 				= self.__getAmmoPacks(entity_index)
+		metadata["controlPoints"] 			= self.__getControlPoints(entity_index)
+		metadata["briefCases"] 				= self.__getBriefCases(entity_index)
+		metadata["spawnPoints"] 			= self.__getSpawnPoints(entity_index)
+		metadata["resupplyLockers"] 		= self.__getResupplyLockers(entity_index)
+		metadata["containsHalloweenProps"] 	= self.__containsHalloweenProps(entity_index)
+		metadata["fileHash"] 				= file_hash if file_hash is not None else self.__getHashForMap(maps_dir, map_name)
+		for key in metadata:
+			if type(metadata[key]) is list:
+				metadata[key] = [entity.toDict() if isinstance(entity, Entity) else entity for entity in metadata[key]]
+		metadata["shotPlan"] 				= self.shot_planner.plan(metadata["cameras"], metadata["spawnPoints"])
+		return metadata
+
+	def __generateVMFFilesFromBSPs(self, maps_dir, map_names):
+		"""
+		Decompile the given maps with BSPSource, returns the error per map that could not be decompiled.
+		"""
 		print("[BSPSource] Now creating VMF files, this might take a while ...")
-		if os.name == 'nt':
-			cmd = "start /wait cmd /c {} {} {} {} \"{}\"".format(self.java_exec, '-jar', 'bspsrc.jar', '-r', maps_dir)
-		else:
-			cmd = "{} {} {} {} \"{}\"".format(self.java_exec, '-jar', 'bspsrc.jar', '-r', maps_dir)
-		print(cmd)
-		os.system(cmd)
-		print("[BSPSource] Finished converting all BSP files to VMF.")
-		return
+		start = time.time()
+		bsp_files = ["{}{}{}.bsp".format(maps_dir, os.sep, map_name) for map_name in map_names]
+		results = self.bsp_decompiler.decompile(bsp_files)
+		decompile_errors = {}
+		skipped = 0
+		results_by_file = dict((result['bspFile'], result) for result in results)
+		for (map_name, bsp_file) in zip(map_names, bsp_files):
+			result = results_by_file[bsp_file]
+			if result['status'] == BSPDecompiler.STATUS_FAILED:
+				decompile_errors[map_name] = result['error']
+			elif result['status'] == BSPDecompiler.STATUS_SKIPPED:
+				skipped += 1
+		print("[BSPSource] Finished converting {} BSP files to VMF in {:.1f}s ({} up to date, {} failed).".format(len(bsp_files), time.time() - start, skipped, len(decompile_errors)))
+		return decompile_errors
 
 	def __getAllMapsInFolder(self, maps_dir):
 		maps = []
-		full_path_maps = glob.glob("{}{}*_d.vmf".format(maps_dir, os.sep))
+		full_path_maps = glob.glob("{}{}*.bsp".format(maps_dir, os.sep))
 		for full_path_map in full_path_maps:
 			path_parts = full_path_map.split(os.sep)
-			map_name = path_parts[-1].split('_d.')[0]
+			map_name = path_parts[-1][:-len('.bsp')]
 			maps.append(map_name)
 		return maps
 
-	def __getVMFObj(self, maps_dir, map_name):
-		vmf_contents = self.vmf_parser.load("{}{}{}_d.vmf".format(maps_dir, os.sep, map_name))
+	def __getMapObj(self, maps_dir, map_name, dimensions_method):
+		"""
+		The VMF object of the map, or the subset of it that is stored in the .bsp when using the BSP backend.
+		"""
+		if self.backend == MapDataGatherer.BACKEND_BSP:
+			return self.bsp_reader.load("{}{}{}.bsp".format(maps_dir, os.sep, map_name))
+		vmf_contents = self.vmf_parser.load("{}{}{}_d.vmf".format(maps_dir, os.sep, map_name), keep_blocks=self.__getRequiredVMFBlocks(dimensions_method))
 		return vmf_contents
 
-	def __getDimensionsOfMap(self, vmf_obj, scale_optimizer, method='solids'):
+	def __getRequiredVMFBlocks(self, dimensions_method):
+		"""
+		The VMF blocks our extractors read. Entities are stored in full (including their connections), world brushes are only needed for the 'solids' dimensions method.
+		"""
+		blocks = set(['world', 'entity', 'connections', 'editor'])
+		if dimensions_method == 'solids':
+			blocks.update(['solid', 'side'])
+		return blocks
+
+	def __getDimensionsOfMap(self, vmf_obj, entity_index, scale_optimizer, method='solids'):
 		"""
 		Estimation function for determining the best boundries of a map. This takes into account a tournament stage and sky_box being baked into the same map.
+		All candidate points are gathered in one (N, 3) array, which is filtered and reduced with NumPy. Falls back on the entities when a map has no skybox brushes.
 		"""
 		screenWidth = scale_optimizer[0]
 		screenHeight = scale_optimizer[1]
-		world_min = None # x,y,z
-		world_max = None # x,y,z
 		centerPos = {} # x, y, z
 		scale = {'screenWidth' : screenWidth, 'screenHeight' : screenHeight, 'scale' : 0}
 
-		plane_re = re.compile(r'\(([0-9\-\. ]+)\) \(([0-9\-\. ]+)\) \(([0-9\-\. ]+)\)')
-
 		if method == 'solids':
-			for solid in vmf_obj['world']['solid']:
-				for side in solid['side']:
-					if "plane" in side and ("material" not in side or ("toolsskybox" in side["material"])):
-						result = plane_re.match(side["plane"])
-						for plane_coord in [result.group(1), result.group(2), result.group(3)]:
-							coords = plane_coord.split(" ")
-							if world_min == None:
-								world_min = [float(coords[0]), float(coords[1]), float(coords[2])]
-								world_max = [float(coords[0]), float(coords[1]), float(coords[2])]
-							else:
-								world_min[0] = min(float(coords[0]), float(world_min[0]))
-								world_min[1] = min(float(coords[1]), float(world_min[1]))
-								world_min[2] = min(float(coords[2]), float(world_min[2]))
-								world_max[0] = max(float(coords[0]), float(world_max[0]))
-								world_max[1] = max(float(coords[1]), float(world_max[1]))
-								world_max[2] = max(float(coords[2]), float(world_max[2]))
+			points = self.__getSkyboxPlanePoints(vmf_obj)
 		elif method == 'entities':
-			skybox_loc = self.__get3DSkyboxCoords(vmf_obj)
-			compstage_loc = self.__getCompStageCoords(vmf_obj)
-
-			for entity in vmf_obj['entity']:
-				if "origin" in entity and ("targetname" not in entity or ("competitive" not in entity["targetname"])) and ("model" not in entity or ("skybox" not in entity["model"])) and ("targetname" not in entity or "skybox" not in entity["targetname"]) and ("classname" not in entity or ("sky_camera" not in entity["classname"])):
-					coords = entity["origin"].split(" ")
-					# Exclude the comp. stage at all times
-					if self.__isEntityInBox((float(coords[0]), float(coords[1]), float(coords[2])), skybox_loc[0], skybox_loc[1]) == False and self.__isEntityInBox((float(coords[0]), float(coords[1]), float(coords[2])), compstage_loc[0], compstage_loc[1]) == False:
-						if world_min == None:
-							world_min = [float(coords[0]), float(coords[1]), float(coords[2])]
-							world_max = [float(coords[0]), float(coords[1]), float(coords[2])]
-						else:
-							world_min[0] = min(float(coords[0]), float(world_min[0]))
-							world_min[1] = min(float(coords[1]), float(world_min[1]))
-							world_min[2] = min(float(coords[2]), float(world_min[2]))
-							world_max[0] = max(float(coords[0]), float(world_max[0]))
-							world_max[1] = max(float(coords[1]), float(world_max[1]))
-							world_max[2] = max(float(coords[2]), float(world_max[2]))
+			points = self.__getEntityOrigins(entity_index)
 		else:
 			raise Exception('Unknown method used for determining dimensions.')
 
-		scaleX = (abs(float(world_min[0])) + abs(float(world_max[0])))/screenWidth
-		scaleY = (abs(float(world_min[1])) + abs(float(world_max[1])))/screenHeight
+		# Exclude the 3D skybox and comp. stage at all times
+		skybox_loc = self.__get3DSkyboxCoords(entity_index)
+		compstage_loc = self.__getCompStageCoords(entity_index)
+		points = points[~(self.__getPointsInBoxMask(points, skybox_loc[0], skybox_loc[1]) | self.__getPointsInBoxMask(points, compstage_loc[0], compstage_loc[1]))]
+
+		if len(points) == 0:
+			if method == 'solids':
+				return self.__getDimensionsOfMap(vmf_obj, entity_index, scale_optimizer, method='entities')
+			raise Exception('Unable to determine the dimensions of this map.')
+
+		world_min = points.min(axis=0) # x,y,z
+		world_max = points.max(axis=0) # x,y,z
+		size = np.abs(world_min) + np.abs(world_max)
+		scaleX = size[0]/screenWidth
+		scaleY = size[1]/screenHeight
 
 		if scaleX > scaleY:
 			scale['scale'] = int(scaleX)+1
 		else:
 			scale['scale'] = int(scaleY)+1
 
-		centerPos["x"] = ((abs(float(world_min[0])) + abs(float(world_max[0])))/2.0) + float(world_min[0])
-		centerPos["y"] = ((abs(float(world_min[1])) + abs(float(world_max[1])))/2.0) + float(world_min[1])
+		centerPos["x"] = float((size[0]/2.0) + world_min[0])
+		centerPos["y"] = float((size[1]/2.0) + world_min[1])
 		centerPos["z"] = float(world_max[2])
 
-		return (world_min, world_max, scale, centerPos)
+		return (world_min.tolist(), world_max.tolist(), scale, centerPos)
 
-	def __get3DSkyboxCoords(self, vmf_obj):
+	def __getSkyboxPlanePoints(self, vmf_obj):
+		"""
+		All plane points of the world brush sides that are textured with the skybox (or have no material), as an (N, 3) array.
+		"""
+		solids = vmf_obj['world'].get('solid', [])
+		if type(solids) is not list:
+			solids = [solids]
+		planes = []
+		for solid in solids:
+			sides = solid.get('side', [])
+			if type(sides) is not list:
+				sides = [sides]
+			for side in sides:
+				if "plane" in side and ("material" not in side or ("toolsskybox" in side["material"].lower())):
+					planes.append(side["plane"])
+		# "(x y z) (x y z) (x y z)", parsed in one go
+		coords = ' '.join(planes).replace('(', ' ').replace(')', ' ').split()
+		return np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+	def __getEntityOrigins(self, entity_index):
+		"""
+		Origins of all entities that are not part of the skybox or the comp. stage, as an (N, 3) array.
+		"""
+		origins = []
+		for (entity, coords) in entity_index['withOrigin']:
+			if ("targetname" not in entity or ("competitive" not in entity["targetname"])) and ("model" not in entity or ("skybox" not in entity["model"])) and ("targetname" not in entity or "skybox" not in entity["targetname"]) and ("classname" not in entity or ("sky_camera" not in entity["classname"])):
+				origins.append(coords)
+		return np.array(origins, dtype=np.float64).reshape(-1, 3)
+
+	def __get3DSkyboxCoords(self, entity_index):
 		# get sky_camera and box around it
-		camera = self.__getEntityCoordsByClassName(vmf_obj, 'sky_camera')
+		camera = self.__getEntityCoordsByClassName(entity_index, 'sky_camera')
 		# No camera, no 3d skybox
 		if camera == None:
 			return (None, None)
@@ -163,9 +290,9 @@ class MapDataGatherer(object):
 			world_max = [camera[0]+2000, camera[1]+2000, camera[2]+500]
 			return (world_min, world_max)
 
-	def __getCompStageCoords(self, vmf_obj):
+	def __getCompStageCoords(self, entity_index):
 		# get competitive_stage and box around it
-		stage = self.__getEntityCoordsByModelname(vmf_obj, 'competitive_stage')
+		stage = self.__getEntityCoordsByModelname(entity_index, 'competitive_stage')
 		# Comp stage, no tournament stage present
 		if stage == None:
 			return (None, None)
@@ -174,37 +301,76 @@ class MapDataGatherer(object):
 			world_max = [stage[0]+1000, stage[1]+1000, stage[2]+500]
 			return (world_min, world_max)
 
-	def __isEntityInBox(self, entity_coords, world_min, world_max):
+	def __getPointsInBoxMask(self, points, world_min, world_max):
 		if world_min == None or world_max == None:
-			return False
-		if (entity_coords[0] >= world_min[0] and entity_coords[0] <= world_max[0]) and (entity_coords[1] >= world_min[1] and entity_coords[1] <= world_max[1]) and (entity_coords[2] >= world_min[2] and entity_coords[2] <= world_max[2]):
-			return True
-		else:
-			return False
-
-	def __getEntityCoordsByClassName(self, vmf_obj, class_name):
-		for entity in vmf_obj['entity']:
-			if "origin" in entity and "classname" in entity and entity["classname"] == class_name:
-				coords = entity["origin"].split(" ")
-				ret_coords = (float(coords[0]), float(coords[1]), float(coords[2]))
-				return ret_coords
+			return np.zeros(len(points), dtype=bool)
+		return np.all((points >= world_min) & (points <= world_max), axis=1)
+
+	def __buildEntityIndex(self, vmf_obj):
+		"""
+		Walk all entities once, parsing their origins and indexing them by classname and by the partial class and model names our extractors ask for.
+		Every index entry is an (entity, coords) tuple, coords being None for entities without a (valid) origin. A malformed origin is reported and only leaves that entity without coords.
+		"""
+		entities = vmf_obj.get('entity', [])
+		if type(entities) is not list:
+			entities = [entities]
+		entity_index = {
+			'withOrigin' : [],
+			'byClassName' : {},
+			'byPartialClassName' : dict((class_name, []) for class_name in MapDataGatherer.INDEXED_PARTIAL_CLASS_NAMES),
+			'byPartialModelName' : dict((model_name, []) for model_name in MapDataGatherer.INDEXED_PARTIAL_MODEL_NAMES),
+		}
+		for entity in entities:
+			coords = None
+			has_origin = "origin" in entity
+			if isinstance(entity, Entity) and entity.origin is not None:
+				coords = entity.origin
+			elif has_origin:
+				coords = self.__parseCoords(entity["origin"])
+				if coords is None:
+					print("Ignoring the malformed origin '{}' of entity {} ({}).".format(entity["origin"], entity.get("id"), entity.get("classname")))
+			if coords is not None:
+				entity_index['withOrigin'].append((entity, coords))
+			if "classname" in entity:
+				class_name = entity["classname"]
+				entity_index['byClassName'].setdefault(class_name, []).append((entity, coords))
+				if has_origin:
+					for partial_class_name in MapDataGatherer.INDEXED_PARTIAL_CLASS_NAMES:
+						if partial_class_name in class_name:
+							entity_index['byPartialClassName'][partial_class_name].append((entity, coords))
+			if "model" in entity and has_origin:
+				model = entity["model"]
+				for partial_model_name in MapDataGatherer.INDEXED_PARTIAL_MODEL_NAMES:
+					if partial_model_name in model:
+						entity_index['byPartialModelName'][partial_model_name].append((entity, coords))
+		return entity_index
+
+	def __parseCoords(self, coords_str):
+		"""
+		Returns the (x, y, z) tuple, or None when the string is not three numbers.
+		"""
+		coords = coords_str.split(" ")
+		if len(coords) != 3:
+			return None
+		try:
+			return (float(coords[0]), float(coords[1]), float(coords[2]))
+		except ValueError:
+			return None
+
+	def __getEntityCoordsByClassName(self, entity_index, class_name):
+		for (entity, coords) in entity_index['byClassName'].get(class_name, []):
+			if coords is not None:
+				return coords
 		return None
 
-	def __getEntityCoordsByModelname(self, vmf_obj, model_name):
-		for entity in vmf_obj['entity']:
-			if "origin" in entity and "model" in entity and model_name in entity["model"]:
-				coords = entity["origin"].split(" ")
-				ret_coords = (float(coords[0]), float(coords[1]), float(coords[2]))
-				return ret_coords
+	def __getEntityCoordsByModelname(self, entity_index, model_name):
+		for (entity, coords) in entity_index['byPartialModelName'][model_name]:
+			if coords is not None:
+				return coords
 		return None
 
-	def __getCameras(self, vmf_obj):
-		cameras = []
-		if type(vmf_obj['entity']) is list:
-			for entity in vmf_obj['entity']:
-				if 'classname' in entity and entity['classname'] == 'info_observer_point':
-					cameras.append(entity)
-		return cameras
+	def __getCameras(self, entity_index):
+		return [entity for (entity, coords) in entity_index['byClassName'].get('info_observer_point', [])]
 
 	def __getMapVersion(self, vmf_obj):
 		# "mapversion" "5483"
@@ -213,61 +379,65 @@ class MapDataGatherer(object):
 		else:
 			return None
 
-	def __md5(self, fname):
-		hash_md5 = hashlib.md5()
-		with open(fname, "rb") as f:
-			for chunk in iter(lambda: f.read(4096), b""):
-				hash_md5.update(chunk)
-		return hash_md5.hexdigest()
-
 	def __getHashForMap(self, maps_dir, map_name):
-		file_hash = self.__md5("{}{}{}.bsp".format(maps_dir, os.sep, map_name))
-		return file_hash
+		return self.fingerprinter.getDigest("{}{}{}.bsp".format(maps_dir, os.sep, map_name))
+
+	def __getHashesForMaps(self, maps_dir, map_names):
+		bsp_files = ["{}{}{}.bsp".format(maps_dir, os.sep, map_name) for map_name in map_names]
+		digests = self.fingerprinter.getDigests(bsp_files)
+		self.fingerprinter.save()
+		return dict((map_name, digests[bsp_file]) for (map_name, bsp_file) in zip(map_names, bsp_files))
 
 	def __getEntityCount(self, vmf_obj):
 		return len(vmf_obj['entity'])
 
-	def __getHealthKits(self, vmf_obj):
-		return self.__getAllEntitiesByPartialClassName(vmf_obj, 'item_healthkit')
+	def __getHealthKits(self, entity_index):
+		return self.__getAllEntitiesByPartialClassName(entity_index, 'item_healthkit')
+
+	def __getAmmoPacks(self, entity_index):
+		return self.__getAllEntitiesByPartialClassName(entity_index, 'item_ammopack')
 
-	def __getAmmoPacks(self, vmf_obj):
-		return self.__getAllEntitiesByPartialClassName(vmf_obj, 'item_ammopack')
+	def __getControlPoints(self, entity_index):
+		return self.__getAllEntitiesByPartialClassName(entity_index, 'team_control_point')
 
-	def __getControlPoints(self, vmf_obj):
-		return self.__getAllEntitiesByPartialClassName(vmf_obj, 'team_control_point')
+	def __getBriefCases(self, entity_index):
+		return self.__getAllEntitiesByPartialClassName(entity_index, 'item_teamflag')
 
-	def __getBriefCases(self, vmf_obj):
-		return self.__getAllEntitiesByPartialClassName(vmf_obj, 'item_teamflag')
+	def __getSpawnPoints(self, entity_index):
+		return self.__getAllEntitiesByPartialClassName(entity_index, 'info_player_teamspawn')
 
-	def __getSpawnPoints(self, vmf_obj):
-		return self.__getAllEntitiesByPartialClassName(vmf_obj, 'info_player_teamspawn')
+	def __getResupplyLockers(self, entity_index):
+		return self.__getAllEntitiesByPartialModelName(entity_index, 'resupply_locker')
 
-	def __getResupplyLockers(self, vmf_obj):
-		return self.__getAllEntitiesByPartialModelName(vmf_obj, 'resupply_locker')
+	def __containsHalloweenProps(self, entity_index):
+		return len(entity_index['byPartialModelName']['halloween']) > 0
 
-	def __containsHalloweenProps(self, vmf_obj):
-		coords = self.__getEntityCoordsByModelname(vmf_obj, 'halloween')
-		if coords is not None:
-			return True
-		return False
+	def __getAllEntitiesByPartialClassName(self, entity_index, class_name):
+		return [entity for (entity, coords) in entity_index['byPartialClassName'][class_name]]
 
-	def __getAllEntitiesByPartialClassName(self, vmf_obj, class_name):
-		result = []
-		for entity in vmf_obj['entity']:
-			if "origin" in entity and "classname" in entity and class_name in entity["classname"]:
-				result.append(entity)
-		return result
+	def __getAllEntitiesByPartialModelName(self, entity_index, model_name):
+		return [entity for (entity, coords) in entity_index['byPartialModelName'][model_name]]
 
-	def __getAllEntitiesByPartialModelName(self, vmf_obj, model_name):
-		result = []
-		for entity in vmf_obj['entity']:
-			if "origin" in entity and "model" in entity and model_name in entity["model"]:
-				result.append(entity)
-		return result
 
-	def __saveMetadataToDisk(self, maps_metadata, metadata_output_filename):
-		with open('.{}metadata{}{}'.format(os.sep, os.sep, metadata_output_filename), 'w') as outfile:
-			json.dump(maps_metadata, outfile, sort_keys=True)
+# The gatherer of a pool worker process, see MapDataGatherer.gatherMetadataFromBSPDir.
+_worker_gatherer = None
+
+def _initMetadataWorker(gatherer):
+	global _worker_gatherer
+	_worker_gatherer = gatherer
+
+def _gatherMetadataForMapWorker(job):
+	return _gatherMetadataForMapJob(_worker_gatherer, job)
+
+def _gatherMetadataForMapJob(gatherer, job):
+	"""
+	Returns (map_name, metadata, error), so a single malformed map does not stop the whole batch.
+	"""
+	(maps_dir, map_name, scale_optimizer, dimensions_method, file_hash) = job
+	try:
+		return (map_name, gatherer.gatherMetadataForMap(maps_dir, map_name, scale_optimizer, dimensions_method, file_hash), None)
+	except Exception:
+		return (map_name, None, traceback.format_exc())
 
 
 if __name__ == '__main__':
@@ -276,6 +446,11 @@ if __name__ == '__main__':
 	JAVA_EXEC = 'C:\\ProgramData\\Oracle\\Java\\javapath\\java.exe'
 	MAPS_DIR = 'Z:\\TMP TF2 DUMP\\rc_tmp'
 	OUTPUT_FILENAME = 'bsp_maps_metadata.json'
+	OUTPUT_FORMAT = 'json' # or 'jsonl'/'shards' to write every map as soon as it is processed, compact with: python -m metadata_store
+	WORKERS = multiprocessing.cpu_count()
+	CACHE_DIR = '.{}metadata{}cache'.format(os.sep, os.sep)
+	FINGERPRINT_CACHE_FILENAME = '.{}metadata{}fingerprints.json'.format(os.sep, os.sep)
+	SHOT_TIME_BUDGET = None # seconds of screenshots per map, spectator shots are planned first and 360 images with the remaining time
 	# Main call
-	gatherer = MapDataGatherer(JAVA_EXEC)
-	gatherer.gatherMetadataFromBSPDir(maps_dir=MAPS_DIR, metadata_output_filename=OUTPUT_FILENAME)
+	gatherer = MapDataGatherer(JAVA_EXEC, fingerprint_cache_filename=FINGERPRINT_CACHE_FILENAME, shot_planner=ShotPlanner(time_budget=SHOT_TIME_BUDGET))
+	gatherer.gatherMetadataFromBSPDir(maps_dir=MAPS_DIR, metadata_output_filename=OUTPUT_FILENAME, workers=WORKERS, cache_dir=CACHE_DIR, output_format=OUTPUT_FORMAT)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import time, threading, traceback
+from contextlib import contextmanager
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+class StageStats(object):
+	"""
+	Collects the busy time per stage of the map pipeline, to report how much of the run every stage (and its workers) was in use.
+	"""
+
+	def __init__(self):
+		"""
+		Contructor
+		"""
+		self.lock = threading.Lock()
+		self.start = time.time()
+		self.stages = {}
+
+	def add(self, stage, seconds, count=1):
+		with self.lock:
+			entry = self.stages.setdefault(stage, {'seconds' : 0.0, 'count' : 0, 'workers' : 1})
+			entry['seconds'] += seconds
+			entry['count'] += count
+
+	def setWorkers(self, stage, workers):
+		with self.lock:
+			self.stages.setdefault(stage, {'seconds' : 0.0, 'count' : 0, 'workers' : 1})['workers'] = workers
+
+	@contextmanager
+	def measure(self, stage):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.add(stage, time.time() - start)
+
+	def getReport(self):
+		"""
+		Returns per stage the busy seconds, the number of measurements and the utilization (busy time / (workers * wall time)).
+		"""
+		wall = max(time.time() - self.start, 0.001)
+		report = {}
+		with self.lock:
+			for (stage, entry) in self.stages.items():
+				report[stage] = dict(entry, utilization=entry['seconds'] / (entry['workers'] * wall))
+		return (wall, report)
+
+	def printReport(self):
+		(wall, report) = self.getReport()
+		print("Pipeline utilization over {:.1f} seconds:".format(wall))
+		for stage in sorted(report, key=lambda stage: -report[stage]['seconds']):
+			entry = report[stage]
+			print("- {:<16} {:>9.1f}s busy in {:>5} step(s) on {} worker(s), {:>5.1f}% utilized".format(stage, entry['seconds'], entry['count'], entry['workers'], entry['utilization'] * 100))
+
+class BackgroundStage(object):
+	"""
+	Runs the steps of a stage (function, args) in order on its own thread, so the game can continue with the next map meanwhile.
+	Failing steps are reported and do not stop the stage.
+	"""
+
+	def __init__(self, name, stats=None):
+		"""
+		Contructor
+		"""
+		self.name = name
+		self.stats = stats
+		self.queue = queue.Queue()
+		self.thread = threading.Thread(target=self.__run, name=name)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def submit(self, function, args=()):
+		self.queue.put((function, args))
+
+	def join(self):
+		"""
+		Wait until all submitted steps are done, and stop the thread.
+		"""
+		self.queue.put(None)
+		self.thread.join()
+
+	def __run(self):
+		while True:
+			step = self.queue.get()
+			if step is None:
+				return
+			(function, args) = step
+			start = time.time()
+			try:
+				function(*args)
+			except Exception:
+				print("[{}] Step failed:\n{}".format(self.name, traceback.format_exc()))
+			if self.stats is not None:
+				self.stats.add(self.name, time.time() - start)
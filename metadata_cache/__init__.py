@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, json, time, hashlib
+
+class MetadataCache(object):
+	"""
+	Persistent, content-addressed cache for map metadata, keyed by the hash of the .bsp file plus the version and options of the extractor.
+
+	Every entry is a separate json file (<cache_dir>/<hash prefix>/<file hash>_<variant>.json), so entries can be written and evicted independently. Entries that are not used for max_age seconds are evicted, as are the least recently used entries once the cache grows beyond max_size bytes.
+	"""
+
+	def __init__(self, cache_dir, version, max_age=90*24*3600, max_size=1024*1024*1024):
+		"""
+		Contructor
+		"""
+		self.cache_dir = cache_dir
+		self.version = version
+		self.max_age = max_age
+		self.max_size = max_size
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+	def get(self, file_hash, options=None):
+		"""
+		Returns the cached metadata, or None if this file has not been processed with this version and options yet.
+		"""
+		filename = self.__getEntryFilename(file_hash, options)
+		if not os.path.exists(filename):
+			return None
+		try:
+			with open(filename) as data_file:
+				metadata = json.load(data_file)
+		except ValueError:
+			# Partially written or corrupt entry
+			os.remove(filename)
+			return None
+		# Mark as recently used for the eviction
+		os.utime(filename, None)
+		return metadata
+
+	def contains(self, file_hash, options=None):
+		return os.path.exists(self.__getEntryFilename(file_hash, options))
+
+	def put(self, file_hash, metadata, options=None):
+		filename = self.__getEntryFilename(file_hash, options)
+		entry_dir = os.path.dirname(filename)
+		if not os.path.exists(entry_dir):
+			os.makedirs(entry_dir)
+		# Write to a temporary file first, so an interrupted run never leaves a partial entry behind
+		tmp_filename = '{}.tmp'.format(filename)
+		with open(tmp_filename, 'w') as outfile:
+			json.dump(metadata, outfile, sort_keys=True)
+		if os.path.exists(filename):
+			os.remove(filename)
+		os.rename(tmp_filename, filename)
+
+	def evict(self):
+		"""
+		Remove stale entries by age and size, returns the number of removed entries.
+		"""
+		now = time.time()
+		entries = []
+		removed = 0
+		for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				stat = os.stat(path)
+				if self.max_age is not None and now - stat.st_mtime > self.max_age:
+					os.remove(path)
+					removed += 1
+				else:
+					entries.append((stat.st_mtime, stat.st_size, path))
+
+		if self.max_size is not None:
+			total_size = sum(entry[1] for entry in entries)
+			# Least recently used first
+			for (mtime, size, path) in sorted(entries):
+				if total_size <= self.max_size:
+					break
+				os.remove(path)
+				total_size -= size
+				removed += 1
+		return removed
+
+	def __getEntryFilename(self, file_hash, options):
+		variant = hashlib.md5(json.dumps([self.version, options], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+		return os.path.join(self.cache_dir, file_hash[:2], '{}_{}.json'.format(file_hash, variant))
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, re, json, glob, mmap, collections
+
+class MetadataWriter(object):
+	"""
+	Writes the metadata of maps to disk in one of the following formats:
+	- json: the legacy single file, a dict with every map name as an entry. Kept in memory until close().
+	- jsonl: JSON Lines, one {"mapName": ..., "metadata": ...} record per map, flushed as soon as it is written.
+	- shards: a directory with a <map name>.json file per map.
+
+	The jsonl and shards formats only hold one map in memory, and keep every map that was written when the run is interrupted. Use MetadataCompactor to turn them into the legacy format.
+	"""
+
+	FORMAT_JSON 	= 'json'
+	FORMAT_JSONL 	= 'jsonl'
+	FORMAT_SHARDS 	= 'shards'
+
+	def __init__(self, output_location, output_format=FORMAT_JSON):
+		"""
+		Contructor
+		"""
+		self.output_location = output_location
+		self.output_format = output_format
+		self.maps_metadata = {}
+		self.outfile = None
+		if output_format == MetadataWriter.FORMAT_JSONL:
+			self.outfile = open(output_location, 'w')
+		elif output_format == MetadataWriter.FORMAT_SHARDS:
+			if not os.path.exists(output_location):
+				os.makedirs(output_location)
+		elif output_format != MetadataWriter.FORMAT_JSON:
+			raise Exception('Unknown metadata output format {}.'.format(output_format))
+
+	def write(self, map_name, metadata):
+		if self.output_format == MetadataWriter.FORMAT_JSONL:
+			self.outfile.write(json.dumps({'mapName' : map_name, 'metadata' : metadata}, sort_keys=True))
+			self.outfile.write('\n')
+			self.outfile.flush()
+		elif self.output_format == MetadataWriter.FORMAT_SHARDS:
+			with open(os.path.join(self.output_location, '{}.json'.format(map_name)), 'w') as outfile:
+				json.dump(metadata, outfile, sort_keys=True)
+		else:
+			self.maps_metadata[map_name] = metadata
+
+	def close(self):
+		if self.output_format == MetadataWriter.FORMAT_JSONL:
+			self.outfile.close()
+		elif self.output_format == MetadataWriter.FORMAT_JSON:
+			with open(self.output_location, 'w') as outfile:
+				json.dump(self.maps_metadata, outfile, sort_keys=True)
+			self.maps_metadata = {}
+
+
+class MetadataCompactor(object):
+	"""
+	Converts JSON Lines or shard metadata output to the legacy single file format, byte for byte equal to what json.dump(maps_metadata, sort_keys=True) writes.
+	Only the offsets of the records and one decoded map are held in memory. When a map occurs multiple times in a JSON Lines file, the last record wins.
+	"""
+
+	def compact(self, source_location, output_filename):
+		"""
+		Compact a .jsonl file or a shards directory into output_filename, returns the number of maps.
+		"""
+		if os.path.isdir(source_location):
+			records = self.__indexShards(source_location)
+		else:
+			records = self.__indexJSONLines(source_location)
+
+		source_file = None
+		if not os.path.isdir(source_location):
+			source_file = open(source_location, 'rb')
+		try:
+			with open(output_filename, 'w') as outfile:
+				outfile.write('{')
+				first = True
+				for map_name in sorted(records):
+					if not first:
+						outfile.write(', ')
+					first = False
+					metadata = self.__readRecord(source_file, records[map_name])
+					outfile.write(json.dumps(map_name))
+					outfile.write(': ')
+					outfile.write(json.dumps(metadata, sort_keys=True))
+				outfile.write('}')
+		finally:
+			if source_file is not None:
+				source_file.close()
+		return len(records)
+
+	def __indexJSONLines(self, filename):
+		records = {}
+		with open(filename, 'rb') as data_file:
+			offset = 0
+			for line in data_file:
+				if line.strip() != b'':
+					record = json.loads(line.decode('utf-8'))
+					records[record['mapName']] = (offset, len(line))
+				offset += len(line)
+		return records
+
+	def __indexShards(self, shards_dir):
+		records = {}
+		for shard in glob.glob(os.path.join(shards_dir, '*.json')):
+			records[os.path.basename(shard)[:-len('.json')]] = shard
+		return records
+
+	def __readRecord(self, source_file, record):
+		if type(record) is tuple:
+			(offset, length) = record
+			source_file.seek(offset)
+			return json.loads(source_file.read(length).decode('utf-8'))['metadata']
+		with open(record) as data_file:
+			return json.load(data_file)
+
+
+class MetadataStore(object):
+	"""
+	Read-only random access to a metadata file (legacy json or jsonl), to look up single maps without decoding the whole file.
+	The format is detected from the content, not from the file extension.
+
+	An index of map name -> byte range is stored next to the file (<file>.idx) and rebuilt whenever the file changes, so opening the store only reads that index. The file is memory-mapped, records are decoded on request and kept in an LRU cache of cache_size maps.
+	"""
+
+	# Bump whenever the index changes, older indexes are rebuilt
+	INDEX_VERSION = 2
+
+	def __init__(self, metadata_filename, cache_size=16):
+		"""
+		Contructor
+		"""
+		self.metadata_filename = metadata_filename
+		self.index_filename = '{}.idx'.format(metadata_filename)
+		self.cache_size = cache_size
+		self.cache = collections.OrderedDict()
+		self.data_file = open(metadata_filename, 'rb')
+		self.data = None
+		if os.path.getsize(metadata_filename) > 0:
+			self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.index = self.__loadIndex()
+
+	def get(self, map_name):
+		"""
+		Returns the metadata of the given map, or None if the map is not in this file.
+		"""
+		if map_name in self.cache:
+			# Mark as most recently used
+			metadata = self.cache.pop(map_name)
+			self.cache[map_name] = metadata
+			return metadata
+		if map_name not in self.index['records']:
+			return None
+
+		(offset, length) = self.index['records'][map_name]
+		metadata = json.loads(self.data[offset:offset + length].decode('utf-8'))
+		if self.index['format'] == MetadataWriter.FORMAT_JSONL:
+			metadata = metadata['metadata']
+
+		self.cache[map_name] = metadata
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return metadata
+
+	def getMapNames(self):
+		return sorted(self.index['records'])
+
+	def __contains__(self, map_name):
+		return map_name in self.index['records']
+
+	def __len__(self):
+		return len(self.index['records'])
+
+	def close(self):
+		if self.data is not None:
+			self.data.close()
+		self.data_file.close()
+
+	def __loadIndex(self):
+		stat = os.stat(self.metadata_filename)
+		if os.path.exists(self.index_filename):
+			try:
+				with open(self.index_filename) as index_file:
+					index = json.load(index_file)
+				if index.get('version') == MetadataStore.INDEX_VERSION and index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+					return index
+			except (ValueError, KeyError):
+				pass
+
+		print("Indexing metadata file {} ...".format(self.metadata_filename))
+		index = {'version' : MetadataStore.INDEX_VERSION, 'size' : stat.st_size, 'mtime' : stat.st_mtime}
+		index['format'] = self.__detectFormat()
+		if index['format'] == MetadataWriter.FORMAT_JSONL:
+			index['records'] = self.__indexJSONLines()
+		else:
+			index['records'] = self.__indexJSON()
+
+		try:
+			tmp_filename = '{}.tmp'.format(self.index_filename)
+			with open(tmp_filename, 'w') as outfile:
+				json.dump(index, outfile)
+			if os.path.exists(self.index_filename):
+				os.remove(self.index_filename)
+			os.rename(tmp_filename, self.index_filename)
+		except (IOError, OSError):
+			print("Could not store the index of {}, it will be rebuilt next time.".format(self.metadata_filename))
+		return index
+
+	def __detectFormat(self):
+		"""
+		A JSON Lines file starts with a {"mapName": ..., "metadata": ...} record on the first line. The legacy format is one dict with the map names as keys,
+		which json.dump writes on a single line (or indented, in which case the first line is just the opening brace).
+		"""
+		if self.data is None:
+			return MetadataWriter.FORMAT_JSON
+		line_end = self.data.find(b'\n')
+		first_line = self.data[:line_end] if line_end != -1 else self.data[:]
+		try:
+			record = json.loads(first_line.decode('utf-8'))
+		except ValueError:
+			return MetadataWriter.FORMAT_JSON
+		if isinstance(record, dict) and set(record.keys()) == set(['mapName', 'metadata']) and isinstance(record['metadata'], dict) and not isinstance(record['mapName'], dict):
+			return MetadataWriter.FORMAT_JSONL
+		return MetadataWriter.FORMAT_JSON
+
+	def __indexJSONLines(self):
+		records = {}
+		prefix = b'{"mapName": '
+		decoder = json.JSONDecoder()
+		offset = 0
+		self.data_file.seek(0)
+		for line in self.data_file:
+			if line.strip() != b'':
+				if line.startswith(prefix):
+					# Written by MetadataWriter, only decode the map name
+					map_name = decoder.raw_decode(line[len(prefix):].decode('utf-8'))[0]
+				else:
+					map_name = json.loads(line.decode('utf-8'))['mapName']
+				records[map_name] = (offset, len(line))
+			offset += len(line)
+		return records
+
+	def __indexJSON(self):
+		"""
+		Walk the top level dict of the legacy format, recording the byte range of the metadata of every map.
+		"""
+		records = {}
+		if self.data is None:
+			return records
+		text = self.data[:].decode('utf-8')
+		# json.dump escapes non-ASCII by default, in which case character and byte offsets are equal
+		is_ascii = len(text) == len(self.data)
+		decoder = json.JSONDecoder()
+		whitespace = re.compile(r'\s*')
+		(char_offset, byte_offset) = (0, 0)
+		idx = whitespace.match(text, 0).end()
+		if text[idx] != '{':
+			raise Exception('{} is not a metadata file.'.format(self.metadata_filename))
+		idx = whitespace.match(text, idx + 1).end()
+		while text[idx] != '}':
+			(map_name, idx) = decoder.raw_decode(text, idx)
+			idx = whitespace.match(text, idx).end()
+			if text[idx] != ':':
+				raise Exception('{} is not a metadata file.'.format(self.metadata_filename))
+			start = whitespace.match(text, idx + 1).end()
+			(metadata, end) = decoder.raw_decode(text, start)
+			if is_ascii:
+				records[map_name] = (start, end - start)
+			else:
+				byte_offset += len(text[char_offset:start].encode('utf-8'))
+				length = len(text[start:end].encode('utf-8'))
+				records[map_name] = (byte_offset, length)
+				(char_offset, byte_offset) = (end, byte_offset + length)
+			idx = whitespace.match(text, end).end()
+			if text[idx] == ',':
+				idx = whitespace.match(text, idx + 1).end()
+		return records
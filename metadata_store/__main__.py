@@ -0,0 +1,11 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import sys
+from metadata_store import MetadataCompactor
+
+if __name__ == '__main__':
+	if len(sys.argv) != 3:
+		print("Usage: python -m metadata_store <metadata .jsonl file or shards dir> <output .json file>")
+		sys.exit(1)
+	count = MetadataCompactor().compact(sys.argv[1], sys.argv[2])
+	print("Compacted the metadata of {} maps into {}".format(count, sys.argv[2]))
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, sys, time, math, threading, traceback, subprocess, multiprocessing
+import numpy as np
+from PIL import Image
+
+class PostProcessingQueue(object):
+	"""
+	Runs post-processing jobs (overview merging, 360 stitching and cleanup) in a fixed-size process pool, so capturing can continue with the next map.
+
+	Jobs are module-level functions with picklable arguments. submit() blocks while max_pending jobs are still queued or running, which keeps the captured frames waiting in memory bounded.
+	"""
+
+	STATUS_PENDING 	= 'pending'
+	STATUS_DONE 	= 'done'
+	STATUS_FAILED 	= 'failed'
+
+	def __init__(self, workers=2, max_pending=8):
+		"""
+		Contructor
+		"""
+		self.pool = multiprocessing.Pool(workers)
+		self.pending = threading.BoundedSemaphore(max_pending)
+		self.lock = threading.Lock()
+		self.jobs = []
+
+	def submit(self, name, function, args, on_finished=None):
+		"""
+		Queue function(*args), returns the status dict of the job which is updated once the job finishes.
+		on_finished is called with that status dict (from the pool's result thread) once the job finished or failed.
+		"""
+		self.pending.acquire()
+		job = {'name' : name, 'status' : PostProcessingQueue.STATUS_PENDING, 'seconds' : None, 'error' : None, 'result' : None, 'on_finished' : on_finished}
+		with self.lock:
+			self.jobs.append(job)
+		callbacks = {'callback' : lambda outcome: self.__onJobFinished(job, outcome)}
+		if sys.version_info[0] >= 3:
+			# Errors _runJob cannot catch itself, e.g. arguments or results that cannot be pickled
+			callbacks['error_callback'] = lambda error: self.__onJobFinished(job, (None, 'The job could not run: {!r}'.format(error), None))
+		self.pool.apply_async(_runJob, (function, args), **callbacks)
+		return job
+
+	def getStatus(self):
+		with self.lock:
+			return [dict((key, value) for (key, value) in job.items() if key != 'on_finished') for job in self.jobs]
+
+	def join(self):
+		"""
+		Wait for all jobs to finish and stop the workers, returns the status of every job.
+		"""
+		self.pool.close()
+		self.pool.join()
+		failed = [job for job in self.jobs if job['status'] == PostProcessingQueue.STATUS_FAILED]
+		print("[PostProcessing] Finished {} job(s), {} failed.".format(len(self.jobs), len(failed)))
+		return self.getStatus()
+
+	def __onJobFinished(self, job, outcome):
+		(result, error, seconds) = outcome
+		with self.lock:
+			job['status'] = PostProcessingQueue.STATUS_DONE if error is None else PostProcessingQueue.STATUS_FAILED
+			job['result'] = result
+			job['error'] = error
+			job['seconds'] = seconds
+		if error is None:
+			print("[PostProcessing] Finished '{}' ({:.1f}s).".format(job['name'], seconds))
+		else:
+			print("[PostProcessing] Failed '{}':\n{}".format(job['name'], error))
+		if job['on_finished'] is not None:
+			try:
+				job['on_finished'](job)
+			except Exception:
+				traceback.print_exc()
+		self.pending.release()
+
+
+def _runJob(function, args):
+	"""
+	Returns (result, error, seconds), so the callback also fires for failed jobs.
+	"""
+	start = time.time()
+	try:
+		return (function(*args), None, time.time() - start)
+	except Exception:
+		return (None, traceback.format_exc(), time.time() - start)
+
+def keyOverviewFrame(frame, key_tolerance=0):
+	"""
+	Returns the frame with the green anti-aliasing and the background colour (the colour of the top left pixel) made transparent, and its (transparent) top left pixel.
+	"""
+	data = np.array(frame.convert("RGBA"))
+	rgb = data[:, :, :3].astype(np.int16)
+	transparent = _getColorMask(rgb, (39, 190, 36), key_tolerance) | _getColorMask(rgb, rgb[0, 0].copy(), key_tolerance)
+	data[transparent] = (0, 0, 0, 0)
+	return (Image.fromarray(data, "RGBA"), tuple(data[0, 0].tolist()))
+
+def _getColorMask(rgb, color, key_tolerance):
+	"""
+	Mask of all pixels within key_tolerance of the given colour, on every channel.
+	"""
+	if key_tolerance == 0:
+		return np.all(rgb == color, axis=2)
+	return np.all(np.abs(rgb - color) <= key_tolerance, axis=2)
+
+def mergeOverviewFrames(frames, output_filename, key_tolerance=0, debug_layer_filename=None):
+	"""
+	Key and alpha-composite the overview frames in memory, only the merged image is encoded.
+	debug_layer_filename is an optional format string (with the layer number) to also store every keyed layer.
+	"""
+	overviews_to_merge = []
+
+	# Make the images transparant and elect the best images
+	# This is required to prevent green screenshots from merging into the image
+	# However, make sure at least 0..Z_POS_CENTER+1 is being used, Z_POS_CENTER = 3
+	i = 0
+	for frame in frames:
+		(overview, top_left_pixel) = keyOverviewFrame(frame, key_tolerance)
+		if debug_layer_filename is not None:
+			overview.save(debug_layer_filename.format(i), "PNG")
+		if (top_left_pixel[0] == 0 and top_left_pixel[1] == 0 and top_left_pixel[2] == 0) or (i < 3):
+			overviews_to_merge.append(overview)
+		i += 1
+
+	# Merge layers
+	background = overviews_to_merge[0]
+	for overview in overviews_to_merge[1:]:
+		background = Image.alpha_composite(background, overview)
+
+	background.save(output_filename, "PNG")
+	return output_filename
+
+def stitch360Image(stitch_exec, stitch_folder, image_filenames, output_filename, delete_images=True):
+	"""
+	Stitch the box screenshots with the external stitcher, which runs from its own folder.
+	"""
+	cmd = ['primusrun', stitch_exec, '-GPU', 'Default', output_filename]
+	cmd.extend(image_filenames)
+
+	print(' '.join(cmd))
+
+	process = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=stitch_folder)
+	output, error = process.communicate()
+	print(output)
+
+	# Check if the output is more than just one pixel
+	if os.path.exists(output_filename) and os.path.getsize(output_filename) < 1024:
+		os.remove(output_filename)
+
+	if delete_images == True:
+		removeFiles(image_filenames)
+	return output_filename
+
+def removeFiles(filenames):
+	for filename in filenames:
+		if os.path.exists(filename):
+			os.remove(filename)
+
+class EquirectangularProjector(object):
+	"""
+	Reprojects screenshots taken from one position at known angles (setang_exact) into an equirectangular panorama, without feature matching.
+
+	For every panorama pixel the screenshot that looks most directly at it is sampled (bilinear). The remap tables (which screenshot, and where in it)
+	only depend on the screenshot size, the angles and the FOV, and are cached. The panorama is rendered in bands of tile_height rows,
+	so only the screenshots needed for the current band are kept in memory.
+	"""
+
+	def __init__(self, output_width=4096, tile_height=256, hfov=None):
+		"""
+		Contructor
+		"""
+		self.output_width = output_width
+		self.output_height = output_width // 2
+		self.tile_height = tile_height
+		# Horizontal FOV in degrees, by default the one of fov 90 (which the game defines for 4:3) at the aspect ratio of the screenshots
+		self.hfov = hfov
+		self.remap_tables = {}
+
+	def getHorizontalFOV(self, image_size):
+		if self.hfov is not None:
+			return self.hfov
+		(width, height) = image_size
+		return math.degrees(2 * math.atan(math.tan(math.radians(45)) * (float(width) / height) / (4.0 / 3.0)))
+
+	def getRemapTables(self, image_size, angles):
+		"""
+		Returns a (source index, source x, source y) table per band, for screenshots of image_size taken at angles [(pitch, yaw), ...].
+		"""
+		key = (tuple(image_size), tuple(angles))
+		if key not in self.remap_tables:
+			self.remap_tables[key] = [self.__getRemapTable(image_size, angles, top) for top in range(0, self.output_height, self.tile_height)]
+		return self.remap_tables[key]
+
+	def project(self, image_filenames, angles, output_filename, quality=90):
+		size = Image.open(image_filenames[0]).size
+		tables = self.getRemapTables(size, angles)
+		# Load every screenshot when it is first needed, and drop it after the last band that uses it
+		last_use = {}
+		for (tile, (index, xs, ys)) in enumerate(tables):
+			for image_index in np.unique(index):
+				last_use[image_index] = tile
+		panorama = np.zeros((self.output_height, self.output_width, 3), dtype=np.uint8)
+		images = {}
+		for (tile, (index, xs, ys)) in enumerate(tables):
+			top = tile * self.tile_height
+			band = panorama[top:top + index.shape[0]]
+			for image_index in np.unique(index):
+				if image_index == len(image_filenames):
+					# Not covered by any screenshot
+					continue
+				if image_index not in images:
+					images[image_index] = np.asarray(Image.open(image_filenames[image_index]).convert('RGB'))
+				mask = index == image_index
+				band[mask] = _sampleBilinear(images[image_index], xs[mask], ys[mask])
+				if last_use[image_index] == tile:
+					del images[image_index]
+		Image.fromarray(panorama, 'RGB').save(output_filename, quality=quality)
+		return output_filename
+
+	def __getRemapTable(self, image_size, angles, top):
+		(width, height) = image_size
+		rows = min(self.tile_height, self.output_height - top)
+		# Direction of every panorama pixel, in the game's coordinates (x forward, y left, z up)
+		longitude = np.radians(180.0 - (np.arange(self.output_width, dtype=np.float32) + 0.5) * 360.0 / self.output_width)
+		latitude = np.radians(90.0 - (np.arange(top, top + rows, dtype=np.float32) + 0.5) * 180.0 / self.output_height)
+		(longitude, latitude) = np.meshgrid(longitude, latitude)
+		directions = np.stack([np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)], axis=-1)
+
+		focal = (width / 2.0) / math.tan(math.radians(self.getHorizontalFOV(image_size)) / 2)
+		index = np.full((rows, self.output_width), len(angles), dtype=np.uint8)
+		xs = np.zeros((rows, self.output_width), dtype=np.float32)
+		ys = np.zeros((rows, self.output_width), dtype=np.float32)
+		best = np.zeros((rows, self.output_width), dtype=np.float32)
+		for (image_index, (pitch, yaw)) in enumerate(angles):
+			(pitch, yaw) = (math.radians(pitch), math.radians(yaw))
+			# A positive pitch looks down
+			forward = np.array([math.cos(pitch) * math.cos(yaw), math.cos(pitch) * math.sin(yaw), -math.sin(pitch)], dtype=np.float32)
+			right = np.array([math.sin(yaw), -math.cos(yaw), 0], dtype=np.float32)
+			up = np.array([math.sin(pitch) * math.cos(yaw), math.sin(pitch) * math.sin(yaw), math.cos(pitch)], dtype=np.float32)
+			depth = directions.dot(forward)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				x = width / 2.0 + directions.dot(right) / depth * focal
+				y = height / 2.0 - directions.dot(up) / depth * focal
+			# Prefer the screenshot that looks most directly at the pixel
+			visible = (depth > best) & (x >= 0) & (x <= width - 1) & (y >= 0) & (y <= height - 1)
+			index[visible] = image_index
+			xs[visible] = x[visible]
+			ys[visible] = y[visible]
+			best[visible] = depth[visible]
+		return (index, xs, ys)
+
+_projectors = {}
+
+def _sampleBilinear(image, xs, ys):
+	x0 = np.minimum(xs.astype(np.int32), image.shape[1] - 2)
+	y0 = np.minimum(ys.astype(np.int32), image.shape[0] - 2)
+	fx = (xs - x0)[:, None]
+	fy = (ys - y0)[:, None]
+	top = image[y0, x0] * (1 - fx) + image[y0, x0 + 1] * fx
+	bottom = image[y0 + 1, x0] * (1 - fx) + image[y0 + 1, x0 + 1] * fx
+	return np.clip(top * (1 - fy) + bottom * fy + 0.5, 0, 255).astype(np.uint8)
+
+def projectEquirectangular(image_filenames, angles, output_filename, output_width=4096, hfov=None, delete_images=True):
+	"""
+	Stitch the box screenshots into an equirectangular panorama on the CPU. Projectors (and their remap tables) are kept per worker process,
+	so the tables are only computed once for all cameras with the same screenshot size and angles.
+	"""
+	key = (output_width, hfov)
+	if key not in _projectors:
+		_projectors[key] = EquirectangularProjector(output_width=output_width, hfov=hfov)
+	_projectors[key].project(image_filenames, angles, output_filename)
+	if delete_images == True:
+		removeFiles(image_filenames)
+	return output_filename
@@ -14,7 +14,7 @@ class MapStatsCoordinator(object):
 
 	def helperNormalizeMapName(self, name):
 		if name == None:
-		return None
+			return None
 
 		match = re.search(self.re_map_name_normalizer, name)
 		normalized_to_end_name = name
@@ -27,7 +27,7 @@ class MapStatsCoordinator(object):
 				name_parts = name.split("_")
 				new_proposal_parts = name_parts
 				for i, part in reversed(list(enumerate(name_parts))):
-					match = re.search(COMPILED_REGEX_MAP_NAME, "_{}".format(part))
+					match = re.search(self.re_map_name_normalizer, "_{}".format(part))
 					if match is not None and match.group(0) != None and len('_'.join(name_parts[0:i])) > 3:
 						del new_proposal_parts[i]
 					elif len('_'.join(name_parts[0:i])) <= 3:
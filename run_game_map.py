@@ -2,13 +2,16 @@
 # Created by Makamoto (teamwork.tf)
 import time, json
 import math, threading
-import glob, gtk, re, wnck, gtk, os, pyautogui, psutil, subprocess
-from pyautogui import press, typewrite, hotkey, keyDown, keyUp
-import pyautogui
+import glob, re, os, subprocess
 import numpy as np
 from PIL import Image
-import subprocess
-import game_coordinator
+import post_processing
+import capture
+from screen_state import ScreenStateClassifier
+from job_ledger import JobLedger
+from fingerprint import FileFingerprinter
+import map_pipeline
+from metadata_store import MetadataStore
 
 class FatalGameMapRunnerException(Exception):
 	pass
@@ -34,24 +37,78 @@ class GameMapRunner(object):
 	TASK_360_IMAGES 		= 3
 	TASK_ISOMETRIC_CAMS 	= 4
 
-	def __init__(self, game_base_dir, screenshots_storage_dir, metadata_filename, max_360_spec_cams=2, post_process=True, delete_leftover_images=True, pp_stitch_folder=None, pp_stitch_exec=None):
+	def __init__(self, game_base_dir, screenshots_storage_dir, metadata_filename, max_360_spec_cams=2, post_process=True, delete_leftover_images=True, pp_stitch_folder=None, pp_stitch_exec=None, overview_key_tolerance=0, debug_overview_layers=False, pp_workers=2, use_console_log=True, capture_backend=None, screenshot_format=capture.EncodingPool.FORMAT_PNG, encoding_workers=2, render_wait=0.5, settle_detection=True, settle_threshold=1.0, settle_timeout=3.0, max_shot_retries=2, loading_timeout=30, pp_panorama_width=4096, ledger_filename=None, map_priorities=None, max_map_attempts=3, retry_backoff=60, game_coordinator=None, instance_name=None, interactive=True, use_shot_plan=True):
 		"""
 		Contructor
 		"""
 		self.usr_steam_exec = '/usr/bin/steam'
 		self.maps_dir = '{}tf/maps/'.format(game_base_dir)
 		self.screenshots_storage_dir = screenshots_storage_dir
-		self.gc = game_coordinator.GameCoordinator(game_base_dir=game_base_dir)
+		if game_coordinator is None:
+			# Only the real game requires the desktop (gtk, wnck and pyautogui), a stand-in like fake_game.FakeGameCoordinator does not
+			from game_coordinator import GameCoordinator
+			# With the console log, the coordinator waits for the game to report events instead of fixed sleeps
+			game_coordinator = GameCoordinator(game_base_dir=game_base_dir, usr_steam_exec=self.usr_steam_exec, screenshots_storage_dir=screenshots_storage_dir, use_console_log=use_console_log, capture_backend=capture_backend)
+		self.gc = game_coordinator
+		# Frames are grabbed from the same screen (or stand-in) the coordinator looks at
+		capture_backend = self.gc.getCaptureBackend()
 		self.max_360_spec_cams = max_360_spec_cams
+		# Only capture the cameras in the shot plan of the metadata (see shot_planner), instead of every camera
+		self.use_shot_plan = use_shot_plan
 		self.post_process = post_process
 		self.delete_leftover_images = delete_leftover_images
 		self.pp_stitch_folder = pp_stitch_folder
 		self.pp_stitch_exec = pp_stitch_exec
-		with open(metadata_filename) as data_file:
-			self.metadata = json.loads(data_file.read())
+		# Without a stitch exec, the 360 images are projected on the CPU into an equirectangular panorama of this width
+		self.pp_panorama_width = pp_panorama_width
+		# Max. difference per colour channel for pixels to be made transparent in the overview screenshots
+		self.overview_key_tolerance = overview_key_tolerance
+		# Also write the separate (keyed) overview layers to disk
+		self.debug_overview_layers = debug_overview_layers
+		# Overview merging and 360 stitching run in a pool of pp_workers processes, while the game continues
+		self.pp_workers = pp_workers
+		self.pp_queue = None
+		# Frames are grabbed into memory, encoding and writing them happens in a pool of encoding_workers threads
+		self.capture_backend = capture_backend
+		self.screenshot_format = screenshot_format
+		self.encoding_workers = encoding_workers
+		self.encoder = None
+		# Time the game gets to render the frame after the camera changed, before we grab it
+		self.render_wait = render_wait
+		# Instead of the fixed render_wait, grab frames until they stop changing (or settle_timeout passed)
+		self.settle_detector = None
+		if settle_detection == True:
+			# Without a visible change, wait at least the render_wait before accepting unchanged frames (nothing confirms a click rendered, or any command without the console log)
+			self.settle_detector = capture.SettleDetector(threshold=settle_threshold, timeout=settle_timeout, change_timeout=render_wait)
+		self.settle_times = {}
+		# Shots that do not show the game (black, menu or welcome screen) are taken again, at most max_shot_retries times before the map fails
+		self.max_shot_retries = max_shot_retries
+		# While the game shows the loading screen, we wait (at most loading_timeout seconds) instead of using up the retries
+		self.loading_timeout = loading_timeout
+		# The state of every map and task is kept in the ledger, so an interrupted run continues where it stopped
+		if ledger_filename is None:
+			ledger_filename = '{}/ledger.sqlite'.format(screenshots_storage_dir)
+		self.ledger_filename = ledger_filename
+		self.max_map_attempts = max_map_attempts
+		self.retry_backoff = retry_backoff
+		self.ledger = None
+		# With multiple game instances (see capture_scheduler), the name of this instance, which claims maps from its own shard of the ledger
+		self.instance_name = instance_name
+		# Ask the user to check the setup before starting
+		self.interactive = interactive
+		# Map name => priority, maps with a higher priority (e.g. the most played) are processed first
+		self.map_priorities = map_priorities
+		# Post-processing jobs of the maps that did not finish yet
+		self.pp_maps = {}
+		self.pp_maps_lock = threading.Lock()
+		# Waiting for the written screenshots, metadata.json and checksums.json happen in the finishing stage, while the game loads the next map
+		self.finisher = None
+		self.stats = None
+		# Indexed and lazily decoded, only the maps we process are loaded
+		self.metadata = MetadataStore(metadata_filename)
 
 	def __getMapMetadata(self, map_name):
-		return self.metadata[map_name]
+		return self.metadata.get(map_name)
 
 	def __saveMetadataToFolder(self, map_name):
 		metadata = self.__getMapMetadata(map_name)
@@ -59,84 +116,341 @@ class GameMapRunner(object):
 			with open('{}/{}/metadata.json'.format(self.screenshots_storage_dir, map_name), 'w') as outfile:
 				json.dump(metadata, outfile)
 
+	def __saveSettleTimesToFolder(self, map_name, settle_times):
+		"""
+		Store how long every shot took to settle, to tune the settle detection and throughput.
+		"""
+		if len(settle_times) == 0:
+			return
+		seconds = [shot['seconds'] for shot in settle_times]
+		not_settled = len([shot for shot in settle_times if shot['settled'] == False])
+		print("Shots for '{}' settled in {:.2f}s on average (max. {:.2f}s), {} did not settle.".format(map_name, sum(seconds) / len(seconds), max(seconds), not_settled))
+		with open('{}/{}/settle_times.json'.format(self.screenshots_storage_dir, map_name), 'w') as outfile:
+			json.dump(settle_times, outfile)
+
 	# Stub, currently unused.
 	def __prepareForGame(self):
 		return
 		
 	def gatherScreenshotsBasedOnMetadata(self, metadata_filename, tasks):
-		self.__verifyUserCorrectSetup()
+		if self.interactive == True:
+			self.__verifyUserCorrectSetup()
+		if not os.path.exists(self.screenshots_storage_dir):
+			os.makedirs(self.screenshots_storage_dir)
+		# The scheduler of the instances adds the maps and recovers the ledger
+		self.ledger = JobLedger(self.ledger_filename, max_attempts=self.max_map_attempts, backoff=self.retry_backoff, recover=self.instance_name is None)
+		if self.instance_name is None:
+			self.ledger.addMaps(self.gc.getAllMapsInTFFolder(), self.map_priorities)
+		print("Maps per state in the ledger: {}".format(self.ledger.getSummary()))
 		self.gc.startupGame()
 		self.__prepareForGame()
-		i = 0
-		maps = self.gc.getNotProcessedMapsInTFFolder()
-		for map_name in maps:
+		self.pp_queue = post_processing.PostProcessingQueue(workers=self.pp_workers)
+		self.encoder = capture.EncodingPool(workers=self.encoding_workers, image_format=self.screenshot_format)
+		self.stats = map_pipeline.StageStats()
+		self.finisher = map_pipeline.BackgroundStage('finishing', self.stats)
+		while True:
+			map_name = self.__claimNextMap()
+			if map_name is None:
+				# Wait for failed maps that may be retried later, and maps that can still fail in post-processing
+				wait = self.ledger.getSecondsUntilRetry()
+				if wait is None:
+					with self.pp_maps_lock:
+						if len(self.pp_maps) == 0:
+							break
+					time.sleep(1)
+					continue
+				print("Waiting {:.0f} seconds to retry failed maps ...".format(wait))
+				# In steps, so an instance keeps sending heartbeats
+				time.sleep(min(wait, 10))
+				continue
 			metadata = self.__getMapMetadata(map_name)
 			if metadata == None:
 				print("Found a gamemap called '{}', but did not found metadata for this map, skipping this map.".format(map_name))
-			else:
-				print("Now starting to process map '{}' ({}/{})".format(map_name, i, len(maps)))
-				self.gc.changeMap(map_name)
-				if self.gc.isMapLoaded() == True:
-					self.gc.prepareMapForScreenshots(map_name)
-					# Execute the actual tasks
-					# Tasks with spectator cams
-					if GameMapRunner.TASK_SPECTATOR_CAMS in tasks:
-						take360 = False
-						if GameMapRunner.TASK_360_IMAGES in tasks:
-							take360 = True
-						self.__generateSpectatorScreenshotsForMaps(map_name, take360=take360)
-
-					# Generate a leveloverview.
-					if GameMapRunner.TASK_LEVELOVERVIEW in tasks:
-						self.__generateOverviewScreenshotsForMaps(map_name)
-
-					# Generate automatic Isometric images of the map.
-					if GameMapRunner.TASK_ISOMETRIC_CAMS in tasks:
-						raise FatalGameMapRunnerException("Task TASK_ISOMETRIC_CAMS not implemented yet.")
-
-
-					self.gc.prepareMapForUnload(map_name)
-					self.__saveMetadataToFolder(map_name)
-					time.sleep(1)
-				else:
-					print("Map '{}' could not be loaded.".format(map_name))
-					self.gc.killGame()
-					self.gc.startupGame()
-					self.__prepareForGame()
-			i += 1
+				self.ledger.skipMap(map_name, 'No metadata')
+				continue
+			if self.instance_name is None:
+				self.ledger.startMap(map_name)
+			print("Now starting to process map '{}' ({})".format(map_name, self.ledger.getSummary()))
+			with self.stats.measure('game'):
+				loaded = self.gc.changeMap(map_name) and self.gc.isMapLoaded() == True
+				if loaded:
+					with self.pp_maps_lock:
+						pp_map = {'pending' : 0, 'captured' : False, 'capture_error' : None, 'errors' : [], 'seconds' : 0.0, 'writes' : {}, 'tasks' : []}
+						self.pp_maps[map_name] = pp_map
+					try:
+						self.__runTasksForMap(map_name, tasks)
+					except FatalGameMapRunnerException:
+						raise
+					except Exception as e:
+						# The map fails once its running post-processing jobs finished, so a retry does not overlap with them
+						pp_map['capture_error'] = repr(e)
+					# The game continues with the next map, while the finishing stage waits for this one
+					self.finisher.submit(self.__finishMapCapture, (map_name, pp_map, self.settle_times.pop(map_name, [])))
+			if not loaded:
+				print("Map '{}' could not be loaded.".format(map_name))
+				self.ledger.failMap(map_name, 'Map could not be loaded')
+				self.gc.killGame()
+				self.gc.startupGame()
+				self.__prepareForGame()
+		# Wait for the last screenshots to be written, and the post-processing of the last maps
+		self.finisher.join()
+		self.encoder.close()
+		self.pp_queue.join()
 		self.gc.killGame()
+		self.__printUtilization()
+		print("Maps per state in the ledger: {}".format(self.ledger.getSummary()))
+		self.ledger.close()
 		self.__printFinished()
 
-	def __makeScreenshot(self, map_name, name):
+	def __claimNextMap(self):
+		if self.instance_name is None:
+			return self.ledger.getNextMap()
+		# Also tells the scheduler this instance is still healthy
+		self.ledger.heartbeat(self.instance_name, os.getpid())
+		return self.ledger.claimNextMap(self.instance_name)
+
+	def __getTasksToRun(self, map_name, tasks):
+		"""
+		Returns the ledger tasks of the map that did not finish in an earlier run.
+		"""
+		ledger_tasks = []
+		if GameMapRunner.TASK_SPECTATOR_CAMS in tasks:
+			ledger_tasks.append(JobLedger.TASK_SPECTATOR)
+			if GameMapRunner.TASK_360_IMAGES in tasks:
+				ledger_tasks.append(JobLedger.TASK_360)
+		if GameMapRunner.TASK_LEVELOVERVIEW in tasks:
+			ledger_tasks.append(JobLedger.TASK_OVERVIEW)
+		# The captures that are post-processed only exist in memory or as leftovers, redo them when their post-processing did not finish
+		if self.post_process == True and not self.ledger.isTaskDone(map_name, JobLedger.TASK_POST_PROCESS):
+			self.ledger.resetTasks(map_name, [JobLedger.TASK_360, JobLedger.TASK_OVERVIEW])
+		return [task for task in ledger_tasks if not self.ledger.isTaskDone(map_name, task)]
+
+	def __runTasksForMap(self, map_name, tasks):
+		# Generate automatic Isometric images of the map.
+		if GameMapRunner.TASK_ISOMETRIC_CAMS in tasks:
+			raise FatalGameMapRunnerException("Task TASK_ISOMETRIC_CAMS not implemented yet.")
+
+		ledger_tasks = self.__getTasksToRun(map_name, tasks)
+		if self.post_process == True:
+			self.ledger.startTask(map_name, JobLedger.TASK_POST_PROCESS)
+		self.gc.prepareMapForScreenshots(map_name)
+		# Execute the actual tasks
+		# Tasks with spectator cams
+		if JobLedger.TASK_SPECTATOR in ledger_tasks or JobLedger.TASK_360 in ledger_tasks:
+			self.__runTask(map_name, [task for task in [JobLedger.TASK_SPECTATOR, JobLedger.TASK_360] if task in ledger_tasks], self.__generateSpectatorScreenshotsForMaps,
+							(map_name, JobLedger.TASK_SPECTATOR in ledger_tasks, JobLedger.TASK_360 in ledger_tasks))
+
+		# Generate a leveloverview.
+		if JobLedger.TASK_OVERVIEW in ledger_tasks:
+			self.__runTask(map_name, [JobLedger.TASK_OVERVIEW], self.__generateOverviewScreenshotsForMaps, (map_name,))
+
+		self.gc.prepareMapForUnload(map_name)
+
+	def __runTask(self, map_name, ledger_tasks, function, args):
+		start = time.time()
+		for task in ledger_tasks:
+			self.ledger.startTask(map_name, task)
+		try:
+			function(*args)
+		except Exception as e:
+			for task in ledger_tasks:
+				self.ledger.failTask(map_name, task, repr(e), time.time() - start)
+			raise
+		if self.instance_name is not None:
+			self.ledger.heartbeat(self.instance_name, os.getpid())
+		# The tasks are done once their screenshots are written, in the finishing stage
+		self.pp_maps[map_name]['tasks'].append((ledger_tasks, time.time() - start))
+
+	def __waitForWrites(self, writes):
+		"""
+		Returns whether all screenshots were written.
+		"""
+		return all([write.get() is not None for write in writes])
+
+	def __finishMapCapture(self, map_name, pp_map, settle_times):
+		"""
+		Finishing stage: wait for the screenshots of the map, and store its metadata.
+		"""
+		if not self.__waitForWrites(pp_map['writes'].values()) and pp_map['capture_error'] is None:
+			pp_map['capture_error'] = 'Failed to write screenshots'
+		for (ledger_tasks, seconds) in pp_map['tasks']:
+			for task in ledger_tasks:
+				if pp_map['capture_error'] is None:
+					self.ledger.finishTask(map_name, task, seconds)
+				else:
+					self.ledger.failTask(map_name, task, pp_map['capture_error'], seconds)
+		if pp_map['capture_error'] is None:
+			self.__saveMetadataToFolder(map_name)
+			self.__saveSettleTimesToFolder(map_name, settle_times)
+		# The map is finished once its post-processing is
+		with self.pp_maps_lock:
+			pp_map['captured'] = True
+		self.__finishMapIfProcessed(map_name, pp_map)
+
+	def __submitPostProcessing(self, map_name, name, function, args, writes=None):
+		"""
+		Queue a post-processing job for the map. With writes, the job is queued by the finishing stage, once those screenshots are written.
+		"""
+		with self.pp_maps_lock:
+			pp_map = self.pp_maps[map_name]
+			pp_map['pending'] += 1
+		if writes is None:
+			self.pp_queue.submit(name, function, args, on_finished=lambda job: self.__onPostProcessingFinished(map_name, pp_map, job))
+		else:
+			self.finisher.submit(self.__submitPostProcessingAfterWrites, (map_name, pp_map, name, function, args, writes))
+
+	def __submitPostProcessingAfterWrites(self, map_name, pp_map, name, function, args, writes):
+		if not self.__waitForWrites(writes):
+			self.__onPostProcessingFinished(map_name, pp_map, {'name' : name, 'status' : post_processing.PostProcessingQueue.STATUS_FAILED, 'seconds' : 0.0})
+			return
+		self.pp_queue.submit(name, function, args, on_finished=lambda job: self.__onPostProcessingFinished(map_name, pp_map, job))
+
+	def __onPostProcessingFinished(self, map_name, pp_map, job):
+		with self.pp_maps_lock:
+			pp_map['pending'] -= 1
+			pp_map['seconds'] += job['seconds']
+			if job['status'] == post_processing.PostProcessingQueue.STATUS_FAILED:
+				pp_map['errors'].append('{} failed'.format(job['name']))
+		self.__finishMapIfProcessed(map_name, pp_map)
+
+	def __finishMapIfProcessed(self, map_name, pp_map):
+		with self.pp_maps_lock:
+			if pp_map['captured'] == False or pp_map['pending'] > 0 or pp_map.get('completing') == True:
+				return
+			pp_map['completing'] = True
+		self.finisher.submit(self.__completeMap, (map_name, pp_map))
+
+	def __completeMap(self, map_name, pp_map):
+		"""
+		Finishing stage: store the checksums of the output and update the ledger, once the map is captured and post-processed.
+		"""
+		try:
+			self.__updateLedgerForMap(map_name, pp_map)
+		finally:
+			# Only now the map can be retried, or the run can end
+			with self.pp_maps_lock:
+				if self.pp_maps.get(map_name) is pp_map:
+					del self.pp_maps[map_name]
+
+	def __updateLedgerForMap(self, map_name, pp_map):
+		if pp_map['capture_error'] is not None:
+			self.ledger.failMap(map_name, pp_map['capture_error'])
+			return
+		if self.post_process == True:
+			if len(pp_map['errors']) > 0:
+				self.ledger.failTask(map_name, JobLedger.TASK_POST_PROCESS, ', '.join(pp_map['errors']), pp_map['seconds'])
+				self.ledger.failMap(map_name, ', '.join(pp_map['errors']))
+				return
+			self.ledger.finishTask(map_name, JobLedger.TASK_POST_PROCESS, pp_map['seconds'])
+		self.__saveChecksumsToFolder(map_name)
+		self.ledger.finishMap(map_name)
+
+	def __saveChecksumsToFolder(self, map_name):
+		map_dir = '{}/{}'.format(self.screenshots_storage_dir, map_name)
+		filenames = [os.path.join(map_dir, name) for name in sorted(os.listdir(map_dir)) if name != 'checksums.json']
+		digests = FileFingerprinter(workers=self.encoding_workers).getDigests(filenames)
+		with open('{}/checksums.json'.format(map_dir), 'w') as outfile:
+			json.dump(dict((os.path.basename(filename), digest) for (filename, digest) in digests.items()), outfile, sort_keys=True)
+
+	def __printUtilization(self):
+		self.stats.add('encoding', self.encoder.busy_seconds, self.encoder.encoded)
+		self.stats.setWorkers('encoding', self.encoding_workers)
+		for job in self.pp_queue.getStatus():
+			if job['seconds'] is not None:
+				self.stats.add('post-processing', job['seconds'])
+		self.stats.setWorkers('post-processing', self.pp_workers)
+		self.stats.printReport()
+
+	def __getScreenshotFilename(self, map_name, name):
+		return '{}/{}/{}.{}'.format(self.screenshots_storage_dir, map_name, name, self.encoder.getExtension())
+
+	def __makeScreenshot(self, map_name, name, save=True, check_state=True):
+		"""
+		Take a screenshot, which is returned as an image and queued to be stored on disk unless save is False.
+		With check_state, shots that do not show the game are waited for (loading screen) or taken again.
+		"""
 		dir_check = '{}/{}/'.format(self.screenshots_storage_dir, map_name)
 		if not os.path.exists(dir_check):
 			os.makedirs(dir_check)
-		pyautogui.screenshot('{}/{}/{}.png'.format(self.screenshots_storage_dir, map_name, name))
-		time.sleep(1)
+		attempt = 0
+		loading_deadline = None
+		while True:
+			image = self.__grabFrame(map_name, name)
+			if check_state == False:
+				break
+			state = self.gc.screen_classifier.classify(image)
+			if state == ScreenStateClassifier.STATE_IN_GAME:
+				break
+			if state == ScreenStateClassifier.STATE_LOADING:
+				if loading_deadline is None:
+					print("Screenshot '{}' for '{}' shows the loading screen, waiting for the game.".format(name, map_name))
+					loading_deadline = time.time() + self.loading_timeout
+				if time.time() < loading_deadline:
+					time.sleep(0.5)
+					continue
+			attempt += 1
+			print("Screenshot '{}' for '{}' shows the {} screen ({}/{}).".format(name, map_name, state, attempt, self.max_shot_retries + 1))
+			if attempt > self.max_shot_retries:
+				# Fails the map, so the ledger captures it again instead of keeping a shot of the wrong screen
+				raise Exception("Screenshot '{}' for '{}' still shows the {} screen after {} attempts.".format(name, map_name, state, attempt))
+		if save == True:
+			filename = self.__getScreenshotFilename(map_name, name)
+			self.pp_maps[map_name]['writes'][filename] = self.encoder.save(image, filename)
 		print("Made screenshot '{}' for '{}'.".format(name, map_name))
-		return
-
-	def __generateSpectatorScreenshotsForMaps(self, map_name, take360):
+		return image
+
+	def __grabFrame(self, map_name, name):
+		if self.settle_detector is None:
+			time.sleep(self.render_wait)
+			return self.capture_backend.grab()
+		(image, seconds, settled) = self.settle_detector.waitForSettle(self.capture_backend)
+		self.settle_times.setdefault(map_name, []).append({'name' : name, 'seconds' : round(seconds, 3), 'settled' : settled})
+		if settled == False:
+			print("Screenshot '{}' for '{}' did not settle within {} seconds.".format(name, map_name, self.settle_detector.timeout))
+		return image
+
+	def __generateSpectatorScreenshotsForMaps(self, map_name, take_spectator, take360):
 		self.gc.prepareForSpectatorScreenshots()
 		# Loop through spectator cams
 		metadata = self.__getMapMetadata(map_name)
-		for x in range(0, len(metadata['cameras'])):
-			self.__makeScreenshot(map_name, '{}_{}'.format('spectator', x))
-			time.sleep(1)
-
-			if take360 == True and x < self.max_360_spec_cams:
+		(spectator_cams, cams_360) = self.__getPlannedCameras(metadata)
+		if take_spectator == False:
+			spectator_cams = set()
+		if take360 == False:
+			cams_360 = set()
+		planned_cams = spectator_cams | cams_360
+		if len(planned_cams) < len(metadata['cameras']):
+			print("Capturing {} of the {} spectator cams of '{}'.".format(len(planned_cams), len(metadata['cameras']), map_name))
+		# No need to cycle past the last planned camera
+		last_cam = max(planned_cams) if len(planned_cams) > 0 else -1
+		for x in range(0, last_cam + 1):
+			if x in spectator_cams:
+				self.__makeScreenshot(map_name, '{}_{}'.format('spectator', x))
+
+			if x in cams_360:
 				self.__generateBoxScreenshotsForMaps(map_name, spec_cam=x)
-				time.sleep(1)
+			# The game cycles through the cameras in order
 			self.gc.clickScreen()
-			time.sleep(1.2)
+
+	def __getPlannedCameras(self, metadata):
+		"""
+		Returns the indices of the cameras to take a spectator screenshot and a 360 image of.
+		Metadata without a shot plan (older than METADATA_VERSION 2) uses every camera, and the first cameras for the 360 images.
+		"""
+		if self.use_shot_plan == True and 'shotPlan' in metadata:
+			shot_plan = metadata['shotPlan']
+			return (set(shot_plan['spectator']), set(shot_plan['360'][:self.max_360_spec_cams]))
+		return (set(range(0, len(metadata['cameras']))), set(range(0, min(self.max_360_spec_cams, len(metadata['cameras'])))))
 
 	def __makeBoxScreenshotAndSave(self, map_name, image_name, setang_args):
-		self.gc.openConsoleAndCmd(['setang_exact {}'.format(setang_args)])
+		self.gc.setAngles(setang_args)
 		self.__makeScreenshot(map_name, image_name)
 
 	def __generateBoxScreenshotsForMaps(self, map_name, spec_cam):
 		self.gc.prepareForBoxScreenshots()
 		images = []
+		# (pitch, yaw) of every image
+		angles = []
 		# MOST COMPLETE OF IMAGES, BUT SLOW
 		# for x in [0, 45, 90, 135, 180, 225, 270, 315]:
 		# 	for y in [-60, -30, 0, 30, 60]:
@@ -145,117 +459,65 @@ class GameMapRunner(object):
 			for y in [-60, -30, 0, 30, 60]:
 				image_name = '{}_{}_{}_{}'.format('box', spec_cam, x, y)
 				images.append(image_name)
+				angles.append((y, x))
 				self.__makeBoxScreenshotAndSave(map_name, image_name, '{} {} 0'.format(y, x))
 
 		# Bottom / top
 		image_name = '{}_{}_bottom'.format('box', spec_cam)
 		images.append(image_name)
-		self.__makeBoxScreenshotAndSave(map_name, image_name, '90 0 0'.format(y, x))
+		angles.append((90, 0))
+		self.__makeBoxScreenshotAndSave(map_name, image_name, '90 0 0')
 
 		image_name = '{}_{}_top'.format('box', spec_cam)
 		images.append(image_name)
-		self.__makeBoxScreenshotAndSave(map_name, image_name, '-90 0 0'.format(y, x))
+		angles.append((-90, 0))
+		self.__makeBoxScreenshotAndSave(map_name, image_name, '-90 0 0')
 
 		if self.post_process == True:
-			t = threading.Thread(target=stitch360Image, args=[map_name, images, spec_cam])
-			t.start()
+			self.__stitch360Image(map_name, images, angles, spec_cam)
 
-	def stitch360Image(self, map_name, images, spec_cam):
+	def __stitch360Image(self, map_name, images, angles, spec_cam):
+		output_filename = '{}/{}/360_spec{}.jpg'.format(self.screenshots_storage_dir, map_name, spec_cam)
+		image_filenames = [self.__getScreenshotFilename(map_name, image) for image in images]
+		# The stitcher reads the box screenshots from disk, so it is queued once they are written
+		writes = [self.pp_maps[map_name]['writes'][filename] for filename in image_filenames]
 		if self.pp_stitch_exec == None:
-			print("Skipping the 360 image stitching, as no Exec has been set.")
+			# Project with the known angles on the CPU
+			self.__submitPostProcessing(map_name, '360 projection {} spec {}'.format(map_name, spec_cam), post_processing.projectEquirectangular, (image_filenames, angles, output_filename, self.pp_panorama_width, None, self.delete_leftover_images), writes)
 			return
-		cwd = os.getcwd()
-		os.chdir(self.pp_stitch_folder)
-
-		output_filename = '{}/{}/360_spec{}.jpg'.format(self.screenshots_storage_dir, map_name, spec_cam)
-
-		cmd = ['primusrun', self.pp_stitch_exec, '-GPU', 'Default', output_filename]
-		cmd_args = []
-		for image in images:
-			cmd_args.append('{}/{}/{}.png'.format(self.screenshots_storage_dir, map_name, image))
-		cmd.extend(cmd_args)
-
-		print(' '.join(cmd))
-
-		process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-		output, error = process.communicate()
-		print(output)
-
-		# Check if the output is more than just one pixel
-		if os.path.getsize(output_filename) < 1024:
-			os.remove(output_filename)
-		os.chdir(cwd)
-
-		if self.delete_leftover_images == True:
-			for image in images:
-				filename = '{}/{}/{}.png'.format(self.screenshots_storage_dir, map_name, image)
-				os.remove(filename)
+		self.__submitPostProcessing(map_name, '360 stitch {} spec {}'.format(map_name, spec_cam), post_processing.stitch360Image, (self.pp_stitch_exec, self.pp_stitch_folder, image_filenames, output_filename, self.delete_leftover_images), writes)
 
-	def __generateOverviewScreenshotsForMaps(map_name):
+	def __generateOverviewScreenshotsForMaps(self, map_name):
 		self.gc.prepareForOverviewScreenshots()
 		metadata = self.__getMapMetadata(map_name)
 
 		pos = metadata['dimensions'][3]
 		scale = metadata['dimensions'][2]['scale']
+		# The separate layers are only written to disk when they are not merged, or for debugging
+		save_layers = self.post_process == False or self.debug_overview_layers == True
+		frames = []
 		i = 0
 		for y in [-1500, -1000, 0, 400, 900]:
 			ypos = pos["z"]+y
 			if ypos < 0:
 				ypos = 0
-			this.gc.setCorrectOverview(pos, ypos, scale)
-			this.__makeScreenshot(map_name, '{}_{}'.format('overview', i))
+			self.gc.setCorrectOverview(pos, ypos, scale)
+			# The void around the map is black, which is expected in an overview
+			frames.append(self.__makeScreenshot(map_name, '{}_{}'.format('overview', i), save=save_layers, check_state=False))
 			i += 1
 
 		if self.post_process == True:
-			this.__mergeOverviewScreenshots(map_name)
+			self.__mergeOverviewScreenshots(map_name, frames)
 
-	def __mergeOverviewScreenshots(self, map_name):
-		full_path_overviews = sorted(glob.glob('{}/{}/overview_*.png'.format(self.screenshots_storage_dir, map_name)))
-		overviews_to_merge = []
-
-		# Make the images transparant and elect the best images
-		# This is required to prevent green screenshots from merging into the image
-		# However, make sure at least 0..Z_POS_CENTER+1 is being used, Z_POS_CENTER = 3
-		i = 0
-		for overview_image in full_path_overviews:
-			top_left_pixel = self.__convertImageToTopLeftPixelTransparency(overview_image)
-			if (top_left_pixel[0] == 0 and top_left_pixel[1] == 0 and top_left_pixel[2] == 0) or (i < 3):
-				overviews_to_merge.append(overview_image)
-			i += 1
-
-		# Merge layers
-		background = Image.open(full_path_overviews[0])
-		for overview_image in overviews_to_merge:
-			if overview_image is not full_path_overviews[0]:
-				overlay = Image.open(overview_image)
-				background.paste(overlay, (0, 0))
-			
-		background.save('{}/{}/overview_merged.png'.format(self.screenshots_storage_dir, map_name), "PNG")
-
-		if self.delete_leftover_images == True:
-			for overview_image in full_path_overviews:
-				if 'overview_merged' not in overview_image:
-					os.remove(overview_image)
-
-	def __convertImageToTopLeftPixelTransparency(self, image_path):
-		img = Image.open(image_path)
-		img = img.convert("RGBA")
-		datas = img.getdata()
-
-		newData = []
-		top_left_pixel = datas[0]
-		for item in datas:
-			# Remove green anti-aliasing
-			if item[0] == 39 and item[1] == 190 and item[2] == 36:
-				newData.append((0, 0, 0, 0))
-			elif item[0] == top_left_pixel[0] and item[1] == top_left_pixel[1] and item[2] == top_left_pixel[2]:
-				newData.append((0, 0, 0, 0))
-			else:
-				newData.append(item)
-
-		img.putdata(newData)
-		img.save(image_path, "PNG")
-		return newData[0]
+	def __mergeOverviewScreenshots(self, map_name, frames):
+		"""
+		Key and merge the overview frames in memory in the post-processing queue, only the merged image is encoded.
+		"""
+		debug_layer_filename = None
+		if self.debug_overview_layers == True:
+			debug_layer_filename = '{}/{}/overview_{{}}_keyed.png'.format(self.screenshots_storage_dir, map_name)
+		output_filename = '{}/{}/overview_merged.png'.format(self.screenshots_storage_dir, map_name)
+		self.__submitPostProcessing(map_name, 'overview {}'.format(map_name), post_processing.mergeOverviewFrames, (frames, output_filename, self.overview_key_tolerance, debug_layer_filename))
 
 	def __verifyUserCorrectSetup(self):
 		print("="*100)
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import os, json
+import numpy as np
+from PIL import Image
+
+class ScreenStateClassifier(object):
+	"""
+	Tells what the game is showing (main menu, welcome screen, in-game, loading, black) from a captured frame in a few milliseconds.
+
+	Instead of searching the whole screen for the reference images, only the small region where a reference is shown is compared.
+	Both are reduced to a small colour thumbnail (the signature), which matches when the mean absolute difference (0-255) is at most threshold,
+	and the brightness patterns correlate by at least min_correlation (so a region with just the same average colour does not match).
+	References without a known position are located once with calibrate(), on a frame that shows them.
+	The loading screen is recognized by its reference as well, which is only used when LOADING_REFERENCE (a crop of the loading screen, e.g. around its progress bar) is placed next to the other references,
+	or added with addReference. Without it, frames are never classified as loading.
+	"""
+
+	STATE_MENU 		= 'menu'
+	STATE_WELCOME 	= 'welcome'
+	STATE_LOADING 	= 'loading'
+	STATE_IN_GAME 	= 'in-game'
+	STATE_BLACK 	= 'black'
+
+	# States in which the map is loaded
+	LOADED_STATES 	= [STATE_WELCOME, STATE_IN_GAME]
+
+	REFERENCE_DIR 	= os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	LOADING_REFERENCE 	= 'map_loading_screen.png'
+
+	def __init__(self, threshold=20.0, min_correlation=0.8, black_level=8.0, signature_scale=4, positions_filename=None):
+		"""
+		Contructor
+		"""
+		self.threshold = threshold
+		self.min_correlation = min_correlation
+		# Frames with a mean brightness below black_level (0-255) are black
+		self.black_level = black_level
+		# Signatures are the reference size divided by signature_scale
+		self.signature_scale = signature_scale
+		# Calibrated positions are stored, so the next run does not have to locate them again
+		self.positions_filename = positions_filename
+		self.references = []
+		self.addReference(ScreenStateClassifier.STATE_MENU, os.path.join(ScreenStateClassifier.REFERENCE_DIR, 'menu_find_game.png'))
+		# The continue button, which the coordinator clicks at (1651, 1025) on 1920x1080
+		self.addReference(ScreenStateClassifier.STATE_WELCOME, os.path.join(ScreenStateClassifier.REFERENCE_DIR, 'map_loaded_welcome_screen.png'), (1517, 1006))
+		# Located with calibrate() while a map loads
+		loading_reference = os.path.join(ScreenStateClassifier.REFERENCE_DIR, ScreenStateClassifier.LOADING_REFERENCE)
+		if os.path.exists(loading_reference):
+			self.addReference(ScreenStateClassifier.STATE_LOADING, loading_reference)
+		if positions_filename is not None and os.path.exists(positions_filename):
+			with open(positions_filename) as data_file:
+				positions = json.load(data_file)
+			for reference in self.references:
+				if reference['state'] in positions:
+					reference['position'] = tuple(positions[reference['state']])
+
+	def addReference(self, state, filename, position=None):
+		"""
+		Classify frames as state when they show the reference image (a filename or an image) at position (left, top), e.g. to add a loading screen.
+		"""
+		image = filename if isinstance(filename, Image.Image) else Image.open(filename)
+		image = image.convert('RGB')
+		self.references.append({
+			'state' : state,
+			'image' : image,
+			'size' : image.size,
+			'position' : position,
+			'signature' : self.__getSignature(image, image.size),
+		})
+
+	def calibrate(self, frame, state):
+		"""
+		Locate the reference of state on a frame that shows it (a full-screen search), returns whether it was found.
+		"""
+		import pyautogui
+		for reference in self.references:
+			if reference['state'] != state:
+				continue
+			location = pyautogui.locate(reference['image'], frame.convert('RGB'), grayscale=True)
+			if location is None:
+				print("Could not locate the {} reference on screen.".format(state))
+				return False
+			reference['position'] = (int(location[0]), int(location[1]))
+			print("Located the {} reference at {}.".format(state, reference['position']))
+			self.__savePositions()
+			return True
+		return False
+
+	def classify(self, frame):
+		if self.isBlack(frame):
+			return ScreenStateClassifier.STATE_BLACK
+		for reference in self.references:
+			if reference['position'] is None:
+				continue
+			(left, top) = reference['position']
+			(width, height) = reference['size']
+			if left + width > frame.size[0] or top + height > frame.size[1]:
+				continue
+			region = frame.crop((left, top, left + width, top + height)).convert('RGB')
+			if self.__isMatch(self.__getSignature(region, reference['size']), reference['signature']):
+				return reference['state']
+		return ScreenStateClassifier.STATE_IN_GAME
+
+	def isBlack(self, frame):
+		return float(self.__getThumbnail(frame).mean()) < self.black_level
+
+	def isMapLoaded(self, frame):
+		return self.classify(frame) in ScreenStateClassifier.LOADED_STATES
+
+	def __getThumbnail(self, frame):
+		return np.asarray(frame.convert('L').resize((32, 18), Image.BILINEAR), dtype=np.float32)
+
+	def __getSignature(self, image, size):
+		signature_size = (max(1, size[0] // self.signature_scale), max(1, size[1] // self.signature_scale))
+		return np.asarray(image.resize(signature_size, Image.BILINEAR), dtype=np.float32)
+
+	def __isMatch(self, signature, reference_signature):
+		if float(np.mean(np.abs(signature - reference_signature))) > self.threshold:
+			return False
+		brightness = signature.mean(axis=2).ravel()
+		reference_brightness = reference_signature.mean(axis=2).ravel()
+		brightness = brightness - brightness.mean()
+		reference_brightness = reference_brightness - reference_brightness.mean()
+		norm = np.sqrt(np.sum(brightness ** 2) * np.sum(reference_brightness ** 2))
+		if norm == 0:
+			return False
+		return float(np.sum(brightness * reference_brightness) / norm) >= self.min_correlation
+
+	def __savePositions(self):
+		if self.positions_filename is None:
+			return
+		positions = {}
+		for reference in self.references:
+			if reference['position'] is not None:
+				positions[reference['state']] = reference['position']
+		with open(self.positions_filename, 'w') as outfile:
+			json.dump(positions, outfile)
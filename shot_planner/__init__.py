@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+import math
+import numpy as np
+
+class ShotPlanner(object):
+	"""
+	Plans which spectator cameras of a map are worth a screenshot, based on their origins, angles and teams.
+
+	Cameras that are placed at (almost) the same spot looking the same way, and cameras that mirror each other on the other team's side of a symmetric map,
+	are clustered with the first camera they duplicate, and only that first camera per cluster is planned. The symmetry of the map (rotated or mirrored around its center) is detected from the spawn points of both teams.
+	The remaining cameras are ordered by how much they add: starting from the most central camera, the camera farthest from all cameras picked before comes next.
+	Within the time_budget (seconds per map), spectator shots are planned first, and the 360 images with the remaining time (at most max_360_cams).
+	"""
+
+	SYMMETRY_ROTATION 	= 'rotation'
+	SYMMETRY_MIRROR_X 	= 'mirror-x'
+	SYMMETRY_MIRROR_Y 	= 'mirror-y'
+
+	# Team numbers of info_observer_point, 0 means the camera is available for both teams
+	TEAM_ANY 	= 0
+	TEAM_RED 	= 2
+	TEAM_BLUE 	= 3
+
+	# Screenshots per 360 image, see GameMapRunner.__generateBoxScreenshotsForMaps
+	SHOTS_PER_360 = 22
+
+	def __init__(self, distance_tolerance=192.0, angle_tolerance=25.0, symmetry_tolerance=128.0, seconds_per_shot=3.0, time_budget=None, max_360_cams=2):
+		"""
+		Contructor
+		"""
+		self.distance_tolerance = distance_tolerance
+		self.angle_tolerance = angle_tolerance
+		self.symmetry_tolerance = symmetry_tolerance
+		self.seconds_per_shot = seconds_per_shot
+		self.time_budget = time_budget
+		self.max_360_cams = max_360_cams
+
+	def getOptions(self):
+		"""
+		The options that change the plan, for the metadata cache key.
+		"""
+		return {'distanceTolerance' : self.distance_tolerance, 'angleTolerance' : self.angle_tolerance, 'symmetryTolerance' : self.symmetry_tolerance,
+				'secondsPerShot' : self.seconds_per_shot, 'timeBudget' : self.time_budget, 'max360Cams' : self.max_360_cams}
+
+	def plan(self, cameras, spawn_points=()):
+		"""
+		Returns the shot plan for the cameras (entity dicts with origin, angles and TeamNum), indices refer to the order of the cameras:
+		- spectator: the cameras to take a screenshot of, in camera order.
+		- 360: the cameras to make a 360 image of, most informative first.
+		- clusters: every camera in exactly one cluster, the first camera of a cluster is the one in the plan.
+		- symmetry: the symmetries that were detected for the map.
+		- estimatedSeconds: the estimated capture time of the plan.
+		"""
+		(origins, directions, teams) = self.__parseCameras(cameras)
+		symmetries = self.__detectSymmetries(spawn_points)
+		clusters = self.__clusterCameras(origins, directions, teams, symmetries)
+		order = self.__orderByCoverage(origins, [cluster[0] for cluster in clusters])
+
+		shot_seconds = self.seconds_per_shot
+		seconds_360 = self.seconds_per_shot * ShotPlanner.SHOTS_PER_360
+		spectator = []
+		seconds = 0.0
+		for index in order:
+			# At least one shot for every map, also when it does not fit the budget
+			if len(spectator) > 0 and not self.__fitsBudget(seconds + shot_seconds):
+				break
+			spectator.append(index)
+			seconds += shot_seconds
+		cams_360 = []
+		for index in order:
+			if len(cams_360) >= self.max_360_cams or not self.__fitsBudget(seconds + seconds_360):
+				break
+			cams_360.append(index)
+			seconds += seconds_360
+
+		return {
+			'spectator' : sorted(spectator),
+			'360' : cams_360,
+			'clusters' : clusters,
+			'symmetry' : [symmetry for (symmetry, center) in symmetries],
+			'estimatedSeconds' : round(seconds, 1),
+		}
+
+	def __fitsBudget(self, seconds):
+		return self.time_budget is None or seconds <= self.time_budget
+
+	def __parseCameras(self, cameras):
+		"""
+		Returns the origins (N, 3), view directions (N, 3) and teams (N) of the cameras, cameras without a (valid) origin get NaN coordinates.
+		Malformed angles are reported and taken as 0 0 0.
+		"""
+		origins = np.full((len(cameras), 3), np.nan)
+		directions = np.zeros((len(cameras), 3))
+		teams = np.zeros(len(cameras), dtype=np.int32)
+		for (i, camera) in enumerate(cameras):
+			if 'origin' in camera:
+				origin = self.__parseVector(camera['origin'])
+				if origin is None:
+					print("Ignoring the malformed origin '{}' of camera {}.".format(camera['origin'], i))
+				else:
+					origins[i] = origin
+			angles = self.__parseVector(camera.get('angles', '0 0 0'))
+			if angles is None:
+				print("Ignoring the malformed angles '{}' of camera {}.".format(camera['angles'], i))
+				angles = [0.0, 0.0, 0.0]
+			(pitch, yaw) = angles[:2]
+			directions[i] = self.__getDirection(pitch, yaw)
+			teams[i] = self.__parseTeam(camera)
+		return (origins, directions, teams)
+
+	def __parseVector(self, value):
+		"""
+		Returns [x, y, z] of an "x y z" string or the parsed tuple of a compact entity, or None when the value is not three numbers.
+		"""
+		try:
+			if not isinstance(value, (list, tuple)):
+				value = value.split()
+			vector = [float(part) for part in value]
+		except (ValueError, TypeError, AttributeError):
+			return None
+		if len(vector) != 3 or not all(np.isfinite(vector)):
+			return None
+		return vector
+
+	def __parseTeam(self, entity):
+		try:
+			return int(entity.get('TeamNum', ShotPlanner.TEAM_ANY))
+		except ValueError:
+			return ShotPlanner.TEAM_ANY
+
+	def __getDirection(self, pitch, yaw):
+		# Source engine angles, a positive pitch looks down
+		(pitch, yaw) = (math.radians(pitch), math.radians(yaw))
+		return (math.cos(pitch) * math.cos(yaw), math.cos(pitch) * math.sin(yaw), -math.sin(pitch))
+
+	def __detectSymmetries(self, spawn_points):
+		"""
+		Returns (symmetry, center) for every symmetry that maps the red spawn points onto the blue ones, the center being halfway between both teams.
+		"""
+		spawns = {ShotPlanner.TEAM_RED : [], ShotPlanner.TEAM_BLUE : []}
+		for spawn_point in spawn_points:
+			team = self.__parseTeam(spawn_point)
+			if team in spawns and 'origin' in spawn_point:
+				origin = self.__parseVector(spawn_point['origin'])
+				# A spawn point with a malformed origin does not tell anything about the symmetry
+				if origin is not None:
+					spawns[team].append(origin)
+		if len(spawns[ShotPlanner.TEAM_RED]) == 0 or len(spawns[ShotPlanner.TEAM_BLUE]) == 0:
+			return []
+		red = np.array(spawns[ShotPlanner.TEAM_RED])
+		blue = np.array(spawns[ShotPlanner.TEAM_BLUE])
+		center = (red.mean(axis=0) + blue.mean(axis=0)) / 2.0
+		symmetries = []
+		for symmetry in [ShotPlanner.SYMMETRY_ROTATION, ShotPlanner.SYMMETRY_MIRROR_X, ShotPlanner.SYMMETRY_MIRROR_Y]:
+			(mirrored, directions) = self.__transform(symmetry, center, red, np.zeros(red.shape))
+			# Distance of every mirrored red spawn to the nearest blue spawn
+			distances = np.sqrt(((mirrored[:, np.newaxis, :] - blue[np.newaxis, :, :]) ** 2).sum(axis=2)).min(axis=1)
+			if distances.mean() <= self.symmetry_tolerance:
+				symmetries.append((symmetry, center))
+		return symmetries
+
+	def __transform(self, symmetry, center, origins, directions):
+		origins = origins.copy()
+		directions = directions.copy()
+		if symmetry in [ShotPlanner.SYMMETRY_ROTATION, ShotPlanner.SYMMETRY_MIRROR_X]:
+			origins[:, 0] = 2 * center[0] - origins[:, 0]
+			directions[:, 0] = -directions[:, 0]
+		if symmetry in [ShotPlanner.SYMMETRY_ROTATION, ShotPlanner.SYMMETRY_MIRROR_Y]:
+			origins[:, 1] = 2 * center[1] - origins[:, 1]
+			directions[:, 1] = -directions[:, 1]
+		return (origins, directions)
+
+	def __getMatches(self, origins, directions, other_origins, other_directions):
+		"""
+		Returns an (N, N) matrix, True where camera i (in the first set) is a near-duplicate of camera j (in the other set).
+		"""
+		distances = np.sqrt(((origins[:, np.newaxis, :] - other_origins[np.newaxis, :, :]) ** 2).sum(axis=2))
+		cosines = np.clip((directions[:, np.newaxis, :] * other_directions[np.newaxis, :, :]).sum(axis=2), -1.0, 1.0)
+		with np.errstate(invalid='ignore'):
+			return (distances <= self.distance_tolerance) & (cosines >= math.cos(math.radians(self.angle_tolerance)))
+
+	def __clusterCameras(self, origins, directions, teams, symmetries):
+		count = len(origins)
+		matches = self.__getMatches(origins, directions, origins, directions)
+		for (symmetry, center) in symmetries:
+			(mirrored_origins, mirrored_directions) = self.__transform(symmetry, center, origins, directions)
+			# The mirror image of a camera of one team is a camera of the other team (or of both)
+			other_team = (teams[:, np.newaxis] != teams[np.newaxis, :]) | (teams[:, np.newaxis] == ShotPlanner.TEAM_ANY) | (teams[np.newaxis, :] == ShotPlanner.TEAM_ANY)
+			matches |= self.__getMatches(mirrored_origins, mirrored_directions, origins, directions) & other_team
+		# Every camera joins the first cluster whose representative (its first camera) it duplicates, or starts a new one.
+		# Comparing with the representative only, instead of linking pairs, keeps a row of closely spaced cameras from collapsing into one cluster.
+		clusters = []
+		for i in range(count):
+			for cluster in clusters:
+				if matches[i, cluster[0]] or matches[cluster[0], i]:
+					cluster.append(i)
+					break
+			else:
+				clusters.append([i])
+		return clusters
+
+	def __orderByCoverage(self, origins, candidates):
+		"""
+		Farthest point ordering of the candidate cameras: the most central camera first, then every time the camera farthest from the ones picked before.
+		Cameras without an origin come last.
+		"""
+		known = [index for index in candidates if not np.isnan(origins[index]).any()]
+		unknown = [index for index in candidates if np.isnan(origins[index]).any()]
+		if len(known) == 0:
+			return unknown
+		points = origins[known]
+		first = int(np.argmin(((points - points.mean(axis=0)) ** 2).sum(axis=1)))
+		order = [first]
+		nearest = np.sqrt(((points - points[first]) ** 2).sum(axis=1))
+		while len(order) < len(known):
+			nearest[order] = -1
+			next_point = int(np.argmax(nearest))
+			order.append(next_point)
+			nearest = np.minimum(nearest, np.sqrt(((points - points[next_point]) ** 2).sum(axis=1)))
+		return [known[i] for i in order] + unknown
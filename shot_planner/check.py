@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+"""
+Checks the clustering of the ShotPlanner on synthetic camera layouts: duplicates, mirrored cameras, a row of closely spaced cameras and malformed origins.
+
+Usage: python -m shot_planner.check
+"""
+from shot_planner import ShotPlanner
+
+def getCamera(x, y, z, yaw, team=ShotPlanner.TEAM_ANY):
+	return {'origin' : '{} {} {}'.format(x, y, z), 'angles' : '0 {} 0'.format(yaw), 'TeamNum' : str(team)}
+
+def checkClusters(name, cameras, spawn_points, expected_clusters):
+	clusters = ShotPlanner().plan(cameras, spawn_points)['clusters']
+	if clusters != expected_clusters:
+		print("WARNING: {}: expected clusters {}, got {}.".format(name, expected_clusters, clusters))
+		return False
+	print("{}: {}".format(name, clusters))
+	return True
+
+if __name__ == '__main__':
+	spawn_points = [{'origin' : '-3000 0 0', 'TeamNum' : str(ShotPlanner.TEAM_RED)}, {'origin' : '3000 0 0', 'TeamNum' : str(ShotPlanner.TEAM_BLUE)}]
+	results = [
+		# Two cameras at almost the same spot, looking the same way
+		checkClusters('duplicates', [getCamera(0, 0, 0, 0), getCamera(50, 20, 0, 5), getCamera(1000, 0, 0, 0)], [], [[0, 1], [2]]),
+		# The blue camera is the red one rotated around the center of the map
+		checkClusters('mirrored', [getCamera(-1000, 200, 100, 0, ShotPlanner.TEAM_RED), getCamera(1000, -200, 100, 180, ShotPlanner.TEAM_BLUE)], spawn_points, [[0, 1]]),
+		# Mirrored cameras of the same team are different viewpoints
+		checkClusters('mirrored same team', [getCamera(-1000, 200, 100, 0, ShotPlanner.TEAM_RED), getCamera(1000, -200, 100, 180, ShotPlanner.TEAM_RED)], spawn_points, [[0], [1]]),
+		# Every camera is within the distance tolerance of the next one, but the row spans 1000 units
+		checkClusters('row', [getCamera(x, 0, 0, 90) for x in range(0, 1100, 100)], [], [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9], [10]]),
+		# Malformed origins and angles are treated as missing, they do not stop the plan
+		checkClusters('malformed', [getCamera(0, 0, 0, 0), {'origin' : '1,2,3', 'angles' : '0 0 0'}, {'origin' : '1 2 3 4', 'angles' : '0 0'}, {'origin' : '50 0 0', 'angles' : 'up'}],
+			spawn_points + [{'origin' : '1 2', 'TeamNum' : str(ShotPlanner.TEAM_RED)}], [[0, 3], [1], [2]]),
+	]
+	if all(results):
+		print("All clustering checks passed.")
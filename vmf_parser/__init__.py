@@ -1,30 +1,48 @@
 #!/usr/bin/python
 # Created by Makamoto (teamwork.tf)
 import re
+from vmf_parser.entity import Entity
 
 class VMFParser(object):
 	"""
 	Stateless VMF (Valve Map Format) Parser for Python.
 	"""
 
-	def __init__(self):
+	def __init__(self, chunk_size=1024*1024, compact_entities=False):
 		"""
 		Contructor
 		"""
 		self.vmf_re = re.compile('"([^"]*?)" "([^"]*?)"')
+		self.chunk_size = chunk_size
+		self.compact_entities = compact_entities
 
-	def load(self, vmf_obj_location):
+	def load(self, vmf_obj_location, streaming=False, keep_blocks=None):
 		"""
 		Load an object from the filesystem.
+
+		With streaming=True the file is read in chunks of chunk_size bytes and parsed with an explicit stack instead of recursion, so only the current line and the chain of open objects are held in memory besides the result.
+
+		With compact_entities the top level entity blocks are returned as Entity objects instead of dicts.
+
+		keep_blocks is an optional set of block names (e.g. set(['world', 'entity'])) to keep, at any nesting depth. Every other block is scanned over without being turned into an object, along with everything nested inside it. Implies streaming=True.
 		"""
 		if type(vmf_obj_location) is not str:
 			raise Exception('Must supply the VMF file location in a str.')
 
+		if streaming == True or keep_blocks is not None:
+			with open(vmf_obj_location, 'r', self.chunk_size) as data_file:
+				return self.__parseStream(data_file, keep_blocks)
+
 		with open(vmf_obj_location) as data_file:
 			vmf_contents = data_file.read()	
 
 		lines = vmf_contents.split('\n')
 		obj = self.__parseLinesPerObj(lines)
+		if self.compact_entities == True and 'entity' in obj:
+			if type(obj['entity']) is list:
+				obj['entity'] = [Entity(entity) for entity in obj['entity']]
+			else:
+				obj['entity'] = Entity(obj['entity'])
 		return obj
 
 	def __parseLinesPerObj(self, lines, i=0):
@@ -57,8 +75,69 @@ class VMFParser(object):
 			i += 1
 		return obj
 
+	def __parseStream(self, lines, keep_blocks=None):
+		"""
+		Non-recursive equivalent of __parseLinesPerObj, consuming any iterable of lines.
+		"""
+		root = {}
+		stack = [root]
+		obj = root
+		skip_depth = 0
+		compact_entities = self.compact_entities
+		vmf_re_match = self.vmf_re.match
+		for line in lines:
+			line = line.strip()
+			if line == '':
+				continue
+			first = line[0]
+			if skip_depth > 0:
+				# Inside a skipped block, only track the brackets
+				if first == '{':
+					skip_depth += 1
+				elif first == '}':
+					skip_depth -= 1
+					if skip_depth == 1:
+						skip_depth = 0
+			elif first == '"':
+				# A var
+				result = vmf_re_match(line)
+				obj[result.group(1)] = result.group(2)
+			elif first == '}':
+				# End of this object, continue with the parent
+				if len(stack) > 1:
+					stack.pop()
+					if compact_entities and len(stack) == 1 and root.get('entity') is not None:
+						self.__compactLastEntity(root, obj)
+					obj = stack[-1]
+			elif first == '{':
+				# Opening bracket already came with object name
+				pass
+			elif keep_blocks is not None and line not in keep_blocks:
+				# Skip this obj, its opening bracket follows on the next line
+				skip_depth = 1
+			else:
+				# Obj in this obj
+				new_obj = {}
+				if line in obj:
+					# Check if it's already a list
+					if type(obj[line]) is not list:
+						obj[line] = [obj[line]]
+					obj[line].append(new_obj)
+				else:
+					obj[line] = new_obj
+				stack.append(new_obj)
+				obj = new_obj
+		return root
+
+	def __compactLastEntity(self, root, obj):
+		# Only replace obj when it is the entity block that was just closed
+		if root['entity'] is obj:
+			root['entity'] = Entity(obj)
+		elif type(root['entity']) is list and root['entity'][-1] is obj:
+			root['entity'][-1] = Entity(obj)
+
 	def save(obj):
 		"""
 		Save an VMF object to the filesystem.
 		"""
-		raise NotImplementedError()
\ No newline at end of file
+		raise NotImplementedError()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+"""
+Throughput benchmark for the VMFParser parse modes (recursive, streaming, selective and compact entities) on synthetic VMF files.
+Also checks that the gatherer extracts the same metadata with and without compact entities.
+
+Usage: python -m vmf_parser.benchmark [solids] [entities]
+"""
+import os, sys, time, tempfile
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+from vmf_parser import VMFParser
+
+def writeSyntheticVMF(filename, solids=20000, entities=5000):
+	"""
+	Write a VMF with the same block layout BSPSource produces: world with brushes, sides and displacements, followed by point entities.
+	"""
+	with open(filename, 'w') as f:
+		f.write('versioninfo\n{\n\t"editorversion" "400"\n\t"mapversion" "1"\n}\n')
+		f.write('world\n{\n\t"id" "1"\n\t"mapversion" "1234"\n\t"classname" "worldspawn"\n')
+		side_id = 0
+		for s in range(0, solids):
+			f.write('\tsolid\n\t{{\n\t\t"id" "{}"\n'.format(s))
+			for p in range(0, 6):
+				side_id += 1
+				f.write('\t\tside\n\t\t{\n')
+				f.write('\t\t\t"id" "{}"\n'.format(side_id))
+				f.write('\t\t\t"plane" "({} {} 0) ({} {} 64) ({} {} 64)"\n'.format(s, p, s+64, p, s, p+64))
+				f.write('\t\t\t"material" "TOOLS/TOOLSNODRAW"\n')
+				f.write('\t\t\t"uaxis" "[1 0 0 0] 0.25"\n\t\t\t"vaxis" "[0 -1 0 0] 0.25"\n')
+				if p == 0 and s % 10 == 0:
+					f.write('\t\t\tdispinfo\n\t\t\t{\n\t\t\t\t"power" "3"\n\t\t\t\tnormals\n\t\t\t\t{\n')
+					for row in range(0, 9):
+						f.write('\t\t\t\t\t"row{}" "{}"\n'.format(row, ' '.join(['0 0 1'] * 9)))
+					f.write('\t\t\t\t}\n\t\t\t}\n')
+				f.write('\t\t}\n')
+			f.write('\t\teditor\n\t\t{\n\t\t\t"color" "0 255 0"\n\t\t\t"visgroupshown" "1"\n\t\t}\n')
+			f.write('\t}\n')
+		f.write('}\n')
+		for e in range(0, entities):
+			f.write('entity\n{{\n\t"id" "{}"\n\t"classname" "item_healthkit_small"\n'.format(solids + e))
+			f.write('\t"origin" "{} {} 16"\n\t"angles" "0 0 0"\n'.format(e, -e))
+			f.write('\tconnections\n\t{\n\t\t"OnPlayerTouch" "relay,Trigger,,0,-1"\n\t}\n}\n')
+
+def benchmark(filename, parser_kwargs, load_kwargs):
+	parser = VMFParser(**parser_kwargs)
+	if tracemalloc is not None:
+		tracemalloc.start()
+	start = time.time()
+	obj = parser.load(filename, **load_kwargs)
+	elapsed = time.time() - start
+	peak = None
+	if tracemalloc is not None:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return (obj, elapsed, peak)
+
+def compareEntityModes(filename, dimensions_method='solids'):
+	"""
+	Gather the metadata of a VMF with plain dict entities and with compact entities, returns whether both give the same metadata.
+	"""
+	from map_data_gatherer import MapDataGatherer
+	maps_dir = os.path.dirname(filename)
+	map_name = os.path.basename(filename)[:-len('_d.vmf')]
+	results = []
+	for compact in (False, True):
+		try:
+			results.append(MapDataGatherer(compact_entities=compact).gatherMetadataForMap(maps_dir, map_name, dimensions_method=dimensions_method, file_hash=''))
+		except Exception as e:
+			print("Gathering the metadata with compact_entities={} failed: {!r}".format(compact, e))
+			return False
+	return results[0] == results[1]
+
+if __name__ == '__main__':
+	solids = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	entities = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+	fd, filename = tempfile.mkstemp(suffix='_d.vmf')
+	os.close(fd)
+	try:
+		writeSyntheticVMF(filename, solids, entities)
+		size_mb = os.path.getsize(filename) / (1024.0 * 1024.0)
+		print("Synthetic VMF: {} solids, {} entities, {:.1f} MB".format(solids, entities, size_mb))
+		results = {}
+		modes = [
+			('recursive', {}, {}),
+			('streaming', {}, {'streaming': True}),
+			('entities', {}, {'keep_blocks': set(['world', 'entity', 'connections', 'editor'])}),
+			('compact', {'compact_entities': True}, {'keep_blocks': set(['world', 'entity', 'connections', 'editor'])}),
+		]
+		for (name, parser_kwargs, load_kwargs) in modes:
+			(obj, elapsed, peak) = benchmark(filename, parser_kwargs, load_kwargs)
+			results[name] = obj
+			peak_str = 'n/a' if peak is None else '{:.1f} MB'.format(peak / (1024.0 * 1024.0))
+			print("{:<10} {:>7.2f} s {:>8.1f} MB/s  peak {}".format(name, elapsed, size_mb / elapsed, peak_str))
+		if results['recursive'] != results['streaming']:
+			print("WARNING: parse modes produced different objects.")
+		for dimensions_method in ['solids', 'entities']:
+			if not compareEntityModes(filename, dimensions_method):
+				print("WARNING: compact entities produced different metadata ({} dimensions).".format(dimensions_method))
+			else:
+				print("Compact entities produced the same metadata ({} dimensions).".format(dimensions_method))
+	finally:
+		os.remove(filename)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# Created by Makamoto (teamwork.tf)
+try:
+	intern
+except NameError:
+	# Python 3
+	from sys import intern
+
+class Entity(object):
+	"""
+	Compact representation of a VMF entity, which behaves like the read-only dict VMFParser returns otherwise.
+
+	The common keys are stored in slots: classname, targetname, model and id as (interned) strings, origin and angles as tuples of floats. All other keys, and nested blocks such as connections, are kept in the keyvalues side dict with interned keys.
+	Indexing origin or angles returns the original string; when the float tuple does not format back to exactly that string, the string is kept in keyvalues.
+	"""
+
+	__slots__ = ('classname', 'targetname', 'model', 'id', 'origin', 'angles', 'keyvalues')
+
+	STRING_KEYS = ('classname', 'targetname', 'model', 'id')
+	VECTOR_KEYS = ('origin', 'angles')
+
+	def __init__(self, obj):
+		"""
+		Contructor, obj is the dict of an entity block.
+		"""
+		self.classname = None
+		self.targetname = None
+		self.model = None
+		self.id = None
+		self.origin = None
+		self.angles = None
+		self.keyvalues = {}
+		for (key, value) in obj.items():
+			if key in Entity.STRING_KEYS:
+				setattr(self, key, intern(value))
+			elif key in Entity.VECTOR_KEYS and type(value) is str:
+				vector = self.__parseVector(value)
+				setattr(self, key, vector)
+				if vector is None or self.__formatVector(vector) != value:
+					self.keyvalues[key] = value
+			else:
+				self.keyvalues[intern(key)] = value
+
+	def __getitem__(self, key):
+		if key in self.keyvalues:
+			return self.keyvalues[key]
+		if key in Entity.STRING_KEYS:
+			value = getattr(self, key)
+			if value is not None:
+				return value
+		elif key in Entity.VECTOR_KEYS:
+			vector = getattr(self, key)
+			if vector is not None:
+				return self.__formatVector(vector)
+		raise KeyError(key)
+
+	def __contains__(self, key):
+		if key in self.keyvalues:
+			return True
+		if key in Entity.STRING_KEYS or key in Entity.VECTOR_KEYS:
+			return getattr(self, key) is not None
+		return False
+
+	def get(self, key, default=None):
+		if key in self:
+			return self[key]
+		return default
+
+	def keys(self):
+		keys = [key for key in Entity.STRING_KEYS + Entity.VECTOR_KEYS if getattr(self, key) is not None and key not in self.keyvalues]
+		keys.extend(self.keyvalues.keys())
+		return keys
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def toDict(self):
+		"""
+		The entity as a plain dict, as VMFParser returns it without compact entities. Used for the JSON output.
+		"""
+		return dict(self.items())
+
+	def __getstate__(self):
+		return self.toDict()
+
+	def __setstate__(self, state):
+		self.__init__(state)
+
+	def __repr__(self):
+		return 'Entity({!r})'.format(self.toDict())
+
+	def __parseVector(self, value):
+		parts = value.split(" ")
+		if len(parts) != 3:
+			return None
+		try:
+			return (float(parts[0]), float(parts[1]), float(parts[2]))
+		except ValueError:
+			return None
+
+	def __formatVector(self, vector):
+		return ' '.join([self.__formatFloat(f) for f in vector])
+
+	def __formatFloat(self, f):
+		if f.is_integer():
+			return '{:d}'.format(int(f))
+		return repr(f)